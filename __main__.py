@@ -17,14 +17,19 @@
     along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
 
 
-import flibrowser
 import sys
 from traceback import format_exception
 
-from gi.repository import Gtk
-
 
 def main(args):
+    if args[1:2] == ['--cli']:
+        # консольный режим, GTK не нужен
+        import fbcli
+        return fbcli.main(args[2:])
+
+    import flibrowser
+    from gi.repository import Gtk
+
     try:
         #raise ValueError(u'debug exception')
         flibrowser.main()
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Замеры скорости и расхода памяти на большой (обычно синтетической,
+см. fbsynthlib) библиотеке. Результаты пишутся в файл JSON, который
+можно сравнить с результатами другой версии (параметр --compare)."""
+
+
+from flibcrutch import *
+from fbtemplates import BookFileNameTemplate
+from fbsynthlib import SyntheticLibrary
+from fbcore import VERSION
+import argparse
+import tempfile
+import shutil
+import random
+import tracemalloc
+import subprocess
+from time import perf_counter
+from contextlib import redirect_stdout
+
+try:
+    import resource
+except ImportError:
+    # венда
+    resource = None
+
+
+# версия формата файла результатов
+RESULTS_FORMAT = 1
+
+# образцы для замеров поиска: (имя замера, параметры Library.search_books,
+# где значения - кортежи (образец, регулярное выражение, регулярное
+# выражение для нормализованных строк)).
+# каждый образец ищется перебором книг (замеры filter_*, см. Library.filter),
+# перебором нормализованных полей (scan_*, индекс поиска без триграмм)
+# и по индексу триграмм (замеры search_*, см. Library.search_books)
+FILTER_CASES = (('text_author', {'author':(u'иван', False, False)}),
+    ('text_title', {'title':(u'ёж', False, False)}),
+    ('text_author_title', {'author':(u'smith', False, False), 'title':(u'night', False, False)}),
+    ('regex_title', {'title':(u'\\bзвезд', True, False)}),
+    ('regex_author', {'author':(u'^(петр|сидор)', True, False)}),
+    ('nregex_author', {'author':(u'^(петр|сидор)', True, True)}),
+    ('regex_series', {'series':(u'^тайна.*(ночь|дом)', True, False)}),
+    ('nregex_series', {'series':(u'^тайна.*(ночь|дом)', True, True)}),
+    ('text_series_regex_title', {'series':(u'тайна', False, False), 'title':(u'дом$', True, False)}),
+    ('text_filename', {'filename':(u'77', False, False)}),
+    ('regex_author_alt', {'author':(u'(иванов|петров|smith|сидоров)', True, False)}),
+    ('regex_title_alt', {'title':(u'(ночь|звезды|дом)\\b.*(тайна|море)', True, False)}))
+
+# кол-во случайных регулярных выражений для проверки поиска по индексу
+# с отбором кандидатов по литералам (см. check_regex_search)
+REGEX_CHECKS = 30
+
+# кол-во имён с опечатками для замера нечёткого поиска авторов
+FUZZY_NAMES = 50
+
+SORT_BOOKS = 100000
+NEWEST_BOOKS = 200
+FNAME_BOOKS = 100000
+EXTRACT_BOOKS = 200
+FNAME_TEMPLATE = u'%a/%t %r'
+
+
+def maxrss_kb():
+    """Возвращает кортеж из пикового размера резидентной памяти (в килобайтах)
+    текущего процесса и его завершившихся дочерних процессов (напр. процессов
+    разбора индекса), или (None, None), если это узнать нельзя."""
+
+    if resource is None:
+        return (None, None)
+
+    # в линуксе ru_maxrss - в килобайтах, в макоси - в байтах
+    k = 1024 if sys.platform == 'darwin' else 1
+
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // k,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // k)
+
+
+class Benchmark():
+    """Набор замеров; результаты копятся в списке results."""
+
+    def __init__(self, repeat=3, quiet=True):
+        """repeat   - сколько раз повторять каждый замер (учитывается лучшее время);
+        quiet       - глушить то, что библиотека пишет в stdout."""
+
+        self.repeat = repeat
+        self.quiet = quiet
+        self.results = []
+
+    def run(self, name, func, repeat=None, **params):
+        """Замер времени выполнения func() (без параметров).
+        name    - имя замера;
+        repeat  - если не None - кол-во повторов вместо self.repeat;
+        params  - параметры замера, сохраняемые в результатах.
+        Возвращает значение, возвращённое последним вызовом func."""
+
+        times = []
+
+        for i in range(repeat if repeat is not None else self.repeat):
+            with redirect_stdout(open(os.devnull, 'w') if self.quiet else sys.stderr):
+                t0 = perf_counter()
+                r = func()
+                times.append(perf_counter() - t0)
+
+        rss, childrss = maxrss_kb()
+
+        self.results.append({'name':name,
+            'params':params,
+            'times':times,
+            'best':min(times),
+            'mean':sum(times) / len(times),
+            'maxrss_kb':rss,
+            'children_maxrss_kb':childrss})
+
+        print(u'%-32s %9.4f сек  %s' % (name, min(times),
+            u', '.join(u'%s=%s' % p for p in sorted(params.items()))), file=sys.stderr)
+
+        return r
+
+
+def make_library(inpxpath, workdir, languages, processes):
+    """Создание экземпляра Library для замеров (без файла настроек)."""
+
+    library = Library()
+    library.libraryRootDir = os.path.dirname(os.path.abspath(inpxpath))
+    library.libraryIndexFile = inpxpath
+    library.cfgDir = workdir
+    library.dataDirectory = workdir
+    library.genreNamesFile = os.path.join(workdir, Library.GENRE_NAMES_FNAME)
+    library.snapshotFile = os.path.join(workdir, Library.SNAPSHOT_FNAME)
+    library.extractDir = workdir
+    library.languages = languages
+    library.parserProcesses = processes
+
+    return library
+
+
+def random_regexes(library, count, seed=1):
+    """Генератор случайных регулярных выражений для проверки поиска
+    (см. check_regex_search): альтернативы (как делает "найденное - в поиск"
+    главного окна), якоря, повторы, необязательные группы и т.п. из слов,
+    взятых из полей книг библиотеки library.
+    Возвращает последовательность кортежей (имя поля, выражение)."""
+
+    rnd = random.Random(seed)
+    bookids = list(library.books.keys())
+
+    def _words(fldname):
+        bnfo = library.books[rnd.choice(bookids)]
+
+        if fldname == 'author':
+            s = library.authors[bnfo.authorid].aname
+        elif fldname == 'series':
+            s = library.get_series_name(bnfo.series)
+        else:
+            s = getattr(bnfo, fldname)
+
+        return [w for w in re.split(r'[\W_]+', s) if w] or [u'x']
+
+    def _word(fldname):
+        w = rnd.choice(_words(fldname))
+
+        # кусок слова в случайном регистре
+        if len(w) > 3 and rnd.random() < 0.5:
+            start = rnd.randrange(len(w) - 2)
+            w = w[start:start + rnd.randint(2, len(w) - start)]
+
+        return re.escape(w.upper() if rnd.random() < 0.2 else w)
+
+    forms = (lambda f: u'(%s)' % u'|'.join(_word(f) for i in range(rnd.randint(2, 6))),
+        lambda f: u'^%s' % _word(f),
+        lambda f: u'%s$' % _word(f),
+        lambda f: u'\\b%s' % _word(f),
+        lambda f: u'%s.*%s' % (_word(f), _word(f)),
+        lambda f: u'(%s)+%s' % (_word(f), _word(f)),
+        lambda f: u'(%s)?%s' % (_word(f), _word(f)),
+        lambda f: u'(?:%s|%s) %s' % (_word(f), _word(f), _word(f)),
+        lambda f: u'%s\\s+\\w' % _word(f),
+        lambda f: u'[а-я]%s|%s' % (_word(f), _word(f)),
+        lambda f: u'.*',
+        lambda f: u'(?-i:%s)' % _word(f))
+
+    for i in range(count):
+        fldname = rnd.choice(BookQuery.FIELDS)
+        yield (fldname, rnd.choice(forms)(fldname))
+
+
+def check_regex_search(library, count, seed=1):
+    """Проверка того, что регулярные выражения находятся поиском
+    (Library.search_books - по индексу с отбором кандидатов по литералам,
+    см. fbsearch.regex_literals) ровно там же, где и перебором всех книг
+    с re.search. Проверяется count случайных выражений (см. random_regexes),
+    каждое - и в исходных, и в нормализованных полях.
+    При несовпадении генерирует исключение."""
+
+    for fldname, regex in random_regexes(library, count, seed):
+        for normalized in (False, True):
+            sp = SearchPattern(regex, True, None, normalized)
+
+            expected = set(library.filter(library.book_filter(**{fldname:sp.match})))
+            found = library.search_books(**{fldname:sp})
+
+            if len(found) != len(expected) or set(found) != expected:
+                raise Exception(u'поиск регулярного выражения %s=/%s/%s по индексу и перебором не совпадает: %d и %d книг' % (
+                    fldname, regex, u'n' if normalized else u'', len(found), len(expected)))
+
+
+def run_benchmarks(bench, inpxpath, workdir, languages, processes, usetracemalloc=True, regexchecks=REGEX_CHECKS):
+    """Выполнение всех замеров. Возвращает кортеж из словаря со сведениями
+    о библиотеке и словаря с результатами замеров памяти.
+    regexchecks - см. check_regex_search."""
+
+    library = None
+    memory = {}
+
+    #
+    # разбор индекса
+    #
+    def _parse(nproc):
+        nonlocal library
+
+        library = make_library(inpxpath, workdir, languages, nproc)
+        library.parse_inpx_file(inpxpath, None, nproc)
+
+    bench.run('parse_inpx_file', lambda: _parse(1), processes=1)
+
+    processes = processes or multiprocessing.cpu_count()
+    if processes > 1:
+        bench.run('parse_inpx_file', lambda: _parse(processes), processes=processes)
+
+    if usetracemalloc:
+        # отдельным проходом, т.к. под tracemalloc всё сильно медленнее
+        tracemalloc.start()
+        bench.run('parse_inpx_file_traced', lambda: _parse(1), repeat=1, processes=1)
+        memory['parse_traced_peak_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+
+        # чистый размер загруженной библиотеки
+        library = None
+        tracemalloc.start()
+        with redirect_stdout(open(os.devnull, 'w') if bench.quiet else sys.stderr):
+            _parse(1)
+        memory['library_traced_kb'] = tracemalloc.get_traced_memory()[0] // 1024
+        tracemalloc.stop()
+
+    libinfo = {'inpx':os.path.abspath(inpxpath),
+        'inpx_size':os.path.getsize(inpxpath),
+        'inp_members':len(library.indexMembers),
+        'books':len(library.books),
+        'authors':len(library.authors),
+        'series':len(library.series),
+        'tags':len(library.tags),
+        'languages':sorted(languages)}
+
+    #
+    # снимок
+    #
+    bench.run('save_snapshot', lambda: library.save_snapshot(inpxpath), repeat=1)
+    if not bench.run('load_snapshot', lambda: library.load_snapshot(inpxpath)):
+        raise Exception(u'снимок индекса не загрузился')
+
+    #
+    # поиск - перебором и по индексу
+    #
+    def _patterns(fields):
+        return {fldname:SearchPattern(pattern, isregex, filter_author_pattern if fldname == 'author' else None, normalized)
+            for fldname, (pattern, isregex, normalized) in fields.items()}
+
+    def _patdescr(fields):
+        return u'; '.join(u'%s%s=%s' % (k, (u'(nre)' if v[2] else u'(re)') if v[1] else u'', v[0]) for k, v in sorted(fields.items()))
+
+    def _search(what, fields):
+        patterns = _patterns(fields)
+
+        found = bench.run('%s_%s' % (what, name), lambda: library.search_books(**patterns), patterns=_patdescr(fields))
+        bench.results[-1]['found'] = len(found)
+
+        return set(found)
+
+    filterfound = {}
+
+    for name, fields in FILTER_CASES:
+        filterfunc = library.book_filter(**{fldname:sp.match for fldname, sp in _patterns(fields).items()})
+
+        found = bench.run('filter_%s' % name, lambda: library.filter(filterfunc), patterns=_patdescr(fields))
+        bench.results[-1]['found'] = len(found)
+        filterfound[name] = set(found)
+
+    for trigrams, what in ((False, 'scan'), (True, 'search')):
+        bench.run('build_search_index', lambda: library.build_search_index(trigrams), trigrams=trigrams)
+
+        for name, fields in FILTER_CASES:
+            if _search(what, fields) != filterfound[name]:
+                raise Exception(u'результаты поиска по индексу (%s) и перебором не совпадают (%s)' % (what, _patdescr(fields)))
+
+        if regexchecks > 0:
+            bench.run('check_regex_%s' % what, lambda: check_regex_search(library, regexchecks), repeat=1, expressions=regexchecks)
+
+    #
+    # нечёткий поиск авторов - по фамилиям случайных авторов с опечаткой
+    #
+    def _build_fuzzy():
+        library.authorFuzzyIndex = None
+        return library.build_fuzzy_author_index()
+
+    bench.run('build_fuzzy_author_index', _build_fuzzy, authors=len(library.authors))
+
+    rnd = random.Random(1)
+    fuzzynames = []
+    for anfo in rnd.sample(library.authors, min(FUZZY_NAMES, len(library.authors))):
+        surname = anfo.aname.split()[0] if anfo.aname.split() else u''
+        if len(surname) > 3:
+            ix = rnd.randrange(len(surname))
+            fuzzynames.append(surname[:ix] + surname[ix + 1:])
+
+    fuzzykeys = [SearchPattern(name, fuzzy=True).pattern for name in fuzzynames]
+
+    bench.run('fuzzy_authors', lambda: [library.fuzzy_authors(key) for key in fuzzykeys], names=len(fuzzykeys))
+
+    #
+    # поиск с сортировкой (как в главном окне) - без кэша и с кэшем результатов
+    #
+    library.searchCache.maxitems = max(library.searchCache.maxitems, len(FILTER_CASES))
+
+    for name, fields in FILTER_CASES:
+        query = BookQuery(_patterns(fields))
+
+        def _find_cold():
+            library.searchCache.clear()
+            return library.find_books(query)
+
+        found = bench.run('find_cold_%s' % name, _find_cold, patterns=_patdescr(fields))
+        bench.results[-1]['found'] = len(found)
+
+        found = bench.run('find_cached_%s' % name, lambda: library.find_books(query), patterns=_patdescr(fields))
+        bench.results[-1]['found'] = len(found)
+
+    libinfo['search_cache'] = library.searchCache.stats()
+
+    #
+    # последние поступления и поиск только по дате (срезы отсортированных
+    # по дате строк индекса)
+    #
+    bench.run('newest_books', lambda: library.newest_books(NEWEST_BOOKS), books=NEWEST_BOOKS)
+
+    newest = library.newest_books(1)
+    if newest:
+        mindate = library.books[newest[0]].date - datetime.timedelta(days=365)
+
+        found = bench.run('search_dates', lambda: library.run_query(BookQuery(mindate=mindate)), mindate=str(mindate))
+        bench.results[-1]['found'] = len(found)
+
+    #
+    # сортировка всей библиотеки и найденного (см. Library.sort_books)
+    #
+    rnd = random.Random(1)
+    allbookids = list(library.books.keys())
+    tosort = rnd.sample(allbookids, min(SORT_BOOKS, len(allbookids)))
+
+    def _build_ranks(order):
+        library.sortRanks.pop(order, None)
+        return library.build_sort_ranks(order)
+
+    for order in Library.SORT_ORDERS:
+        bench.run('build_sort_ranks', lambda: _build_ranks(order), order=order)
+        bench.run('sort_books', lambda: library.sort_books(tosort, order), order=order, books=len(tosort))
+
+    #
+    # фасеты найденного (как в панели фасет главного окна)
+    #
+    bench.run('book_facets', lambda: library.book_facets(tosort), books=len(tosort))
+    bench.run('filter_facets', lambda: library.filter_facets(tosort, {'format':'fb2'}), books=len(tosort))
+
+    #
+    # имена файлов по шаблону
+    #
+    template = BookFileNameTemplate(library, FNAME_TEMPLATE)
+    fnamebooks = [library.books[bookid] for bookid in allbookids[:FNAME_BOOKS]]
+
+    bench.run('get_book_fname', lambda: [template.get_book_fname(bnfo) for bnfo in fnamebooks],
+        books=len(fnamebooks), template=FNAME_TEMPLATE)
+
+    #
+    # извлечение книг (если есть архивы)
+    #
+    toextract = rnd.sample(allbookids, min(EXTRACT_BOOKS, len(allbookids)))
+
+    if all(os.path.exists(os.path.join(library.libraryRootDir, library.bundles[library.books[bookid].bundle])) for bookid in toextract):
+        extractdir = os.path.join(workdir, 'extract')
+        library.extractDir = extractdir
+
+        def _extract(pack):
+            shutil.rmtree(extractdir, True)
+            os.makedirs(extractdir)
+
+            em = library.extract_books(toextract, template, pack)
+            if em:
+                raise Exception(em)
+
+        bench.run('extract_books', lambda: _extract(False), books=len(toextract), pack=False)
+        bench.run('extract_books', lambda: _extract(True), books=len(toextract), pack=True)
+
+        shutil.rmtree(extractdir, True)
+    else:
+        print(u'Архивов с книгами нет, извлечение не замеряется', file=sys.stderr)
+
+    return (libinfo, memory)
+
+
+def git_revision():
+    """Возвращает описание текущей ревизии (если исходники лежат в git), иначе None."""
+
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old, new):
+    """Вывод в stdout сравнения результатов old и new (словарей из файлов результатов)."""
+
+    def _key(r):
+        return (r['name'], json.dumps(r['params'], sort_keys=True))
+
+    oldresults = {_key(r):r for r in old['results']}
+
+    print(u'%-32s %10s %10s %8s' % (u'замер', old.get('label') or u'было', new.get('label') or u'стало', u'стало/было'))
+
+    for r in new['results']:
+        o = oldresults.get(_key(r))
+        if o is None:
+            print(u'%-32s %10s %10.4f' % (r['name'], u'-', r['best']))
+        else:
+            print(u'%-32s %10.4f %10.4f %8.2f' % (r['name'], o['best'], r['best'],
+                r['best'] / o['best'] if o['best'] else 0.0))
+
+    for k in sorted(new.get('memory', {})):
+        if k in old.get('memory', {}):
+            print(u'%-32s %10d %10d %8.2f' % (k, old['memory'][k], new['memory'][k],
+                new['memory'][k] / old['memory'][k] if old['memory'][k] else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u'Замеры скорости и расхода памяти Flibrowser')
+
+    grp = parser.add_mutually_exclusive_group()
+    grp.add_argument('--inpx', help=u'индексный файл существующей библиотеки')
+    grp.add_argument('-n', '--books', type=int, default=100000,
+        help=u'кол-во книг в синтетической библиотеке (если не указан --inpx; по умолчанию - 100000)')
+
+    parser.add_argument('--seed', type=int, default=1, help=u'затравка генератора синтетической библиотеки')
+    parser.add_argument('--no-bundles', action='store_true', help=u'не создавать архивы синтетической библиотеки (без замеров извлечения)')
+    parser.add_argument('--workdir', help=u'каталог для синтетической библиотеки и временных файлов; '\
+        u'если там уже есть библиотека с теми же параметрами - она не генерируется заново '\
+        u'(по умолчанию - временный каталог, удаляемый по завершении)')
+    parser.add_argument('--languages', default=u'ru', help=u'допустимые языки через пробел или запятую (по умолчанию - ru)')
+    parser.add_argument('--processes', type=int, default=0, help=u'кол-во процессов для разбора индекса (по умолчанию - по кол-ву процессоров)')
+    parser.add_argument('--repeat', type=int, default=3, help=u'кол-во повторов каждого замера')
+    parser.add_argument('--no-tracemalloc', action='store_true', help=u'не замерять память через tracemalloc')
+    parser.add_argument('--regex-checks', type=int, default=REGEX_CHECKS,
+        help=u'кол-во случайных регулярных выражений для проверки того, что поиск по индексу '\
+            u'находит то же, что и перебор (0 - без проверки; по умолчанию - %d)' % REGEX_CHECKS)
+    parser.add_argument('--label', help=u'метка результатов (напр. версия или ветка)')
+    parser.add_argument('-o', '--output', help=u'файл для результатов в формате JSON (по умолчанию - stdout)')
+    parser.add_argument('--compare', metavar=u'ФАЙЛ', help=u'сравнить результаты с ранее сохранёнными в ФАЙЛ')
+    parser.add_argument('-v', '--verbose', action='store_true', help=u'не глушить сообщения библиотеки')
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='fbbench-')
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    try:
+        if args.inpx:
+            inpxpath = args.inpx
+            synthparams = None
+        else:
+            synthparams = {'books':args.books, 'seed':args.seed, 'bundles':not args.no_bundles}
+
+            libdir = os.path.join(workdir, 'library')
+            inpxpath = os.path.join(libdir, u'library.inpx')
+            paramspath = os.path.join(libdir, u'params.json')
+
+            oldparams = None
+            if os.path.exists(paramspath):
+                with open(paramspath, 'r') as f:
+                    oldparams = json.load(f)
+
+            if oldparams != synthparams or not os.path.exists(inpxpath):
+                print(u'Генерация синтетической библиотеки (%d книг)...' % args.books, file=sys.stderr)
+
+                shutil.rmtree(libdir, True)
+                t0 = perf_counter()
+                SyntheticLibrary(args.books, args.seed).write(libdir, bundles=not args.no_bundles)
+                print(u'  %.1f сек' % (perf_counter() - t0), file=sys.stderr)
+
+                with open(paramspath, 'w') as f:
+                    json.dump(synthparams, f)
+
+        languages = set(filter(None, args.languages.lower().replace(u',', u' ').split()))
+
+        bench = Benchmark(args.repeat, not args.verbose)
+        libinfo, memory = run_benchmarks(bench, inpxpath, workdir, languages, args.processes, not args.no_tracemalloc, args.regex_checks)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, True)
+
+    memory['maxrss_kb'], memory['children_maxrss_kb'] = maxrss_kb()
+
+    results = {'format':RESULTS_FORMAT,
+        'label':args.label,
+        'version':VERSION,
+        'revision':git_revision(),
+        'date':datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':sys.version.split()[0],
+        'platform':sys.platform,
+        'cpus':multiprocessing.cpu_count(),
+        'repeat':args.repeat,
+        'synthetic':synthparams,
+        'library':libinfo,
+        'memory':memory,
+        'results':bench.results}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    else:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=1)
+        print()
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare_results(json.load(f), results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Консольный режим: поиск книг и извлечение их из архивов без GTK
+(для скриптов, пакетной обработки и замеров скорости).
+Поиск - как в главном окне (см. SearchPattern, Library.find_books)."""
+
+
+from flibcrutch import *
+from fbtemplates import BookFileNameTemplate
+import argparse
+import locale
+from contextlib import redirect_stdout
+
+
+# столбцы вывода результатов поиска - как в списке книг главного окна
+OUTPUT_COLUMNS = ('bookid', 'author', 'title', 'series', 'serno', 'genres',
+    'size', 'format', 'date', 'bundle', 'filename')
+
+
+class PhaseTimer():
+    """Замер времени этапов работы. Времена выводятся в stderr,
+    дабы не смешиваться с результатами в stdout."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.t0 = time()
+        self.phases = []
+
+    def phase(self, name):
+        """Завершение этапа name (отсчёт - от завершения предыдущего)."""
+
+        t = time()
+        self.phases.append((name, t - self.t0))
+
+        if self.enabled:
+            print(u'[время] %s: %.3f сек' % (name, t - self.t0), file=sys.stderr)
+
+        self.t0 = t
+
+
+def facets_lines(facets):
+    """Возвращает список строк с кол-вом книг по фасетам facets
+    (см. Library.book_facets) - по строке на фасету."""
+
+    ret = []
+
+    for facet in Library.FACETS:
+        counts = facets[facet]
+
+        if facet == 'year':
+            values = sorted(counts, reverse=True)
+        else:
+            values = sorted(counts, key=lambda v: (-counts[v], v))
+
+        ret.append(u'%s: %s' % (facet, u', '.join(u'%s=%d' % (v if v != u'' else u'?', counts[v]) for v in values)))
+
+    return ret
+
+
+def book_record(library, bnfo):
+    """Возвращает словарь со значениями полей OUTPUT_COLUMNS книги bnfo."""
+
+    return {'bookid':bnfo.bookid,
+        'author':library.authors[bnfo.authorid].aname,
+        'title':bnfo.title,
+        'series':library.get_series_name(bnfo.series),
+        'serno':bnfo.serno,
+        'genres':library.get_book_tags(bnfo),
+        'size':bnfo.fsize,
+        'format':bnfo.format,
+        'date':bnfo.date.isoformat(),
+        'bundle':library.bundles[bnfo.bundle],
+        'filename':bnfo.filename}
+
+
+def print_tsv(library, bookids, f):
+    def _tsv_str(v):
+        # в TSV табуляции и переводы строк внутри значений недопустимы
+        return str(v).replace(u'\t', u' ').replace(u'\n', u' ').replace(u'\r', u' ')
+
+    print(u'\t'.join(OUTPUT_COLUMNS), file=f)
+
+    for bookid in bookids:
+        r = book_record(library, library.books[bookid])
+        print(u'\t'.join(_tsv_str(r[cname]) for cname in OUTPUT_COLUMNS), file=f)
+
+
+def print_json(library, bookids, f):
+    json.dump([book_record(library, library.books[bookid]) for bookid in bookids],
+        f, ensure_ascii=False, indent=1)
+    print(file=f)
+
+
+OUTPUT_FORMATS = {'tsv':print_tsv, 'json':print_json}
+
+
+def date_arg(s):
+    """Преобразование параметра командной строки вида YYYY-MM-DD в datetime.date"""
+
+    d = inpx_date_to_ordinal(s.encode('ascii', 'replace'), None)
+    if d is None:
+        raise argparse.ArgumentTypeError(u'неправильная дата - "%s"' % s)
+
+    return datetime.date.fromordinal(d)
+
+
+def make_arg_parser():
+    parser = argparse.ArgumentParser(prog='fbcli',
+        description=u'Поиск книг в библиотеке Flibrowser и извлечение их из архивов без GUI. '\
+            u'Настройки - из файла настроек Flibrowser. '\
+            u'Ищутся книги, у которых совпали все указанные поля; '\
+            u'образец ищется как подстрока без учёта регистра, разницы между "ё" и "е", '\
+            u'знаков препинания и лишних пробелов, '\
+            u'или, если указан параметр с суффиксом -re - как регулярное выражение.')
+
+    grp = parser.add_argument_group(u'поиск')
+
+    for fldname, fldtitle in (('author', u'имя автора'),
+            ('title', u'название книги'),
+            ('series', u'название цикла'),
+            ('filename', u'имя файла книги')):
+        fgrp = grp.add_mutually_exclusive_group()
+        fgrp.add_argument('--%s' % fldname, metavar=u'СТРОКА', help=u'%s содержит строку' % fldtitle)
+        fgrp.add_argument('--%s-re' % fldname, metavar=u'ВЫРАЖЕНИЕ', help=u'%s соответствует регулярному выражению' % fldtitle)
+
+        if fldname == 'author':
+            fgrp.add_argument('--author-fuzzy', metavar=u'ИМЯ', help=u'нечёткий поиск автора: имена с опечатками, '\
+                u'в другой транслитерации, с инициалами вместо имени и т.п.')
+
+    grp.add_argument('--normalized-re', action='store_true',
+        help=u'регулярные выражения искать в нормализованных полях (без "ё" и знаков препинания, '\
+            u'пробелы - по одному), что быстрее')
+    grp.add_argument('--min-date', type=date_arg, metavar=u'ГГГГ-ММ-ДД', help=u'книги не старше указанной даты')
+    grp.add_argument('--max-date', type=date_arg, metavar=u'ГГГГ-ММ-ДД', help=u'книги не новее указанной даты')
+    grp.add_argument('--lang', nargs='+', metavar=u'ЯЗЫК', help=u'книги на указанных языках (коды, напр. ru en)')
+    grp.add_argument('--book-format', nargs='+', metavar=u'ФОРМАТ', help=u'книги в указанных форматах (напр. fb2 pdf)')
+    grp.add_argument('--genre', nargs='+', metavar=u'ТЭГ', help=u'книги с любым из указанных жанров (тэгов, напр. sf_fantasy)')
+    grp.add_argument('--all-genres', action='store_true', help=u'книги со всеми жанрами, указанными в --genre')
+    grp.add_argument('--not-genre', nargs='+', metavar=u'ТЭГ', help=u'книги без указанных жанров')
+    grp.add_argument('--limit', type=int, default=0, metavar='N', help=u'выводить не более N книг')
+    grp.add_argument('--newest', type=int, metavar='N', help=u'N последних поступлений в библиотеку (среди найденного, '\
+        u'если заданы условия поиска), от новых к старым')
+    grp.add_argument('--explain', action='store_true', help=u'вывести в stderr план поиска (порядок проверки условий '\
+        u'и кол-во книг, отобранных на каждом шаге)')
+    grp.add_argument('--facets', action='store_true', help=u'вывести в stderr кол-во найденных книг по жанрам, '\
+        u'языкам, форматам и годам добавления')
+
+    grp = parser.add_argument_group(u'вывод')
+    grp.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default='tsv', help=u'формат вывода найденного (по умолчанию - tsv)')
+    grp.add_argument('--sort', choices=Library.SORT_ORDERS,
+        help=u'порядок сортировки найденного: цикл, автор, название, формат, дата добавления или размер файла '\
+            u'(по умолчанию - %s, как в главном окне; с --newest - от новых к старым)' % Library.SORT_DEFAULT)
+    grp.add_argument('-o', '--output', metavar=u'ФАЙЛ', help=u'файл для вывода найденного (по умолчанию - stdout)')
+    grp.add_argument('--no-timings', action='store_true', help=u'не выводить в stderr время этапов работы')
+
+    grp = parser.add_argument_group(u'извлечение книг')
+    grp.add_argument('--extract', type=int, nargs='+', metavar='BOOKID', help=u'извлечь книги с указанными идентификаторами')
+    grp.add_argument('--extract-found', action='store_true', help=u'извлечь найденные книги')
+    grp.add_argument('--extract-dir', metavar=u'КАТАЛОГ', help=u'каталог для извлекаемых книг (по умолчанию - из настроек)')
+    grp.add_argument('--template', default=u'', metavar=u'ШАБЛОН', help=u'шаблон имени файла (см. README.md)')
+    grp.add_argument('--zip', action='store_true', help=u'сжимать извлечённые книги ZIPом')
+
+    grp = parser.add_argument_group(u'библиотека')
+    grp.add_argument('--root', metavar=u'КАТАЛОГ', help=u'корневой каталог библиотеки (вместо указанного в настройках)')
+    grp.add_argument('--index', metavar=u'ФАЙЛ', help=u'индексный файл .inpx (вместо указанного в настройках)')
+    grp.add_argument('--processes', type=int, metavar='N', help=u'кол-во процессов для разбора индекса (вместо указанного в настройках)')
+    grp.add_argument('--no-cache', action='store_true', help=u'не загружать и не сохранять снимок разобранного индекса')
+
+    return parser
+
+
+def main(args=None):
+    """Разбор командной строки (args - список параметров; если None -
+    берётся sys.argv[1:]) и выполнение.
+    Возвращает код завершения для sys.exit()."""
+
+    args = make_arg_parser().parse_args(args)
+
+    # имена и названия сортируются по правилам локали (см. collation_key)
+    try:
+        locale.setlocale(locale.LC_COLLATE, '')
+    except locale.Error:
+        pass
+
+    timer = PhaseTimer(not args.no_timings)
+
+    def _error(msg):
+        print(u'Ошибка: %s' % msg, file=sys.stderr)
+        return 1
+
+    try:
+        patterns = {}
+
+        for fldname in ('author', 'title', 'series', 'filename'):
+            isregex = getattr(args, '%s_re' % fldname) is not None
+            sp = SearchPattern(getattr(args, '%s_re' % fldname) if isregex else getattr(args, fldname),
+                isregex, filter_author_pattern if fldname == 'author' else None, args.normalized_re)
+            patterns[fldname] = sp if sp.match else None
+
+        if args.author_fuzzy:
+            sp = SearchPattern(args.author_fuzzy, patfilter=filter_author_pattern, fuzzy=True)
+            patterns['author'] = sp if sp.match else None
+    except re.error as ex:
+        return _error(u'неправильное регулярное выражение - %s' % str(ex))
+
+    query = BookQuery(patterns, args.min_date, args.max_date, args.lang, args.book_format,
+        args.genre, args.not_genre, args.all_genres)
+
+    dosearch = bool(query) or args.newest is not None
+
+    if not dosearch and not args.extract:
+        return _error(u'не указаны ни образцы для поиска, ни книги для извлечения')
+
+    if args.extract_found and not dosearch:
+        return _error(u'--extract-found без условий поиска')
+
+    #
+    # настройки
+    #
+    library = Library()
+
+    em = library.load_settings()
+    if em and not (args.root and args.index):
+        return _error(em)
+
+    if args.root:
+        library.libraryRootDir = args.root
+    if args.index:
+        library.libraryIndexFile = args.index
+    if args.extract_dir:
+        library.extractDir = args.extract_dir
+    if args.processes is not None:
+        library.parserProcesses = args.processes
+
+    em = library.validate_settings()
+    if em:
+        return _error(em)
+
+    if args.no_cache:
+        library.snapshotFile = None
+
+    timer.phase(u'настройки')
+
+    #
+    # загрузка - все сообщения библиотеки тоже в stderr, дабы не портить вывод
+    #
+    try:
+        with redirect_stdout(sys.stderr):
+            library.load()
+    except Exception as ex:
+        return _error(str(ex))
+
+    timer.phase(u'загрузка библиотеки')
+
+    #
+    # поиск
+    #
+    if dosearch:
+        if query:
+            # то же, что Library.find_books, но с планом поиска под рукой
+            plan = library.plan_query(query)
+            found = library.sort_books(library.execute_plan(plan), args.sort or Library.SORT_DEFAULT)
+
+            if args.explain:
+                print(u'\n'.join(plan.explain()), file=sys.stderr)
+
+            if args.newest is not None:
+                found = library.newest_books(args.newest, within=found)
+        else:
+            found = library.newest_books(args.newest)
+
+        # последние поступления - от новых к старым, если порядок не указан явно
+        if args.newest is not None and args.sort:
+            found = library.sort_books(found, args.sort)
+
+        if args.facets:
+            print(u'\n'.join(facets_lines(library.book_facets(found))), file=sys.stderr)
+
+        # --limit ограничивает только вывод, найденное (и извлекаемое) - всё
+        shown = found[:args.limit] if args.limit > 0 else found
+
+        timer.phase(u'поиск')
+
+        printfunc = OUTPUT_FORMATS[args.format]
+
+        try:
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    printfunc(library, shown, f)
+            else:
+                printfunc(library, shown, sys.stdout)
+        except OSError as ex:
+            return _error(str(ex))
+
+        timer.phase(u'вывод')
+
+        if len(shown) != len(found):
+            print(u'Найдено книг: %d, выведено: %d' % (len(found), len(shown)), file=sys.stderr)
+        else:
+            print(u'Найдено книг: %d' % len(found), file=sys.stderr)
+    else:
+        found = []
+
+    #
+    # извлечение
+    #
+    toextract = []
+
+    if args.extract:
+        for bookid in args.extract:
+            if bookid not in library.books:
+                return _error(u'книги с идентификатором %d нет в библиотеке' % bookid)
+
+        toextract += args.extract
+
+    if args.extract_found:
+        toextract += found
+
+    toextract = list(dict.fromkeys(toextract)) # без повторов, но в том же порядке
+
+    if toextract:
+        try:
+            template = BookFileNameTemplate(library, args.template)
+        except ValueError as ex:
+            return _error(str(ex))
+
+        with redirect_stdout(sys.stderr):
+            em = library.extract_books(toextract, template, args.zip)
+
+        timer.phase(u'извлечение')
+
+        if em:
+            return _error(em)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
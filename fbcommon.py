@@ -17,9 +17,7 @@
     along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
 
 
-TITLE = u'Flibrowser'
-VERSION = u'1.8.8.2'
-COPYRIGHT = u'Copyright 2014..2018 MC-6312'
+from fbcore import *
 
 
 GTK_VERSION = '3.0'
@@ -35,64 +33,10 @@ WIDGET_SPACING = 4
 UI_ENCODING = 'utf-8'
 
 
-from locale import getdefaultlocale
-from sys import getfilesystemencoding
-
-
-# кодировка файла настроек (и прочего, зависящего от ОС)
-# спасибо гнойной венде, где до сих пор 3 кодировки одновременно...
-IOENCODING = getdefaultlocale()[1]
-if not IOENCODING:
-    IOENCODING = getfilesystemencoding()
-
-
 from gi.repository import Gtk, GObject, Pango
 from gi.repository.GdkPixbuf import Pixbuf, Colorspace as GdkPixbuf_Colorspace
 
 
-BOOK_AGE_COLORS = ('#00FF00',
-    '#A8FF00',
-    '#B8FF00',
-    '#FFFF00',
-    '#FFF400',
-    '#FFD700',
-    '#FFB900',
-    '#FF9C00',
-    '#FF7A00',
-    '#FF5A00',
-    '#FF3A00',
-    '#FF1B00',
-    '#EE2D1A',
-    '#E03C2F',
-    '#D34A43',
-    '#C55958',
-    '#B8676D',
-    '#AA7681',
-    '#9D8496',
-    '#8F93AA')
-
-BOOK_AGE_MAX = len(BOOK_AGE_COLORS) - 1
-
-
-
-def get_book_age_color(nowdate, bookdate):
-    """Возвращает цвет в виде "#RRGGBB", соответствующий "свежести" книги.
-    Готовой функции, считающей в месяцах, в стандартной библиотеке нет,
-    возиться с точными вычислениями, учитывающими месяцы разной длины
-    и високосные года, а также обвешивать софтину зависимостями на
-    сторонние библиотеки мне влом, а потому "свежесть" считается
-    в четырёхнедельных промежутках от текущей даты (nowdate)."""
-
-    delta = (nowdate - bookdate).days // 28
-
-    if delta < 0:
-        # нет гарантии, что в БД лежала правильная дата
-        delta = 0
-    elif delta > BOOK_AGE_MAX:
-        delta = BOOK_AGE_MAX
-
-    return BOOK_AGE_COLORS[delta]
-
 #print(create_book_age_icons())
 #exit(0)
 
@@ -213,10 +157,6 @@ class LabeledGrid(Gtk.Grid):
         self.curcol = widget
 
 
-def kilobytes_str(n):
-    return u'%gk' % round(n / 1024.0, 1)
-
-
 def msg_dialog(parent, title, msg, msgtype=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.OK):
     dlg = Gtk.MessageDialog(parent, 0, msgtype, buttons, msg)
     dlg.set_title(title)
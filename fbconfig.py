@@ -18,7 +18,7 @@
 
 
 import os.path, sys
-from fbcommon import IOENCODING
+from fbcore import IOENCODING
 
 
 # в жопу ConfigParser! в ём слишком много лишнего, а то, что есть - один фиг требует писания обёрток
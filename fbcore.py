@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+
+"""Общие для всех модулей определения, не зависящие от GTK.
+Модули ядра (flibcrutch, fbconfig, fbtemplates и пр.) импортируют
+только этот модуль, а не fbcommon, дабы работать без GUI
+(и не тратить время на загрузку GTK)."""
+
+
+TITLE = u'Flibrowser'
+VERSION = u'1.8.8.2'
+COPYRIGHT = u'Copyright 2014..2018 MC-6312'
+
+
+from locale import getdefaultlocale
+from sys import getfilesystemencoding
+
+
+# кодировка файла настроек (и прочего, зависящего от ОС)
+# спасибо гнойной венде, где до сих пор 3 кодировки одновременно...
+IOENCODING = getdefaultlocale()[1]
+if not IOENCODING:
+    IOENCODING = getfilesystemencoding()
+
+
+BOOK_AGE_COLORS = ('#00FF00',
+    '#A8FF00',
+    '#B8FF00',
+    '#FFFF00',
+    '#FFF400',
+    '#FFD700',
+    '#FFB900',
+    '#FF9C00',
+    '#FF7A00',
+    '#FF5A00',
+    '#FF3A00',
+    '#FF1B00',
+    '#EE2D1A',
+    '#E03C2F',
+    '#D34A43',
+    '#C55958',
+    '#B8676D',
+    '#AA7681',
+    '#9D8496',
+    '#8F93AA')
+
+BOOK_AGE_MAX = len(BOOK_AGE_COLORS) - 1
+
+# цвета "свежести" по кол-ву дней от даты добавления книги (см. get_book_age_color)
+BOOK_AGE_DAY_COLORS = tuple(BOOK_AGE_COLORS[days // 28] for days in range(len(BOOK_AGE_COLORS) * 28))
+
+
+def get_book_age_color(nowdate, bookdate):
+    """Возвращает цвет в виде "#RRGGBB", соответствующий "свежести" книги.
+    Готовой функции, считающей в месяцах, в стандартной библиотеке нет,
+    возиться с точными вычислениями, учитывающими месяцы разной длины
+    и високосные года, а также обвешивать софтину зависимостями на
+    сторонние библиотеки мне влом, а потому "свежесть" считается
+    в четырёхнедельных промежутках от текущей даты (nowdate)."""
+
+    return get_book_age_color_days((nowdate - bookdate).days)
+
+
+def get_book_age_color_days(days):
+    """То же, что get_book_age_color, но по кол-ву дней days, прошедших
+    с добавления книги - выбор из таблицы BOOK_AGE_DAY_COLORS."""
+
+    if days < 0:
+        # нет гарантии, что в БД лежала правильная дата
+        days = 0
+    elif days >= len(BOOK_AGE_DAY_COLORS):
+        days = len(BOOK_AGE_DAY_COLORS) - 1
+
+    return BOOK_AGE_DAY_COLORS[days]
+
+
+def kilobytes_str(n):
+    return u'%gk' % round(n / 1024.0, 1)
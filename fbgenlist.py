@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  genrelist_update.py
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Импорт списка жанров (без GUI; диалог выбора файла - в fbgenlistimport)."""
+
+
+import os.path
+from gzip import open as gzip_open
+
+
+# 'lib.libgenrelist.sql.gz'
+
+
+def import_genre_list_sql(fname):
+    """Импорт списка жанров (тэгов) из SQL-файла fname.
+    Возвращает кортеж из двух элементов.
+    В случае успеха:
+    - первый элемент - словарь с жанрами,
+    - второй элемент - None.
+    В случае ошибки:
+    - первый элемент - None,
+    - второй элемент - строка с сообщением об ошибке."""
+
+    gdict = dict()
+
+    LEVEL_NONE, LEVEL_INSERT, LEVEL_LIBGEN, LEVEL_VALUES = range(4)
+
+    level = LEVEL_NONE
+
+    def clean_string(s):
+        if s.startswith('\'') or s.startswith('"'):
+            s = s[1:-1]
+        return s
+
+    # sqlparse нужен только здесь, а грузится небыстро
+    try:
+        import sqlparse
+    except ImportError:
+        return (None, u'Для импорта списка жанров требуется модуль sqlparse')
+
+    if not os.path.exists(fname):
+        return (None, u'Файл "%s" отсутствует или недоступен' % fname)
+
+    fext = os.path.splitext(fname)[1]
+
+    if fext == u'.gz':
+        file_open = gzip_open
+        file_mode = 'rt'
+    elif fext == u'.sql':
+        file_open = open
+        file_mode = 'r'
+    else:
+        return (None, u'Формат файла "%s" не поддерживается' % fname)
+
+    try:
+        with file_open(fname, file_mode, encoding='utf-8') as srcf:
+            for sr in srcf:
+                parsed = sqlparse.parse(sr)
+
+                # гавнина is beginning...
+                for stmt in parsed:
+                    if stmt.get_type() == 'INSERT':
+                        level = LEVEL_INSERT
+                        for token in stmt.tokens:
+                            if token.ttype == sqlparse.tokens.Token.Keyword:
+                                if token.value == 'VALUES':
+                                    if level == LEVEL_LIBGEN:
+                                        level = LEVEL_VALUES
+                            elif token.ttype is None:
+                                if level == LEVEL_INSERT:
+                                    if str(token.value) == '`libgenrelist`':
+                                        level = LEVEL_LIBGEN
+                                elif level == LEVEL_VALUES:
+                                    for t0 in token.tokens:
+                                        if t0.ttype is None:
+                                            l = list(map(lambda v: v.value, filter(lambda t: t.ttype != sqlparse.tokens.Token.Punctuation, t0.tokens)))[1:]
+                                            if len(l) != 3:
+                                                continue # влом полностью проверять
+                                            gdict[clean_string(l[0])] = u'%s: %s' % (clean_string(l[1]), clean_string(l[2]))
+
+                    else:
+                        level = LEVEL_NONE
+
+    except Exception as ex:
+        return (None, str(ex))
+
+    return (gdict, None)
+
+
+def main():
+    import sys
+
+    for fname in sys.argv[1:]:
+        print(import_genre_list_sql(fname))
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
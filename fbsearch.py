@@ -0,0 +1,961 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Индексы для поиска подстрок в полях книг (см. Library.search_books).
+Модуль не зависит ни от GTK, ни от flibcrutch - индексы строятся
+из простых списков строк и столбцов-массивов."""
+
+
+import sys
+import re
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from collections import OrderedDict
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    # до Python 3.11
+    import sre_parse, sre_constants
+
+
+# длина n-граммы для индекса подстрок
+TRIGRAM_LEN = 3
+
+
+# всё, что не буквы и не цифры (знаки препинания, пробелы и т.п.)
+_NON_WORD_RX = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize_text(s):
+    """Приведение строки к виду для поиска без учёта регистра и мелких
+    разночтений: регистр сворачивается (str.casefold), "ё" заменяется на "е",
+    знаки препинания и пробелы (в т.ч. подряд) - на один пробел, пробелы
+    в начале и конце отбрасываются.
+    Так приводятся и поля книг (один раз, при построении SearchIndex),
+    и образцы поиска (см. SearchPattern)."""
+
+    return _NON_WORD_RX.sub(u' ', s.casefold().replace(u'ё', u'е')).strip()
+
+
+def normalize_regex(s):
+    """Приведение регулярного выражения для поиска по нормализованным
+    строкам (см. normalize_text). Заменяется только "ё" на "е" - прочее
+    (напр. регистр) ломать выражение может, так что регистр учитывается
+    флагом re.IGNORECASE, а знаки препинания в выражении следует
+    заменять пробелами самостоятельно."""
+
+    return s.replace(u'ё', u'е').replace(u'Ё', u'Е')
+
+
+# символы, которые могут входить в литералы, извлекаемые из регулярных
+# выражений (см. regex_literals): буквы и цифры, у которых все варианты,
+# совпадающие с ними без учёта регистра, после normalize_text дают то же
+# самое (у "i" это не так - "ı" и "İ"), и знаки препинания, совпадающие
+# только сами с собой и после normalize_text становящиеся пробелами
+_LITERAL_CHARS = frozenset(u'abcdefghjklmnopqrstuvwxyzабвгдеёжзийклмнопрстуфхцчшщъыьэюя0123456789')
+_LITERAL_CHARS |= frozenset(u''.join(_LITERAL_CHARS).upper())
+_LITERAL_CHARS |= frozenset(u' \t,.;:!?-_\'"()[]/&')
+
+# литералы короче этого при отборе кандидатов не используются - толку мало
+MIN_LITERAL_LEN = 2
+
+
+def regex_literals(regex):
+    """Извлечение из скомпилированного регулярного выражения regex
+    обязательных литералов - подстрок, без которых выражение совпасть
+    не может.
+
+    Возвращает список условий; каждое условие - frozenset литералов,
+    хотя бы один из которых должен содержаться в строке, где regex
+    находится (для альтернатив "(a|b|c)" - по литералу на альтернативу).
+    Литералы нормализованы (см. normalize_text), и ищутся в нормализованных
+    строках: если regex находится в строке s (или в normalize_text(s) -
+    для выражений, подготовленных normalize_regex), normalize_text(s)
+    содержит хотя бы один литерал каждого условия.
+    Пустой список - обязательных литералов нет."""
+
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        # не должно случаться, но если парсер другой версии чем-то не доволен -
+        # просто обходимся без литералов
+        return []
+
+    return [clause for clause in _seq_literals(parsed)
+        if min(map(len, clause)) >= MIN_LITERAL_LEN]
+
+
+def _seq_literals(seq):
+    """Условия (см. regex_literals) для последовательности узлов
+    разобранного выражения seq."""
+
+    clauses = []
+    run = []
+
+    def _flush():
+        if run:
+            lit = normalize_text(u''.join(run))
+            if lit:
+                clauses.append(frozenset((lit,)))
+
+            run.clear()
+
+    for op, av in seq:
+        if op is sre_constants.LITERAL and chr(av) in _LITERAL_CHARS:
+            run.append(chr(av))
+            continue
+
+        _flush()
+
+        if op is sre_constants.SUBPATTERN:
+            clauses += _seq_literals(av[-1])
+        elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            clauses += _seq_literals(av)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                getattr(sre_constants, 'POSSESSIVE_REPEAT', None)):
+            if av[0] >= 1:
+                clauses += _seq_literals(av[2])
+        elif op is sre_constants.BRANCH:
+            # совпасть должна хоть одна альтернатива - берём от каждой
+            # по самому длинному литералу; если у какой-то литералов нет -
+            # с альтернативами ничего не выйдет
+            clause = set()
+
+            for alt in av[1]:
+                altclauses = _seq_literals(alt)
+                if not altclauses:
+                    clause = None
+                    break
+
+                clause.update(max(altclauses, key=lambda c: min(map(len, c))))
+
+            if clause:
+                clauses.append(frozenset(clause))
+
+        # прочее (якоря, классы символов, обратные ссылки, просмотр вперёд
+        # и назад и т.п.) литералов не даёт, только прерывает их
+
+    _flush()
+
+    return clauses
+
+
+class TextIndex():
+    """Индекс подстрок для списка строк (значения - строки, ключи - их
+    номера 0..N-1, напр. id автора или номер строки BookStore).
+
+    Строки хранятся нормализованными (см. normalize_text) и склеенными
+    в одну через SEPARATOR, так что простой перебор (см. scan) - это
+    str.find по всей склейке, без вызова питоньей функции на каждую
+    строку.
+
+    Если trigrams=True, строится также инвертированный индекс триграмм:
+    для каждой триграммы - возрастающий массив номеров строк, где она
+    встречается. Поиск образца длиной от TRIGRAM_LEN символов - это
+    пересечение списков самых редких его триграмм и проверка оставшихся
+    кандидатов (см. search)."""
+
+    SEPARATOR = u'\n'
+
+    # если у самой редкой триграммы образца строк больше, чем
+    # len(self) // SCAN_RATIO - проще перебрать склейку целиком
+    SCAN_RATIO = 8
+
+    # пересекаем списки не более стольких самых редких триграмм,
+    # остальное отсеивается проверкой кандидатов
+    MAX_TRIGRAMS = 4
+
+    def __init__(self, strings, trigrams=True):
+        """strings  - последовательность строк;
+        trigrams    - строить ли индекс триграмм."""
+
+        parts = [self.normalize(s) for s in strings]
+
+        self.text = self.SEPARATOR.join(parts) + self.SEPARATOR
+
+        # offsets[N] - начало строки N в self.text, последний элемент - len(self.text)
+        self.offsets = array('Q', accumulate(len(s) + 1 for s in parts))
+        self.offsets.insert(0, 0)
+
+        self.postings = None
+
+        if trigrams:
+            self.postings = {}
+
+            for ix, s in enumerate(parts):
+                for tg in {s[i:i + TRIGRAM_LEN] for i in range(len(s) - TRIGRAM_LEN + 1)}:
+                    p = self.postings.get(tg)
+                    if p is None:
+                        self.postings[tg] = p = array('i')
+
+                    p.append(ix)
+
+    def normalize(self, s):
+        """Приведение строки (и образца поиска) к виду, в котором они хранятся
+        в индексе. SEPARATOR normalize_text в любом случае заменяет пробелом."""
+
+        return normalize_text(s)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ix):
+        return self.text[self.offsets[ix]:self.offsets[ix + 1] - 1]
+
+    def scan(self, pattern):
+        """Перебор всех строк. Возвращает возрастающий список номеров строк,
+        содержащих pattern (уже нормализованный, см. normalize)."""
+
+        ret = []
+
+        text = self.text
+        offsets = self.offsets
+
+        pos = text.find(pattern)
+        while pos >= 0:
+            ix = bisect_right(offsets, pos) - 1
+            ret.append(ix)
+
+            # остаток найденной строки не смотрим
+            pos = text.find(pattern, offsets[ix + 1])
+
+        return ret
+
+    def candidates(self, pattern):
+        """Возвращает множество номеров строк, содержащих все триграммы
+        pattern (т.е. надмножество строк, содержащих pattern), или None,
+        если индекс тут не поможет (образец слишком короткий, индекса
+        триграмм нет, или триграммы образца встречаются слишком часто)."""
+
+        if self.postings is None or len(pattern) < TRIGRAM_LEN:
+            return None
+
+        lists = []
+
+        for tg in {pattern[i:i + TRIGRAM_LEN] for i in range(len(pattern) - TRIGRAM_LEN + 1)}:
+            p = self.postings.get(tg)
+            if p is None:
+                # такой триграммы нет нигде
+                return set()
+
+            lists.append(p)
+
+        lists.sort(key=len)
+
+        if len(lists[0]) > len(self) // self.SCAN_RATIO:
+            return None
+
+        ret = set(lists[0])
+        for p in lists[1:self.MAX_TRIGRAMS]:
+            ret.intersection_update(p)
+            if not ret:
+                break
+
+        return ret
+
+    def estimate(self, pattern):
+        """Оценка сверху кол-ва строк, содержащих pattern (уже нормализованный) -
+        длина списка самой редкой из его триграмм. Возвращает None, если
+        без перебора не оценить (образец слишком короткий или индекса
+        триграмм нет)."""
+
+        if self.postings is None or len(pattern) < TRIGRAM_LEN:
+            return None
+
+        return min(len(self.postings.get(pattern[i:i + TRIGRAM_LEN], ()))
+            for i in range(len(pattern) - TRIGRAM_LEN + 1))
+
+    def search_any(self, patterns):
+        """Поиск строк, содержащих хотя бы одну из подстрок patterns (уже
+        нормализованных). Подстроки, для которых есть индекс триграмм,
+        ищутся по нему, остальные - за один проход по склейке одним
+        регулярным выражением-альтернативой.
+        Возвращает множество номеров строк."""
+
+        ret = set()
+        rest = []
+
+        text = self.text
+        offsets = self.offsets
+
+        for pattern in patterns:
+            cands = self.candidates(pattern)
+
+            if cands is None:
+                rest.append(pattern)
+            else:
+                ret.update(ix for ix in cands if text.find(pattern, offsets[ix], offsets[ix + 1]) >= 0)
+
+        if len(rest) == 1:
+            ret.update(self.scan(rest[0]))
+        elif rest:
+            # сначала длинные - чтоб совпадение короткой подстроки не отменяло длинную
+            rsearch = re.compile(u'|'.join(map(re.escape, sorted(rest, key=len, reverse=True)))).search
+
+            m = rsearch(text)
+            while m:
+                ix = bisect_right(offsets, m.start()) - 1
+                ret.add(ix)
+
+                # остаток найденной строки не смотрим
+                m = rsearch(text, offsets[ix + 1])
+
+        return ret
+
+    def search(self, pattern):
+        """Поиск подстроки pattern (уже нормализованной). Возвращает
+        возрастающий список номеров строк, содержащих pattern."""
+
+        cands = self.candidates(pattern)
+        if cands is None:
+            return self.scan(pattern)
+
+        text = self.text
+        offsets = self.offsets
+
+        return [ix for ix in sorted(cands) if text.find(pattern, offsets[ix], offsets[ix + 1]) >= 0]
+
+    def search_regex(self, regex, candidates=None):
+        """Поиск по скомпилированному регулярному выражению regex
+        (см. normalize_regex). candidates - None или множество номеров
+        строк, которые только и надо проверить (см. search_any).
+        Возвращает возрастающий список номеров строк, где regex нашлось."""
+
+        text = self.text
+        offsets = self.offsets
+        rsearch = regex.search
+
+        # именно срезы, а не regex.search(text, pos, endpos) - иначе "^"
+        # и просмотр назад вели бы себя не так, как на отдельной строке
+        return [ix for ix in (range(len(offsets) - 1) if candidates is None else sorted(candidates))
+            if rsearch(text[offsets[ix]:offsets[ix + 1] - 1])]
+
+
+class RowGroups():
+    """Номера строк хранилища книг, сгруппированные по значению столбца
+    (напр. id автора или id серии): номера строк с ключом K - это
+    rows[starts[K]:starts[K + 1]], по возрастанию."""
+
+    def __init__(self, keys, nkeys):
+        """keys - столбец (массив целых 0..nkeys-1), nkeys - кол-во ключей."""
+
+        # sorted() устойчива, потому внутри группы номера строк возрастают
+        self.rows = array('i', sorted(range(len(keys)), key=keys.__getitem__))
+
+        counts = [0] * (nkeys + 1)
+        for k in keys:
+            counts[k + 1] += 1
+
+        self.starts = array('i', accumulate(counts))
+
+    def __getitem__(self, key):
+        return self.rows[self.starts[key]:self.starts[key + 1]]
+
+
+def rows_to_bitmap(rows, nbits):
+    """Возвращает битовую маску (int), в которой установлены биты с номерами
+    из последовательности rows (номера - 0..nbits-1)."""
+
+    buf = bytearray((nbits + 7) // 8)
+
+    for row in rows:
+        buf[row >> 3] |= 1 << (row & 7)
+
+    return int.from_bytes(buf, 'little')
+
+
+def bitmap_to_rows(mask):
+    """Возвращает возрастающий список номеров установленных битов маски mask."""
+
+    # двоичная запись задом наперёд - номер символа равен номеру бита;
+    # единицы ищутся str.find, а не перебором битов
+    bits = bin(mask)[:1:-1]
+
+    ret = []
+
+    pos = bits.find('1')
+    while pos >= 0:
+        ret.append(pos)
+        pos = bits.find('1', pos + 1)
+
+    return ret
+
+
+def bitmap_count(mask):
+    """Возвращает кол-во установленных битов маски mask."""
+
+    return bin(mask).count('1')
+
+
+class TagBitmaps():
+    """Битовые маски книг по тэгам (жанрам): в маске тэга установлен бит N,
+    если у книги в строке N хранилища есть этот тэг. Маски - питоньи int,
+    так что объединение, пересечение и вычитание отборов по тэгам - это
+    OR, AND и AND NOT длинных целых (на C), а не перебор множеств."""
+
+    def __init__(self, tagsetids, tagsets, ntags):
+        """tagsetids - столбец id наборов тэгов (по строке на книгу);
+        tagsets - список наборов тэгов (индексы - id, значения - множества
+            id тэгов);
+        ntags - кол-во тэгов."""
+
+        self.nrows = len(tagsetids)
+
+        # строки книг собираются по наборам тэгов - наборов намного меньше,
+        # чем книг, и каждая книга попадает в маски всех тэгов своего набора
+        setrows = RowGroups(tagsetids, len(tagsets))
+        tagrows = [array('i') for i in range(ntags)]
+
+        for setid, tags in enumerate(tagsets):
+            rows = setrows[setid]
+
+            for tid in tags:
+                tagrows[tid].extend(rows)
+
+        self.masks = [rows_to_bitmap(rows, self.nrows) for rows in tagrows]
+
+        # все книги
+        self.allmask = (1 << self.nrows) - 1
+
+    def mask(self, tid):
+        """Возвращает маску тэга tid (у тэгов, которых ни у одной книги
+        нет, в т.ч. добавленных после построения масок - пустую)."""
+
+        return self.masks[tid] if 0 <= tid < len(self.masks) else 0
+
+    def select(self, include=(), exclude=(), matchall=False):
+        """Возвращает маску книг, у которых есть любой (если matchall=False)
+        или все (если matchall=True) тэги из include (если include пуст -
+        все книги), и нет ни одного тэга из exclude."""
+
+        if not include:
+            ret = self.allmask
+        elif matchall:
+            ret = self.allmask
+            for tid in include:
+                ret &= self.mask(tid)
+        else:
+            ret = 0
+            for tid in include:
+                ret |= self.mask(tid)
+
+        for tid in exclude:
+            ret &= ~self.mask(tid)
+
+        return ret
+
+
+# транслитерация для нечёткого сравнения имён (см. translit_key): кириллица -
+# латиницей, а буквы, которые в разных транслитерациях пишутся по-разному,
+# сводятся к одной (й, ы, y, j - i; я - ia, ю - iu; w - v и т.п.)
+_TRANSLIT = str.maketrans({u'а':u'a', u'б':u'b', u'в':u'v', u'г':u'g', u'д':u'd',
+    u'е':u'e', u'ж':u'zh', u'з':u'z', u'и':u'i', u'й':u'i', u'к':u'k', u'л':u'l',
+    u'м':u'm', u'н':u'n', u'о':u'o', u'п':u'p', u'р':u'r', u'с':u's', u'т':u't',
+    u'у':u'u', u'ф':u'f', u'х':u'h', u'ц':u'ts', u'ч':u'ch', u'ш':u'sh', u'щ':u'sch',
+    u'ъ':u'', u'ы':u'i', u'ь':u'', u'э':u'e', u'ю':u'iu', u'я':u'ia',
+    u'y':u'i', u'j':u'i', u'w':u'v', u'q':u'k', u'x':u'ks'})
+
+# сочетания букв латиницы, заменяемые после транслитерации
+_TRANSLIT_FOLD = ((u'kh', u'h'), (u'ph', u'f'), (u'ck', u'k'))
+
+# наибольшее расстояние редактирования при нечётком поиске имён
+FUZZY_MAX_DIST = 2
+
+
+def translit_key(s):
+    """Ключ для нечёткого сравнения имён: нормализованная (см. normalize_text)
+    строка, в которой кириллица заменена латиницей, а разные варианты
+    транслитерации сведены к одному. Напр. у "Фёдор Достоевский"
+    и "Fyodor Dostoyevsky" ключи отличаются двумя буквами."""
+
+    s = normalize_text(s).translate(_TRANSLIT)
+
+    for old, new in _TRANSLIT_FOLD:
+        s = s.replace(old, new)
+
+    return s
+
+
+def edit_distance(a, b):
+    """Расстояние Левенштейна между строками a и b (кол-во вставок,
+    удалений и замен символов).
+    Считается битово-параллельным алгоритмом Майерса (в варианте Хюрё):
+    столбец таблицы расстояний - биты целого числа, так что на символ b
+    приходится десяток операций с int, а не цикл по символам a."""
+
+    m = len(a)
+    if not m:
+        return len(b)
+
+    peq = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << m) - 1
+    hibit = 1 << (m - 1)
+
+    vp = mask
+    vn = 0
+    dist = m
+
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | vn
+        xh = (((eq & vp) + vp) ^ vp) | eq
+        hp = vn | ~(xh | vp)
+        hn = vp & xh
+
+        if hp & hibit:
+            dist += 1
+        elif hn & hibit:
+            dist -= 1
+
+        hp = ((hp << 1) | 1) & mask
+        hn = (hn << 1) & mask
+        vp = hn | ~(xv | hp)
+        vn = hp & xv
+
+    return dist
+
+
+def fuzzy_max_distance(key):
+    """Допустимое расстояние редактирования для ключа образца key (см.
+    translit_key): для коротких образцов меньше, иначе подходит что попало."""
+
+    n = len(key)
+
+    return min(FUZZY_MAX_DIST, 0 if n < 3 else 1 if n < 6 else 2)
+
+
+def name_keys(name):
+    """Ключи имени name для нечёткого сравнения (см. name_distance): кортеж
+    кортежей слов ключей (см. translit_key) имён соавторов (в name -
+    через запятую); первое слово - фамилия."""
+
+    return tuple(words for words in (tuple(translit_key(part).split()) for part in name.split(u',')) if words)
+
+
+def name_distance(qwords, keys, maxdist):
+    """Расстояние от образца до имени для нечёткого поиска, или None,
+    если оно больше maxdist.
+    qwords  - кортеж слов ключа образца (см. translit_key),
+    keys    - ключи имени (см. name_keys).
+    Имя подходит, если у одного из соавторов фамилия не дальше maxdist
+    от первого слова образца, и - если в образце больше одного слова -
+    ключ образца не дальше maxdist от стольких же первых слов имени
+    соавтора, полностью или с инициалами вместо имени и отчества
+    (т.е. "Иванов И. И." подходит к "Иванов Иван Иванович")."""
+
+    ret = None
+    qkey = u' '.join(qwords)
+    nwords = len(qwords)
+
+    for words in keys:
+        dist = edit_distance(qwords[0], words[0])
+        if dist > maxdist:
+            continue
+
+        if nwords > 1:
+            dist = min(edit_distance(qkey, u' '.join(words[:nwords])),
+                edit_distance(qkey, u' '.join((words[0],) + tuple(w[0] for w in words[1:nwords]))))
+
+            if dist > maxdist:
+                continue
+
+        if ret is None or dist < ret:
+            ret = dist
+
+    return ret
+
+
+class BKTree():
+    """Дерево Буркхарда-Келлера - метрический индекс строк для поиска всех
+    строк, не дальше заданного расстояния (см. edit_distance) от образца,
+    без сравнения образца с каждой строкой: у потомков узла, отстоящих
+    от него на d, расстояние до образца (по неравенству треугольника) -
+    не меньше |d - расстояние от образца до узла|, так что проверяются
+    только ветви с подходящими d."""
+
+    def __init__(self, keys=()):
+        self.root = None # (строка, словарь потомков - ключи - расстояния)
+        self.size = 0
+
+        for key in keys:
+            self.add(key)
+
+    def add(self, key):
+        if self.root is None:
+            self.root = (key, {})
+            self.size = 1
+            return
+
+        node = self.root
+
+        while True:
+            dist = edit_distance(key, node[0])
+            if dist == 0:
+                return # уже есть
+
+            child = node[1].get(dist)
+            if child is None:
+                node[1][dist] = (key, {})
+                self.size += 1
+                return
+
+            node = child
+
+    def __len__(self):
+        return self.size
+
+    def search(self, key, maxdist):
+        """Возвращает список кортежей (расстояние, строка) для строк,
+        не дальше maxdist от key."""
+
+        ret = []
+
+        if self.root is None:
+            return ret
+
+        stack = [self.root]
+
+        while stack:
+            nodekey, children = stack.pop()
+
+            dist = edit_distance(key, nodekey)
+            if dist <= maxdist:
+                ret.append((dist, nodekey))
+
+            for cdist, child in children.items():
+                if dist - maxdist <= cdist <= dist + maxdist:
+                    stack.append(child)
+
+        return ret
+
+
+class FuzzyNameIndex():
+    """Индекс для нечёткого поиска имён (напр. авторов): ключи имён
+    (см. name_keys) и BKTree их фамилий. Разные имена с одной
+    фамилией в дереве - один узел, так что дерево намного меньше
+    списка имён."""
+
+    def __init__(self, names):
+        """names - последовательность имён (индексы - id)."""
+
+        self.keys = list(map(name_keys, names))
+
+        # ключи - фамилии, значения - id имён
+        self.surnames = {}
+        for ix, keys in enumerate(self.keys):
+            for words in keys:
+                self.surnames.setdefault(words[0], []).append(ix)
+
+        self.tree = BKTree(self.surnames)
+
+    def search(self, key, maxdist=None, limit=None):
+        """Поиск имён, подходящих к образцу с ключом key (см. translit_key,
+        name_distance).
+        maxdist - наибольшее расстояние, None - по длине ключа (см.
+                  fuzzy_max_distance);
+        limit   - None или наибольшее кол-во возвращаемых имён.
+        Возвращает список кортежей (расстояние, id) по возрастанию расстояния."""
+
+        qwords = tuple(key.split())
+        if not qwords:
+            return []
+
+        if maxdist is None:
+            maxdist = fuzzy_max_distance(key)
+
+        found = []
+        seen = set()
+
+        for dist, surname in self.tree.search(qwords[0], maxdist):
+            for ix in self.surnames[surname]:
+                if ix in seen:
+                    continue
+
+                seen.add(ix)
+
+                dist = name_distance(qwords, self.keys[ix], maxdist)
+                if dist is not None:
+                    found.append((dist, ix))
+
+        found.sort()
+
+        return found[:limit] if limit is not None else found
+
+
+class SearchIndex():
+    """Нормализованные (см. normalize_text) копии полей книг, по которым
+    ищет главное окно, с индексами подстрок.
+
+    Имена авторов и названия серий индексируются по id (их намного
+    меньше, чем книг), найденные id переводятся в номера строк
+    хранилища книг через RowGroups; названия и имена файлов
+    индексируются по номерам строк.
+
+    Индекс строится по сжатому хранилищу (см. BookStore.compact) и после
+    любого изменения хранилища недействителен."""
+
+    FIELDS = ('author', 'title', 'series', 'filename')
+
+    def __init__(self, authornames, seriesnames, authorids, seriesids, titles, filenames, dates,
+            tagsetids, tagsets, ntags, trigrams=True):
+        """authornames, seriesnames - списки имён авторов и названий серий
+            (индексы - id);
+        authorids, seriesids - столбцы id автора и серии (по строке на книгу);
+        titles, filenames - последовательности названий и имён файлов
+            (по строке на книгу);
+        dates - столбец дат (порядковых номеров дней) - для отбора книг
+            за период (см. date_rows);
+        tagsetids, tagsets, ntags - наборы тэгов книг (см. TagBitmaps);
+        trigrams - строить ли индексы триграмм (см. TextIndex); без них
+            поиск подстроки - перебор нормализованных строк."""
+
+        self.nrows = len(authorids)
+
+        # номера строк, отсортированные по дате (при равных датах - по номеру
+        # строки), и даты в том же порядке - для отбора за период bisect'ом
+        self.daterows = array('i', sorted(range(self.nrows), key=dates.__getitem__))
+        self.sorteddates = array('i', map(dates.__getitem__, self.daterows))
+
+        # те же массивы, что и в BookStore - для проверки отдельных строк (см. row_matcher)
+        self.authorids = authorids
+        self.seriesids = seriesids
+
+        self.author = TextIndex(authornames, trigrams)
+        self.series = TextIndex(seriesnames, trigrams)
+        self.title = TextIndex(titles, trigrams)
+        self.filename = TextIndex(filenames, trigrams)
+
+        self.authorrows = RowGroups(authorids, len(self.author))
+        self.seriesrows = RowGroups(seriesids, len(self.series))
+
+        self.tags = TagBitmaps(tagsetids, tagsets, ntags)
+
+    def estimate(self, fldname, pattern):
+        """Оценка кол-ва книг, у которых поле fldname содержит подстроку
+        pattern (см. TextIndex.estimate), или None, если её не получить
+        без поиска. Для авторов и серий - исходя из среднего кол-ва книг
+        на автора (серию)."""
+
+        index = getattr(self, fldname)
+
+        n = index.estimate(index.normalize(pattern))
+
+        if n is not None and fldname in ('author', 'series'):
+            n = min(self.nrows, n * self.nrows // max(len(index), 1))
+
+        return n
+
+    def count_dates(self, minord, maxord):
+        """Возвращает кол-во книг с датой (порядковым номером дня) в диапазоне
+        minord..maxord включительно."""
+
+        return max(0, bisect_right(self.sorteddates, maxord) - bisect_left(self.sorteddates, minord))
+
+    def date_rows(self, minord, maxord):
+        """Возвращает array номеров строк хранилища книг с датой в диапазоне
+        minord..maxord включительно, отсортированных по дате (от старых
+        к новым)."""
+
+        return self.daterows[bisect_left(self.sorteddates, minord):bisect_right(self.sorteddates, maxord)]
+
+    def match_rows(self, fldname, pattern):
+        """Возвращает множество номеров строк хранилища книг, у которых
+        поле fldname (из FIELDS) содержит подстроку pattern (сравниваются
+        нормализованные строки, см. normalize_text)."""
+
+        index = getattr(self, fldname)
+
+        return self.__found_to_rows(fldname, index.search(index.normalize(pattern)))
+
+    def estimate_literals(self, fldname, clauses):
+        """Оценка кол-ва книг, у которых поле fldname содержит литералы
+        clauses (см. regex_literals), или None, если её не получить
+        без поиска."""
+
+        ret = None
+
+        for clause in clauses:
+            n = 0
+            for lit in clause:
+                e = self.estimate(fldname, lit)
+                if e is None:
+                    break
+
+                n += e
+            else:
+                ret = min(n, self.nrows) if ret is None else min(n, ret)
+
+        return ret
+
+    def literal_candidates(self, fldname, clauses):
+        """Возвращает множество номеров строк индекса поля fldname (т.е.
+        id для авторов и серий, номеров строк книг для прочих полей),
+        содержащих литералы clauses (см. regex_literals)."""
+
+        index = getattr(self, fldname)
+        ret = None
+
+        for clause in sorted(clauses, key=lambda c: -min(map(len, c))):
+            found = index.search_any(clause)
+            ret = found if ret is None else ret & found
+
+            if not ret:
+                break
+
+        return ret
+
+    def match_rows_regex(self, fldname, regex, clauses=None):
+        """Возвращает множество номеров строк хранилища книг, у которых
+        в нормализованном поле fldname нашлось регулярное выражение regex
+        (см. normalize_regex). Для авторов и серий выражение проверяется
+        по разу на каждое имя, а не на каждую книгу.
+        clauses - None или литералы regex (см. regex_literals) - тогда
+        выражение проверяется только там, где они есть."""
+
+        index = getattr(self, fldname)
+
+        return self.__found_to_rows(fldname,
+            index.search_regex(regex, self.literal_candidates(fldname, clauses) if clauses else None))
+
+    def match_rows_literals(self, fldname, clauses, keytest):
+        """Возвращает множество номеров строк хранилища книг, у которых
+        нормализованное поле fldname содержит литералы clauses (см.
+        regex_literals), и для которых keytest(key) вернула True, где key -
+        id автора или серии или номер строки книги (для прочих полей).
+        Для поиска регулярного выражения в исходных (ненормализованных)
+        полях: keytest проверяет выражение только у кандидатов."""
+
+        return self.__found_to_rows(fldname,
+            filter(keytest, sorted(self.literal_candidates(fldname, clauses))))
+
+    def row_matcher(self, fldname, pattern=None, regex=None):
+        """Возвращает функцию, получающую номер строки хранилища книг
+        и возвращающую True, если нормализованное поле fldname этой книги
+        содержит подстроку pattern (если regex=None) или в нём находится
+        регулярное выражение regex. Для проверки небольшого кол-ва книг
+        (напр. при уточнении поиска) - без просмотра всего индекса."""
+
+        index = getattr(self, fldname)
+
+        if regex is not None:
+            rsearch = regex.search
+            test = lambda s: rsearch(s) is not None
+        else:
+            pattern = index.normalize(pattern)
+            test = lambda s: pattern in s
+
+        if fldname == 'author':
+            ids = self.authorids
+            return lambda row: test(index[ids[row]])
+        elif fldname == 'series':
+            ids = self.seriesids
+            return lambda row: test(index[ids[row]])
+        else:
+            return lambda row: test(index[row])
+
+    def __found_to_rows(self, fldname, found):
+        if fldname == 'author':
+            groups = self.authorrows
+        elif fldname == 'series':
+            groups = self.seriesrows
+        else:
+            return set(found)
+
+        rows = set()
+        for ix in found:
+            rows.update(groups[ix])
+
+        return rows
+
+
+class LRUCache():
+    """Кэш ограниченного размера; при переполнении выкидывается то,
+    что дольше всего не использовалось (LRU). Потокобезопасный.
+
+    maxitems    - макс. кол-во элементов; 0 - кэш выключен;
+    sizefunc    - функция, возвращающая размер значения в байтах
+                  (только для статистики, см. stats)."""
+
+    def __init__(self, maxitems, sizefunc=sys.getsizeof):
+        self.maxitems = maxitems
+        self.sizefunc = sizefunc
+
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, defval=None):
+        with self.lock:
+            value = self.items.get(key, None)
+
+            if value is None:
+                self.misses += 1
+                return defval
+
+            self.hits += 1
+            self.items.move_to_end(key)
+
+            return value
+
+    def put(self, key, value):
+        """Добавление значения (не None) по ключу key."""
+
+        with self.lock:
+            if self.maxitems <= 0:
+                return
+
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.nbytes -= self.sizefunc(old)
+
+            self.items[key] = value
+            self.nbytes += self.sizefunc(value)
+
+            while len(self.items) > self.maxitems:
+                self.nbytes -= self.sizefunc(self.items.popitem(False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Возвращает словарь со статистикой: hits, misses - кол-во
+        попаданий и промахов, hitrate - доля попаданий (0.0-1.0),
+        items, maxitems - кол-во элементов, bytes - размер значений."""
+
+        with self.lock:
+            total = self.hits + self.misses
+
+            return {'hits':self.hits, 'misses':self.misses,
+                'hitrate':self.hits / total if total else 0.0,
+                'items':len(self.items), 'maxitems':self.maxitems,
+                'bytes':self.nbytes}
@@ -113,8 +113,6 @@ class TagNameEditor(SettingsEditor):
         self.library = library
         # аналогично library.genrenames
         self.tmpgenrenames = {}
-        # аналогично library.tags
-        self.tmptags = {}
 
         # значение тэга, строка тэга, отображаемая строка тэга
         self.listview, self.liststore, scrollwnd, renderers = create_listview((Pixbuf, GObject.TYPE_INT64, GObject.TYPE_STRING, GObject.TYPE_STRING),
@@ -184,7 +182,6 @@ class TagNameEditor(SettingsEditor):
 
     def validate_data(self):
         self.tmpgenrenames.clear()
-        self.tmptags.clear()
 
         errtags = []
         erritrs = []
@@ -200,7 +197,6 @@ class TagNameEditor(SettingsEditor):
                 errtags.append(tagname)
                 erritrs.append(itr)
 
-            self.tmptags[tagid] = tagname
             self.tmpgenrenames[tagid] = dispname
 
             itr = self.liststore.iter_next(itr)
@@ -216,9 +212,7 @@ class TagNameEditor(SettingsEditor):
     def get_data(self):
         self.library.genrenames.clear()
         self.library.genrenames.update(self.tmpgenrenames)
-
-        self.library.tags.clear()
-        self.library.tags.update(self.tmptags)
+        self.library.genre_names_changed()
 
     def import_genre_names(self):
         tagdict = import_genre_list(self.parentwnd)
@@ -253,7 +247,9 @@ class TagNameEditor(SettingsEditor):
 
             for tagname in tagdict:
                 dispname = tagdict[tagname]
-                tagid = hash(tagname)
+                # новые тэги сразу попадают в пул library.tags - на книги они
+                # не ссылаются, потому от отмены диалога ничего не сломается
+                tagid = self.library.tags.intern(tagname)
 
                 if dispname:
                     icon = self.iconOk
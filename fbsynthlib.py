@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This file is part of Flibrowser.
+
+    Flibrowser is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Flibrowser is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Flibrowser.  If not, see <http://www.gnu.org/licenses/>."""
+
+
+"""Генератор синтетических библиотек (индекс .inpx и архивы с книгами)
+произвольного размера - для замеров скорости (см. fbbench) и отладки
+на объёмах, сравнимых с Флибустой, чего fbfakelib не умеет.
+
+Распределения подобраны "на глаз" по живому индексу Флибусты:
+у немногих авторов и жанров - много книг, у большинства - по чуть-чуть
+(закон Ципфа), около трети книг входит в серии, книги бывают
+написаны группами авторов, часть записей - удаления (DEL=1)
+и переиздания книг, описанных в более ранних файлах .inp."""
+
+
+import os, os.path, sys
+import zipfile
+import random
+import datetime
+from bisect import bisect_left
+from itertools import accumulate
+
+from flibcrutch import INPX_REC_SEPARATOR, INPX_INDEX_ENCODING
+
+
+RU_SURNAME_ROOTS = (u'Иван', u'Петр', u'Сидор', u'Кузнец', u'Смирн', u'Попов', u'Волк',
+    u'Лебед', u'Соколь', u'Козл', u'Новик', u'Морозов', u'Зайц', u'Павл', u'Семён',
+    u'Голуб', u'Виноград', u'Богдан', u'Ворон', u'Федор', u'Михайл', u'Белоус',
+    u'Тарас', u'Беляк', u'Комар', u'Орл', u'Ёлкин', u'Щукин', u'Жук', u'Громык',
+    u'Стругацк', u'Лукьяненк', u'Пелевин', u'Булычёв', u'Ефрем', u'Белянин')
+
+RU_SURNAME_SUFFIXES = (u'ов', u'ев', u'ин', u'ский', u'о', u'ых', u'енко', u'ович', u'')
+
+RU_FIRST_NAMES = (u'Александр', u'Алексей', u'Андрей', u'Анна', u'Борис', u'Валентина',
+    u'Василий', u'Виктор', u'Владимир', u'Вячеслав', u'Галина', u'Дмитрий', u'Евгений',
+    u'Екатерина', u'Елена', u'Иван', u'Игорь', u'Кир', u'Лев', u'Мария', u'Михаил',
+    u'Наталья', u'Николай', u'Ольга', u'Павел', u'Пётр', u'Сергей', u'Татьяна',
+    u'Фёдор', u'Юлия', u'Юрий', u'Яна')
+
+RU_PATRONYMICS = (u'Александрович', u'Алексеевич', u'Борисович', u'Викторович',
+    u'Владимирович', u'Иванович', u'Михайлович', u'Николаевич', u'Петрович',
+    u'Сергеевна', u'Ивановна', u'Фёдоровна', u'Юрьевич', u'')
+
+EN_SURNAMES = (u'Smith', u'Johnson', u'Williams', u'Brown', u'Jones', u'Miller', u'Davis',
+    u'Wilson', u'Anderson', u'Taylor', u'Moore', u'Martin', u'Thompson', u'White',
+    u'Harris', u'Clarke', u'Lewis', u'Walker', u'Hall', u'Young', u'King', u'Wright',
+    u'Simmons', u'Asimov', u'Heinlein', u'Bradbury', u'Pratchett', u'Gaiman')
+
+EN_FIRST_NAMES = (u'John', u'Mary', u'James', u'Patricia', u'Robert', u'Jennifer', u'Michael',
+    u'Linda', u'William', u'Elizabeth', u'David', u'Susan', u'Richard', u'Jessica',
+    u'Joseph', u'Sarah', u'Thomas', u'Karen', u'Dan', u'Neil', u'Terry', u'Ray', u'Isaac')
+
+RU_WORDS = (u'тайна', u'последний', u'звезда', u'ночь', u'дорога', u'война', u'мир', u'ёж',
+    u'тень', u'город', u'песня', u'чёрный', u'белая', u'ветер', u'море', u'дом', u'время',
+    u'колдун', u'империя', u'страж', u'лес', u'крепость', u'огонь', u'зеркало', u'сердце',
+    u'путь', u'клинок', u'охота', u'замок', u'любовь', u'ёлка', u'дракон', u'король',
+    u'улица', u'полёт', u'пепел', u'хроники', u'наследник', u'вечность', u'берег')
+
+EN_WORDS = (u'secret', u'last', u'star', u'night', u'road', u'war', u'peace', u'shadow',
+    u'city', u'song', u'black', u'white', u'wind', u'sea', u'house', u'time', u'wizard',
+    u'empire', u'guard', u'forest', u'fortress', u'fire', u'mirror', u'heart', u'path',
+    u'blade', u'hunt', u'castle', u'love', u'dragon', u'king', u'street', u'flight')
+
+# коды жанров fb2 - в порядке убывания популярности
+GENRES = ('sf_fantasy', 'love_contemporary', 'det_irony', 'sf', 'prose_contemporary',
+    'sf_action', 'detective', 'love_sf', 'sf_humor', 'det_action', 'sci_history',
+    'child_tale', 'prose_history', 'adv_history', 'nonf_biography', 'sf_history',
+    'thriller', 'love_history', 'sf_space', 'det_classic', 'poetry', 'sci_psychology',
+    'prose_classic', 'sf_horror', 'child_prose', 'sf_cyberpunk', 'humor_prose',
+    'sci_philosophy', 'religion', 'adv_animal', 'antique', 'home_cooking', 'comp_programming',
+    'reference', 'dramaturgy', 'sf_postapocalyptic', 'det_espionage', 'love_erotica')
+
+# языки и их доли; заглавные - потому что в живом индексе встречается и такое
+LANGUAGES = (('ru', 820), ('en', 70), ('uk', 45), ('de', 15), ('be', 10), ('fr', 10),
+    ('RU', 8), ('pl', 6), ('es', 5), ('it', 4), ('bg', 3), ('ja', 2), ('', 2))
+
+# форматы файлов и их доли
+FORMATS = (('fb2', 950), ('pdf', 20), ('djvu', 12), ('epub', 8), ('doc', 5), ('txt', 5))
+
+FIRST_DATE = datetime.date(2007, 11, 1).toordinal()
+LAST_DATE = datetime.date(2018, 6, 30).toordinal()
+
+
+class WeightedChoice():
+    """Случайный выбор из последовательности values с весами weights
+    (быстрее random.choices на больших объёмах, т.к. накопленные веса
+    считаются один раз)."""
+
+    def __init__(self, rnd, values, weights):
+        self.rnd = rnd
+        self.values = values
+        self.cumweights = list(accumulate(weights))
+        self.total = self.cumweights[-1]
+
+    def __call__(self):
+        return self.values[bisect_left(self.cumweights, self.rnd.random() * self.total)]
+
+
+def zipf_weights(n, s=1.0):
+    """Веса по закону Ципфа для n элементов (первые - самые частые)."""
+
+    return [1.0 / (k ** s) for k in range(1, n + 1)]
+
+
+class SyntheticLibrary():
+    """Генератор синтетической библиотеки.
+
+    nbooks      - кол-во книг (без учёта записей об удалении и переизданиях);
+    seed        - затравка генератора случайных чисел; при равных
+                  параметрах генерируется одна и та же библиотека;
+    bundlesize  - кол-во книг в архиве (и, соответственно, в файле .inp);
+    delrate     - доля записей об удалении книг из более ранних архивов;
+    updrate     - доля записей о переизданиях (книга из более раннего архива
+                  описывается заново, с новыми названием и датой);
+    grouprate   - доля книг, написанных группами авторов."""
+
+    def __init__(self, nbooks, seed=1, bundlesize=1000, delrate=0.03, updrate=0.02, grouprate=0.05):
+        self.nbooks = nbooks
+        self.seed = seed
+        self.bundlesize = bundlesize
+        self.delrate = delrate
+        self.updrate = updrate
+        self.grouprate = grouprate
+
+        self.rnd = random.Random(seed)
+
+        rnd = self.rnd
+
+        # авторы: примерно по пять книг на автора в среднем, но по Ципфу
+        nauthors = max(10, nbooks // 5)
+        self.authors = [self.__make_author_name() for i in range(nauthors)]
+        self.random_author = WeightedChoice(rnd, self.authors, zipf_weights(nauthors, 0.9))
+
+        # серии: около трети книг, в среднем по 8 книг на серию
+        nseries = max(5, nbooks // 25)
+        self.series = [self.__make_title(2) for i in range(nseries)]
+        self.random_series = WeightedChoice(rnd, range(nseries), zipf_weights(nseries, 0.8))
+        self.sernos = {}
+
+        self.random_genre = WeightedChoice(rnd, GENRES, zipf_weights(len(GENRES), 1.1))
+        self.random_lang = WeightedChoice(rnd, *zip(*LANGUAGES))
+        self.random_format = WeightedChoice(rnd, *zip(*FORMATS))
+
+    def __make_author_name(self):
+        """Возвращает имя автора в формате индекса: "Фамилия,Имя,Отчество:"."""
+
+        rnd = self.rnd
+
+        if rnd.random() < 0.85:
+            name = (rnd.choice(RU_SURNAME_ROOTS) + rnd.choice(RU_SURNAME_SUFFIXES),
+                rnd.choice(RU_FIRST_NAMES), rnd.choice(RU_PATRONYMICS))
+        else:
+            name = (rnd.choice(EN_SURNAMES), rnd.choice(EN_FIRST_NAMES), u'')
+
+        return u'%s:' % u','.join(name)
+
+    def __make_title(self, maxwords=5):
+        rnd = self.rnd
+        words = RU_WORDS if rnd.random() < 0.9 else EN_WORDS
+
+        title = u' '.join(rnd.choice(words) for i in range(rnd.randint(1, maxwords)))
+
+        if rnd.random() < 0.1:
+            title = u'%s %d' % (title, rnd.randint(1, 20))
+
+        return title[0].upper() + title[1:]
+
+    def __book_date(self, bookid):
+        """Дата добавления книги - растёт с bookid, с небольшим разбросом."""
+
+        d = FIRST_DATE + (LAST_DATE - FIRST_DATE) * bookid // (self.nbooks + 1) + self.rnd.randint(-3, 3)
+
+        return datetime.date.fromordinal(max(FIRST_DATE, min(LAST_DATE, d))).isoformat()
+
+    def __book_record(self, bookid):
+        """Возвращает кортеж (запись индекса, имя файла книги)."""
+
+        rnd = self.rnd
+
+        if rnd.random() < self.grouprate:
+            author = u''.join(self.random_author() for i in range(rnd.randint(2, 3)))
+        else:
+            author = self.random_author()
+
+        genres = set(self.random_genre() for i in range(rnd.randint(1, 3)))
+
+        if rnd.random() < 0.33:
+            serid = self.random_series()
+            series = self.series[serid]
+            serno = self.sernos.get(serid, 0) + 1
+            self.sernos[serid] = serno
+            serno = str(serno)
+        else:
+            series = u''
+            serno = u''
+
+        ext = self.random_format()
+        fsize = int(rnd.lognormvariate(12.5, 1.0))
+
+        # небольшая доля книг удаляется сразу же
+        isdel = u'1' if rnd.random() < 0.01 else u''
+
+        fields = (author, u'%s:' % u':'.join(sorted(genres)), self.__make_title(), series, serno,
+            str(bookid), str(fsize), str(bookid), isdel, ext, self.__book_date(bookid),
+            self.random_lang(), u'')
+
+        return (INPX_REC_SEPARATOR.join(fields) + INPX_REC_SEPARATOR, u'%d.%s' % (bookid, ext))
+
+    def __deleted_record(self, bookid):
+        return INPX_REC_SEPARATOR.join((u'', u'', u'', u'', u'', str(bookid), u'0', str(bookid),
+            u'1', u'fb2', self.__book_date(bookid), u'ru', u'')) + INPX_REC_SEPARATOR
+
+    def generate_bundles(self):
+        """Генератор, возвращающий для каждого архива библиотеки кортеж
+        (имя архива без расширения, список записей индекса, список имён файлов книг)."""
+
+        rnd = self.rnd
+
+        for first in range(1, self.nbooks + 1, self.bundlesize):
+            last = min(first + self.bundlesize - 1, self.nbooks)
+
+            records = []
+            fnames = []
+
+            for bookid in range(first, last + 1):
+                rec, fname = self.__book_record(bookid)
+                records.append(rec)
+                fnames.append(fname)
+
+                # удаления и переиздания книг из предыдущих архивов
+                if first > 1:
+                    r = rnd.random()
+
+                    if r < self.delrate:
+                        records.append(self.__deleted_record(rnd.randint(1, first - 1)))
+                    elif r < self.delrate + self.updrate:
+                        rec, fname = self.__book_record(rnd.randint(1, first - 1))
+                        records.append(rec)
+                        fnames.append(fname)
+
+            yield (u'fb2-%06d-%06d' % (first, last), records, fnames)
+
+    def write(self, destdir, indexname=u'library.inpx', bundles=True, callback=None):
+        """Запись библиотеки в каталог destdir: индекс indexname и,
+        если bundles == True, архивы с (фиктивными) файлами книг.
+        callback(fraction) - (если не None) функция для отображения прогресса.
+        Возвращает полный путь к файлу индекса."""
+
+        if not os.path.exists(destdir):
+            os.makedirs(destdir)
+
+        indexpath = os.path.join(destdir, indexname)
+        nbundles = (self.nbooks + self.bundlesize - 1) // self.bundlesize
+
+        with zipfile.ZipFile(indexpath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zindex:
+            zindex.writestr(u'collection.info', u'Synthetic library\r\nsynthetic\r\n65536\r\n' \
+                u'Сгенерировано fbsynthlib: %d книг, seed=%d\r\n' % (self.nbooks, self.seed))
+            zindex.writestr(u'version.info', u'%s\r\n' % datetime.date.today().strftime('%Y%m%d'))
+
+            for ixbundle, (bundle, records, fnames) in enumerate(self.generate_bundles()):
+                zindex.writestr(bundle + u'.inp',
+                    (u'\r\n'.join(records) + u'\r\n').encode(INPX_INDEX_ENCODING))
+
+                if bundles:
+                    with zipfile.ZipFile(os.path.join(destdir, bundle + u'.zip'), 'w', zipfile.ZIP_DEFLATED) as zbundle:
+                        # переизданная книга может попасть в архив дважды
+                        for fname in sorted(set(fnames)):
+                            zbundle.writestr(fname, u'<?xml version="1.0" encoding="utf-8"?>\n' \
+                                u'<FictionBook><body><p>%s</p></body></FictionBook>\n' % fname)
+
+                if callback is not None:
+                    callback(float(ixbundle + 1) / nbundles)
+
+        return indexpath
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=u'Генератор синтетической библиотеки (индекс .inpx и архивы с книгами)')
+    parser.add_argument('destdir', help=u'каталог для библиотеки')
+    parser.add_argument('-n', '--books', type=int, default=100000, help=u'кол-во книг (по умолчанию - 100000)')
+    parser.add_argument('--seed', type=int, default=1, help=u'затравка генератора случайных чисел')
+    parser.add_argument('--bundle-size', type=int, default=1000, help=u'кол-во книг в архиве')
+    parser.add_argument('--index', default=u'library.inpx', help=u'имя файла индекса')
+    parser.add_argument('--no-bundles', action='store_true', help=u'не создавать архивы с книгами (только индекс)')
+    args = parser.parse_args()
+
+    def _progress(fraction):
+        print(u'\r%3d%%' % (fraction * 100), end='', file=sys.stderr)
+
+    slib = SyntheticLibrary(args.books, args.seed, args.bundle_size)
+    print(slib.write(args.destdir, args.index, not args.no_bundles, _progress))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
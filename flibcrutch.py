@@ -18,16 +18,27 @@
 
 
 import sys, os, os.path
-from collections import namedtuple
+from collections import namedtuple, Counter
 from time import time
 import zipfile
 import json
+import multiprocessing
+import threading
+import copy
+import pickle
 import re
 import datetime
+import itertools
+import heapq
+from array import array
+from bisect import bisect_left
 from fnmatch import fnmatch
-from locale import getdefaultlocale
+from locale import getdefaultlocale, strxfrm
 from platform import system as system_name
 from fbconfig import *
+from fbsearch import SearchIndex, LRUCache, normalize_text, normalize_regex, regex_literals, \
+    FuzzyNameIndex, translit_key, fuzzy_max_distance, name_keys, name_distance, \
+    rows_to_bitmap, bitmap_to_rows, bitmap_count
 
 
 # файлы банлиста, жанров и прочего, что НЕ должно зависеть от закидонов ОС
@@ -36,6 +47,7 @@ DATABASE_ENCODING = 'utf-8'
 # кодировка файла .inpx - приколочена внутре гвоздями!
 INPX_INDEX_ENCODING = 'utf-8'
 INPX_REC_SEPARATOR = '\x04'
+INPX_REC_SEPARATOR_B = INPX_REC_SEPARATOR.encode(INPX_INDEX_ENCODING)
 
 
 INPX_REC_AUTHOR     = 0
@@ -90,22 +102,116 @@ def comma_separated_str_to_set(s):
     return set(filter(None, map(lambda t: t.lower().strip(), s.split(','))))
 
 
+class StringPool():
+    """Пул строк, присваивающий каждой различной строке плотный
+    целочисленный идентификатор (0..N-1).
+
+    Идентификатор зависит только от порядка добавления строк (а не от
+    hash(), который для строк у каждого процесса свой), потому его
+    можно хранить на диске, передавать другим процессам и использовать
+    как индекс в массивах.
+
+    Снаружи пул выглядит как словарь, где ключи - идентификаторы,
+    а значения - строки.
+
+    casefold    - если True, строки, отличающиеся только регистром,
+                  считаются одинаковыми;
+    reserved    - строки, добавляемые в пул при создании и очистке
+                  (т.е. всегда получающие идентификаторы 0, 1, ...)."""
+
+    def __init__(self, casefold=False, reserved=()):
+        self.casefold = casefold
+        self.reserved = tuple(reserved)
+
+        self.ids = {}   # ключи - нормализованные строки, значения - идентификаторы
+        self.names = [] # строки, индексы - идентификаторы
+
+        self.clear()
+
+    def clear(self):
+        self.ids.clear()
+        self.names.clear()
+
+        for s in self.reserved:
+            self.intern(s)
+
+    def set_names(self, names):
+        """Заполнение пула строками из списка names (напр. из снимка)
+        с сохранением порядка, т.е. и идентификаторов."""
+
+        self.ids.clear()
+        self.names[:] = names
+
+        for ix, s in enumerate(self.names):
+            self.ids[self.__key(s)] = ix
+
+    def __key(self, s):
+        return s.lower() if self.casefold else s
+
+    def intern(self, s):
+        """Возвращает идентификатор строки s, при необходимости добавляя
+        её в пул. Для casefold=True хранится первое встреченное написание."""
+
+        k = self.__key(s)
+        ix = self.ids.get(k)
+
+        if ix is None:
+            ix = len(self.names)
+            self.ids[k] = ix
+            self.names.append(s)
+
+        return ix
+
+    def get_id(self, s, defval=None):
+        """Возвращает идентификатор строки s, если она есть в пуле,
+        иначе - значение defval. В пул ничего не добавляет."""
+
+        return self.ids.get(self.__key(s), defval)
+
+    def __getitem__(self, ix):
+        return self.names[ix]
+
+    def __contains__(self, ix):
+        return isinstance(ix, int) and 0 <= ix < len(self.names)
+
+    def __iter__(self):
+        return iter(range(len(self.names)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return range(len(self.names))
+
+    def values(self):
+        return iter(self.names)
+
+    def items(self):
+        return enumerate(self.names)
+
+
 class BookInfo():
-    """ Класс, хранящий информацию о книге.
+    """ Информация о книге - "окно" в строку row хранилища BookStore.
+        Экземпляры создаются хранилищем по требованию и ничего, кроме
+        ссылки на хранилище и номера строки, не содержат.
 
         bookid    - целое; id книги в БД Flibusta/LibRusEc/совместимых
-        authorid  - целое; id автора (тут у нас группа авторов пока что считается за одного)
+        authorid  - целое; id автора (тут у нас группа авторов пока что считается за одного), индекс в списке Library.authors
         author    - ссылка на экземпляр AuthorInfo
         filename  - строка; имя файла книги, обычно "bookid.fb2"
         title     - строка; название книги
-        series    - целое; серия книг (если есть). хранится как хэш от нормализованного названия, сами названия - в словаре Library.series
+        series    - целое; серия книг (0, если серии нет). хранится как id в пуле Library.series
         serno     - целое; номер в серии (еслиесть)
         format    - строка; формат файла книги (он же расширение файла)
         fsize     - целое; размер файла книги
         lang      - строка; язык книги
-        tags      - множество; содержит id's тэгов
-        bundle    - целое; хэш нормализованного названия файла архива с книгами, сами названия - в словаре Library.bundles
-        date      - datetime.date"""
+        tags      - frozenset; содержит id's тэгов (из пула Library.tags)
+        bundle    - целое; id названия файла архива с книгами, сами названия - в пуле Library.bundles
+        date      - datetime.date
+        dateord   - целое; дата как порядковый номер дня (см. datetime.date.toordinal)
+        tagset    - целое; id набора тэгов (tags) в пуле BookStore.tagsets"""
+
+    __slots__ = ('store', 'row')
 
     def __str__(self):
         """Для отладки"""
@@ -113,24 +219,327 @@ class BookInfo():
         return 'bookid=%d, authorid=%d, author=%s, filename="%s", title="%s", series=%d, serno=%d, format=%s, fsize=%d, lang="%s", tags=(%s), bundle=%d, date=%s' % (self.bookid,
             self.authorid, self.author, self.filename, self.title, self.series, self.serno, self.format, self.fsize, self.lang, self.tags, self.bundle, self.date)
 
-    def __init__(self, bookid, authorid, filename, title, series, serno, _format, fsize, lang, tags, bundle, date):
-        self.bookid = bookid
-        self.authorid = authorid
-        self.author = None
-        self.filename = filename
-        self.title = title
-        self.series = series
-        self.serno = serno
-        self.format = _format
-        self.fsize = fsize
-        self.lang = lang
-        self.tags = tags
-        self.bundle = bundle
-        self.date   = date
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def bookid(self):
+        return self.store.bookid[self.row]
+
+    @property
+    def authorid(self):
+        return self.store.authorid[self.row]
+
+    @property
+    def author(self):
+        return self.store.library.authors[self.store.authorid[self.row]]
+
+    @property
+    def filename(self):
+        return self.store.filename[self.row]
+
+    @property
+    def title(self):
+        return self.store.title[self.row]
+
+    @property
+    def series(self):
+        return self.store.series[self.row]
+
+    @property
+    def serno(self):
+        return self.store.serno[self.row]
+
+    @property
+    def format(self):
+        return self.store.formats[self.store.format[self.row]]
+
+    @property
+    def fsize(self):
+        return self.store.fsize[self.row]
+
+    @property
+    def lang(self):
+        return self.store.langs[self.store.lang[self.row]]
+
+    @property
+    def tags(self):
+        return self.store.tagsets[self.store.tagset[self.row]]
+
+    @property
+    def bundle(self):
+        return self.store.bundle[self.row]
+
+    @property
+    def date(self):
+        return datetime.date.fromordinal(self.store.date[self.row])
+
+    @property
+    def dateord(self):
+        return self.store.date[self.row]
+
+    @property
+    def tagset(self):
+        return self.store.tagset[self.row]
+
+
+class PackedStrings():
+    """Список строк, хранимых в общем буфере в кодировке UTF-8.
+    Строка номер N лежит в буфере buf между смещениями offsets[N]
+    и offsets[N + 1]."""
+
+    ENCODING = 'utf-8'
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.offsets = array('Q', (0,))
+
+    def append(self, s):
+        self.buf += s.encode(self.ENCODING)
+        self.offsets.append(len(self.buf))
+
+    def __getitem__(self, ix):
+        return self.buf[self.offsets[ix]:self.offsets[ix + 1]].decode(self.ENCODING)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def select(self, rows):
+        """Возвращает новый экземпляр PackedStrings, содержащий только
+        строки с номерами из последовательности rows (в этом порядке)."""
+
+        ret = PackedStrings()
+        buf = self.buf
+        offsets = self.offsets
+
+        for row in rows:
+            ret.buf += buf[offsets[row]:offsets[row + 1]]
+            ret.offsets.append(len(ret.buf))
+
+        return ret
+
+
+class BookStore():
+    """Колоночное хранилище сведений о книгах.
+
+    Вместо экземпляра BookInfo на каждую книгу (со своим __dict__,
+    множеством тэгов, datetime.date и дублирующимися строками) поля всех
+    книг хранятся в массивах-столбцах (по элементу на книгу), а названия
+    и имена файлов - в буферах PackedStrings. Языки, форматы и наборы
+    тэгов хранятся как id в соотв. пулах.
+
+    Снаружи выглядит как словарь, где ключи - bookid, значения - экземпляры
+    BookInfo (создаваемые по требованию).
+
+    Добавление и удаление книг оставляют в столбцах мусор (удалённые и
+    перезаписанные строки), который выкидывается вызовом compact().
+    После compact() книги отсортированы по bookid, а номера строк плотные
+    (0..N-1) - их можно использовать как индексы в других массивах."""
+
+    # столбцы - имена атрибутов и коды типов для array
+    COLUMNS = (('bookid', 'q'), ('authorid', 'i'), ('series', 'i'),
+        ('serno', 'i'), ('fsize', 'q'), ('date', 'i'), ('lang', 'H'),
+        ('format', 'H'), ('tagset', 'i'), ('bundle', 'i'))
+
+    PACKED_COLUMNS = ('title', 'filename')
+
+    def __init__(self, library):
+        """library - экземпляр Library (нужен для BookInfo.author)."""
+
+        self.library = library
+
+        self.langs = StringPool()
+        self.formats = StringPool()
+        self.tagsets = StringPool() # значения - frozenset'ы id тэгов
+
+        self.clear()
+
+    def clear(self):
+        for cname, ctype in self.COLUMNS:
+            setattr(self, cname, array(ctype))
+
+        for cname in self.PACKED_COLUMNS:
+            setattr(self, cname, PackedStrings())
+
+        self.langs.clear()
+        self.formats.clear()
+        self.tagsets.clear()
+
+        # ключи - bookid, значения - номера строк;
+        # None, если мусора нет и столбец bookid отсортирован (см. compact)
+        self.__rows = None
+
+    def get_row(self, bookid, defval=None):
+        """Возвращает номер строки для книги bookid, если она есть в хранилище,
+        иначе - defval."""
+
+        if self.__rows is not None:
+            return self.__rows.get(bookid, defval)
+
+        row = bisect_left(self.bookid, bookid)
+        return row if row < len(self.bookid) and self.bookid[row] == bookid else defval
+
+    # см. get_rows
+    BULK_ROWS = 20000
+
+    def get_rows(self, bookids, defval=None):
+        """Возвращает список номеров строк для последовательности bookids
+        (defval - для книг, которых нет в хранилище).
+        Для длинных последовательностей быстрее, чем get_row для каждой
+        книги: словарь bookid - номер строки строится разом."""
+
+        rows = self.__rows
+
+        if rows is None:
+            if len(bookids) < self.BULK_ROWS:
+                return [self.get_row(bookid, defval) for bookid in bookids]
+
+            rows = dict(zip(self.bookid, range(len(self.bookid))))
+
+        try:
+            return list(map(rows.__getitem__, bookids))
+        except KeyError:
+            return [rows.get(bookid, defval) for bookid in bookids]
+
+    def __mutable(self):
+        if self.__rows is None:
+            self.__rows = {bookid:row for row, bookid in enumerate(self.bookid)}
+
+        return self.__rows
+
+    def add(self, bookid, authorid, filename, title, series, serno, _format, fsize, lang, tags, bundle, date):
+        """Добавление (или замена) книги. Параметры - как поля BookInfo,
+        tags - последовательность id тэгов, date - datetime.date
+        или порядковый номер дня (см. datetime.date.toordinal).
+        Возвращает номер строки."""
+
+        rows = self.__mutable()
+
+        row = len(self.bookid)
+        rows[bookid] = row
+
+        self.bookid.append(bookid)
+        self.authorid.append(authorid)
+        self.series.append(series)
+        self.serno.append(serno)
+        self.fsize.append(fsize)
+        self.date.append(date if isinstance(date, int) else date.toordinal())
+        self.lang.append(self.langs.intern(lang))
+        self.format.append(self.formats.intern(_format))
+        self.tagset.append(self.tagsets.intern(frozenset(tags)))
+        self.bundle.append(bundle)
+        self.title.append(title)
+        self.filename.append(filename)
+
+        return row
+
+    def compact(self):
+        """Выкидывание мусора и сортировка строк по bookid."""
+
+        if self.__rows is None:
+            return
+
+        rows = [row for bookid, row in sorted(self.__rows.items())]
+
+        for cname, ctype in self.COLUMNS:
+            col = getattr(self, cname)
+            setattr(self, cname, array(ctype, map(col.__getitem__, rows)))
+
+        for cname in self.PACKED_COLUMNS:
+            setattr(self, cname, getattr(self, cname).select(rows))
+
+        self.__rows = None
+
+    def get_state(self):
+        """Возвращает содержимое хранилища в виде кортежа, пригодного
+        для сохранения в снимок (см. set_state). Хранилище должно
+        быть сжато (см. compact)."""
+
+        self.compact()
+
+        return (tuple(getattr(self, cname).tobytes() for cname, ctype in self.COLUMNS),
+            tuple((bytes(getattr(self, cname).buf), getattr(self, cname).offsets.tobytes()) for cname in self.PACKED_COLUMNS),
+            self.langs.names, self.formats.names, [tuple(ts) for ts in self.tagsets.names])
+
+    def set_state(self, state):
+        """Заполнение хранилища данными, полученными от get_state."""
+
+        columns, packed, langs, formats, tagsets = state
+
+        self.clear()
+
+        for (cname, ctype), data in zip(self.COLUMNS, columns):
+            col = array(ctype)
+            col.frombytes(data)
+            setattr(self, cname, col)
+
+        for cname, (buf, offsets) in zip(self.PACKED_COLUMNS, packed):
+            col = PackedStrings()
+            col.buf = bytearray(buf)
+            col.offsets = array('Q')
+            col.offsets.frombytes(offsets)
+            setattr(self, cname, col)
+
+        self.langs.set_names(langs)
+        self.formats.set_names(formats)
+        self.tagsets.set_names([frozenset(ts) for ts in tagsets])
+
+        nbooks = len(self.bookid)
+        if any(len(getattr(self, cname)) != nbooks for cname in self.PACKED_COLUMNS + tuple(c[0] for c in self.COLUMNS)):
+            self.clear()
+            raise ValueError(u'%s.set_state: столбцы разной длины' % self.__class__.__name__)
+
+    def rows(self):
+        """Возвращает итератор номеров строк всех книг."""
+
+        return iter(self.__rows.values()) if self.__rows is not None else iter(range(len(self.bookid)))
+
+    def __len__(self):
+        return len(self.__rows) if self.__rows is not None else len(self.bookid)
+
+    def __contains__(self, bookid):
+        return self.get_row(bookid) is not None
+
+    def __getitem__(self, bookid):
+        row = self.get_row(bookid)
+        if row is None:
+            raise KeyError(bookid)
+
+        return BookInfo(self, row)
+
+    def get(self, bookid, defval=None):
+        row = self.get_row(bookid)
+        return BookInfo(self, row) if row is not None else defval
+
+    def pop(self, bookid, *defval):
+        """Удаление книги. Возвращает её BookInfo, которое остаётся
+        действительным до вызова compact()."""
+
+        row = self.__mutable().pop(bookid, None)
+        if row is None:
+            if defval:
+                return defval[0]
+
+            raise KeyError(bookid)
+
+        return BookInfo(self, row)
+
+    def __delitem__(self, bookid):
+        self.pop(bookid)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        return iter(self.__rows.keys()) if self.__rows is not None else iter(self.bookid)
+
+    def values(self):
+        return map(lambda row: BookInfo(self, row), self.rows())
 
 
 class AuthorInfo():
-    """ aid         - хэш нормализованного имени автора
+    """ aid         - id нормализованного имени автора (из пула Library.authornames)
         aname       - имя автора в человекочитаемом виде
         shortname   - сокращенное имя автора (см. Changelog 1.8.5)
         books       - множество bookid"""
@@ -166,34 +575,535 @@ class AuthorInfo():
         return '%s%s%s' % (aname, suf1, suf2)
 
 
-def inpx_date_to_date(s, defval):
-    """Преобразование строки вида YYYY-MM-DD в datetime.date.
+def inpx_date_to_ordinal(s, defval):
+    """Преобразование строки байт вида YYYY-MM-DD в порядковый номер дня
+    (см. datetime.date.toordinal).
     Возвращает результат преобразования в случае успеха.
-    Если строка не содержит правильной даты - возвращает значение defval."""
+    Если строка не содержит правильной даты - возвращает значение defval.
+    Разбирает то же, что и strptime(s, '%Y-%m-%d'), но раз в десять быстрее."""
+
+    ymd = s.split(b'-')
+    if len(ymd) != 3:
+        return defval
+
+    y, m, d = ymd
+    if len(y) != 4 or not 1 <= len(m) <= 2 or not 1 <= len(d) <= 2 \
+        or not (y.isdigit() and m.isdigit() and d.isdigit()):
+        return defval
 
     try:
-        d = datetime.datetime.strptime(s, '%Y-%m-%d')
-        return d.date()
+        return datetime.date(int(y), int(m), int(d)).toordinal()
     except ValueError:
         return defval
 
 
+def collation_key(s):
+    """Возвращает ключ для сортировки строк по правилам текущей локали
+    (см. locale.strxfrm) без учёта регистра."""
+
+    return strxfrm(s.upper())
+
+
+def parse_author_name(rawname):
+    """Приведение списка имён авторов к виду "Фамилия Имя Отчество[, Фамилия Имя Отчество]"."""
+
+    rawnames = filter(None, rawname.split(u':'))
+    tmpn = []
+
+    for rawname in rawnames:
+        # потому что в индексных файлах кривожопь
+        tmpn.append((u' '.join(map(lambda s: s.strip(), rawname.split(u',')))).strip())
+
+    return u', '.join(tmpn)
+
+
+def parse_inp_member(fpath, fname, languages):
+    """Разбор одного файла .inp (fname) из архива индекса fpath.
+
+    Функция вызывается и в основном процессе, и в процессах-обработчиках
+    (см. Library.parse_inpx_file), потому ничего, кроме своих параметров,
+    не трогает.
+    languages - множество допустимых языков (в нижнем регистре).
+
+    Записи разбираются на уровне байтов: удалённые книги и книги на
+    недопустимых языках отсеиваются до декодирования, а декодируются
+    только нужные поля.
+
+    Возвращает кортеж из четырёх элементов:
+    1. список записей в порядке их следования в файле, где запись - кортеж
+       (bookid,) для удалённой книги или
+       (bookid, author, tags, title, series, serno, filename, format, fsize, lang, date)
+       для существующей; tags - кортеж тэгов, date - порядковый номер дня
+       (см. datetime.date.toordinal);
+    2. кол-во записей, отброшенных из-за недопустимого языка;
+    3. массив bookid, последняя запись о которых в этом файле - существующая книга;
+    4. массив bookid, последняя запись о которых в этом файле - удаление.
+    Последние два нужны для обновления библиотеки (см. Library.update_inpx_file)."""
+
+    records = []
+    rejected = 0
+    lastrec = {} # ключи - bookid, значения - True для существующей книги, False для удалённой
+
+    # сравниваем язык до декодирования записи (что обычно и нужно - коды языков латинские)
+    blanguages = {lang.encode(INPX_INDEX_ENCODING) for lang in languages}
+
+    # значения этих полей в пределах файла часто повторяются,
+    # потому разобранные значения запоминаем (ключи - сырые байты)
+    authors = {}
+    genres = {}
+    dates = {}
+
+    with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
+        znfo = zf.getinfo(fname)
+        defdate = datetime.date(znfo.date_time[0], znfo.date_time[1], znfo.date_time[2]).toordinal() # могли бы поганцы и константы для индексов сделать, или namedtuple
+
+        data = zf.read(znfo)
+
+    def _decode(b):
+        return b.decode(INPX_INDEX_ENCODING, 'replace')
+
+    for recix, recstr in enumerate(data.split(b'\n')):
+        recstr = recstr.rstrip(b'\r')
+        if not recstr:
+            continue
+
+        try:
+            srcrec = recstr.split(INPX_REC_SEPARATOR_B)
+
+            isdel = srcrec[INPX_REC_DEL] == b'1'
+
+            if not isdel:
+                # пока валим без учета даты добавления
+
+                # проверяем на допустимость языка, пока ничего не декодировано
+                lang = srcrec[INPX_REC_LANG]
+                if lang.lower() not in blanguages and (lang.isascii() or _decode(lang).lower() not in languages):
+                    rejected += 1
+                    continue
+
+            if not srcrec[INPX_REC_LIBID].isdigit():
+                raise ValueError(u'Неправильное значение поля LIBID: "%s"' % _decode(srcrec[INPX_REC_LIBID]))
+
+            bookid = int(srcrec[INPX_REC_LIBID])
+
+            if isdel:
+                records.append((bookid,))
+                lastrec[bookid] = False
+                continue
+
+            rawfld = srcrec[INPX_REC_AUTHOR]
+            author = authors.get(rawfld)
+            if author is None:
+                author = authors[rawfld] = parse_author_name(_decode(rawfld))
+
+            rawfld = srcrec[INPX_REC_GENRE]
+            tags = genres.get(rawfld)
+            if tags is None:
+                tags = genres[rawfld] = tuple(filter(None, _decode(rawfld).lower().split(u':')))
+
+            rawfld = srcrec[INPX_REC_DATE]
+            bdate = dates.get(rawfld)
+            if bdate is None:
+                bdate = dates[rawfld] = inpx_date_to_ordinal(rawfld, defdate)
+
+            ext = _decode(srcrec[INPX_REC_EXT])
+
+            records.append((bookid, author, tags,
+                _decode(srcrec[INPX_REC_TITLE]), _decode(srcrec[INPX_REC_SERIES]),
+                int(srcrec[INPX_REC_SERNO]) if srcrec[INPX_REC_SERNO].isdigit() else 0,
+                u'%s.%s' % (_decode(srcrec[INPX_REC_FILE]), ext),
+                ext,
+                int(srcrec[INPX_REC_SIZE]) if srcrec[INPX_REC_SIZE].isdigit() else 0,
+                _decode(lang),
+                bdate))
+            lastrec[bookid] = True
+
+        except Exception as ex:
+            # вот ниибет, что квыво
+            raise Exception(u'Ошибка в записи #%d файла "%s" - %s\n* запись: %s' % (recix + 1, fname, str(ex),
+                _decode(recstr).replace(INPX_REC_SEPARATOR, u';')))
+
+    return (records, rejected,
+        array('q', sorted(bookid for bookid, live in lastrec.items() if live)),
+        array('q', sorted(bookid for bookid, live in lastrec.items() if not live)))
+
+
+# способ запуска процессов для разбора индекса (см. Library.parse_inpx_file):
+# не fork - разбор идёт и из фонового потока GUI, а дочерний процесс,
+# полученный fork'ом многопоточного, может повиснуть на блокировках,
+# захваченных в момент fork другими потоками (в т.ч. потоками GLib)
+PARSER_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def _parse_inp_member_task(args):
+    """Обёртка parse_inp_member для multiprocessing.Pool.imap"""
+
+    return parse_inp_member(*args)
+
+
+class SearchPattern():
+    """Образец для поиска по строковому полю книги (так же ищут поля
+    поиска главного окна).
+
+    pattern - строка образца; пробелы в начале и конце отбрасываются;
+              пустая строка или None - образца нет;
+    isregex - True, если pattern - регулярное выражение (ищется без учёта
+              регистра), иначе pattern ищется как подстрока в нормализованной
+              строке (см. fbsearch.normalize_text: без учёта регистра,
+              "ё" = "е", знаки препинания и пробелы сворачиваются);
+    patfilter - None или функция для фильтрации строки-образца (напр. от
+              нежелательных символов), получает и возвращает строку;
+              для регулярных выражений НЕ вызывается;
+    normalized - для регулярного выражения: True, если оно ищется
+              не в самой строке, а в нормализованной (см. normalize_regex);
+    fuzzy   - True, если образец (не регулярное выражение) - имя для
+              нечёткого поиска (см. fbsearch.name_distance): с опечатками,
+              в другой транслитерации, с инициалами вместо имени и т.п.
+
+    Атрибуты:
+    pattern - образец (для подстроки - отфильтрованный и нормализованный)
+              или None;
+    regex   - скомпилированное регулярное выражение или None;
+    fuzzy   - True, если образец - для нечёткого поиска (тогда pattern -
+              его ключ, см. fbsearch.translit_key);
+    normalized - True, если образец ищется в нормализованных строках
+              (для подстрок - всегда);
+    match   - функция, получающая строку и возвращающая булевское значение,
+              или None, если образца нет (в т.ч. если после нормализации
+              от него ничего не осталось).
+
+    Если регулярное выражение неправильное - конструктор генерирует
+    исключение re.error."""
+
+    def __init__(self, pattern, isregex=False, patfilter=None, normalized=False, fuzzy=False):
+        self.pattern = None
+        self.regex = None
+        self.normalized = normalized or not isregex
+        self.fuzzy = fuzzy and not isregex
+        self.match = None
+
+        pattern = pattern.strip() if pattern else None
+
+        if pattern:
+            if self.fuzzy:
+                pattern = translit_key(patfilter(pattern) if patfilter else pattern)
+                if pattern:
+                    self.pattern = pattern
+                    self.maxdist = fuzzy_max_distance(pattern)
+                    self.match = self.search_fuzzy
+            elif isregex:
+                self.regex = re.compile(normalize_regex(pattern) if normalized else pattern, re.UNICODE|re.IGNORECASE)
+                self.pattern = pattern
+                self.match = self.search_regexp_normalized if normalized else self.search_regexp
+            else:
+                pattern = normalize_text(patfilter(pattern) if patfilter else pattern)
+                if pattern:
+                    self.pattern = pattern
+                    self.match = self.search_text
+
+    def search_regexp(self, s):
+        return bool(self.regex.search(s))
+
+    def search_regexp_normalized(self, s):
+        return bool(self.regex.search(normalize_text(s)))
+
+    def search_text(self, s):
+        return self.pattern in normalize_text(s)
+
+    def search_fuzzy(self, s):
+        return name_distance(tuple(self.pattern.split()), name_keys(s), self.maxdist) is not None
+
+    def key(self):
+        """Возвращает кортеж, однозначно определяющий, что ищется по образцу
+        (напр. для ключа кэша результатов поиска), или None, если образца нет."""
+
+        return (self.pattern, self.regex is not None, self.normalized, self.fuzzy) if self.match is not None else None
+
+    def refines(self, other):
+        """Возвращает True, если всё, что находится по self, заведомо
+        находится и по other (экземпляру SearchPattern или None - образца
+        нет, т.е. подходит что угодно). Т.е. по self можно искать среди
+        найденного по other, а не по всей библиотеке."""
+
+        if other is None or other.match is None:
+            return True
+
+        if self.match is None:
+            return False
+
+        if self.fuzzy or other.fuzzy:
+            # похожих имён по уточнённому образцу может быть больше
+            return self.fuzzy and other.fuzzy and self.pattern == other.pattern
+
+        if self.regex is None and other.regex is None:
+            # подстрока, содержащая образец other, содержит и other
+            return other.pattern in self.pattern
+
+        return self.regex is not None and other.regex is not None \
+            and self.pattern == other.pattern and self.normalized == other.normalized
+
+
+def patterns_key(patterns):
+    """Возвращает кортеж, однозначно определяющий поиск по словарю образцов
+    patterns (см. patterns_refine) - напр. для ключа кэша."""
+
+    return tuple(sorted((fldname, sp.key()) for fldname, sp in patterns.items()
+        if sp is not None and sp.match is not None))
+
+
+def patterns_refine(patterns, oldpatterns):
+    """Возвращает True, если поиск по образцам patterns - уточнение поиска
+    по oldpatterns (т.е. искать можно среди найденного по oldpatterns).
+    patterns, oldpatterns - словари, где ключи - имена полей (как у
+    параметров Library.search_books), значения - экземпляры SearchPattern
+    или None."""
+
+    for fldname in set(patterns) | set(oldpatterns):
+        sp = patterns.get(fldname)
+
+        if sp is None or sp.match is None:
+            if oldpatterns.get(fldname) is not None and oldpatterns[fldname].match is not None:
+                # образец убрали - найдётся больше
+                return False
+        elif not sp.refines(oldpatterns.get(fldname)):
+            return False
+
+    return True
+
+
+def filter_author_pattern(s):
+    """Для образца поиска по имени автора - замена пробелами некоторых
+    нежелательных символов (см. SearchPattern). Пробелами, а не удаление -
+    т.к. образец потом нормализуется, и "Иванов,Иван" должно совпадать
+    с "Иванов Иван"."""
+
+    return ''.join(map(lambda c: ' ' if c in ',;' else c, s))
+
+
+class BookQuery():
+    """Запрос поиска книг - что ищем, без указания того, как искать
+    (это решает Library.plan_query).
+
+    patterns    - словарь образцов (ключи - имена полей из FIELDS, значения -
+                  экземпляры SearchPattern или None);
+    mindate, maxdate - None или datetime.date - книги, добавленные
+                  в библиотеку не раньше mindate и не позже maxdate;
+    languages   - None или последовательность кодов языков (напр. ('ru', 'en'));
+    formats     - None или последовательность форматов файлов (напр. ('fb2',));
+    genres      - None или последовательность тэгов (жанров, напр. 'sf_fantasy'),
+                  из которых у книги должен быть любой (если allgenres=False)
+                  или все (если allgenres=True);
+    exclgenres  - None или последовательность тэгов, которых у книги
+                  не должно быть.
+    Коды языков и форматы сравниваются без учёта регистра.
+    Отбираются книги, удовлетворяющие всем заданным условиям."""
+
+    FIELDS = ('author', 'title', 'series', 'filename')
+
+    def __init__(self, patterns=None, mindate=None, maxdate=None, languages=None, formats=None,
+            genres=None, exclgenres=None, allgenres=False):
+        self.patterns = {fldname:sp for fldname, sp in patterns.items()
+            if sp is not None and sp.match is not None} if patterns else {}
+
+        self.mindate = mindate
+        self.maxdate = maxdate
+
+        self.languages = frozenset(map(str.lower, languages)) if languages else None
+        self.formats = frozenset(map(str.lower, formats)) if formats else None
+
+        self.genres = frozenset(genres) if genres else None
+        self.exclgenres = frozenset(exclgenres) if exclgenres else None
+        self.allgenres = bool(allgenres) and self.genres is not None
+
+    def __bool__(self):
+        """False, если условий нет (искать нечего)."""
+
+        return bool(self.patterns) or any(v is not None for v in (self.mindate, self.maxdate,
+            self.languages, self.formats, self.genres, self.exclgenres))
+
+    def key(self):
+        """Возвращает кортеж, однозначно определяющий запрос (напр. для
+        ключа кэша, см. Library.find_books)."""
+
+        return (patterns_key(self.patterns), self.mindate, self.maxdate,
+            tuple(sorted(self.languages)) if self.languages else None,
+            tuple(sorted(self.formats)) if self.formats else None,
+            tuple(sorted(self.genres)) if self.genres else None,
+            tuple(sorted(self.exclgenres)) if self.exclgenres else None,
+            self.allgenres)
+
+
+class QueryStep():
+    """Шаг плана поиска (см. QueryPlan) - проверка одного условия запроса.
+
+    descr   - описание условия (для QueryPlan.explain);
+    estimate - ожидаемое кол-во книг, удовлетворяющих условию;
+    check   - функция, получающая номер строки хранилища книг (см. BookStore)
+              и возвращающая True, если книга удовлетворяет условию;
+    select  - None или функция без параметров, возвращающая множество
+              номеров строк книг, удовлетворяющих условию, без перебора
+              всех книг (напр. по индексу поиска);
+    cost    - относительная стоимость одного вызова check;
+    bitmap  - None или функция без параметров, возвращающая битовую маску
+              (int) книг, удовлетворяющих условию (см. fbsearch.TagBitmaps).
+
+    После выполнения плана (см. Library.execute_plan):
+    method  - как проверялось условие: 'index' - отбор через select,
+              'bitmap' - пересечение битовых масок,
+              'check' - проверка отобранного предыдущими шагами,
+              'scan' - перебор всех книг, или None, если до шага не дошло;
+    found   - кол-во книг, отобранных после этого шага."""
+
+    def __init__(self, descr, estimate, check, select=None, cost=1, bitmap=None):
+        self.descr = descr
+        self.estimate = estimate
+        self.check = check
+        self.select = select
+        self.cost = cost
+        self.bitmap = bitmap
+
+        self.method = None
+        self.found = None
+
+
+class QueryPlan():
+    """План поиска по запросу (см. Library.plan_query): шаги (экземпляры
+    QueryStep) в порядке выполнения. Первый шаг отбирает кандидатов
+    (по индексу или перебором), следующие - отсеивают их.
+
+    План ссылается на столбцы хранилища книг и индекс поиска, и после
+    изменения библиотеки недействителен."""
+
+    def __init__(self, query, steps, nbooks):
+        self.query = query
+        self.steps = steps
+        self.nbooks = nbooks
+        self.time = None # время выполнения (в секундах) или None, если не выполнялся
+
+    def explain(self):
+        """Возвращает описание плана (и, если он выполнен - результатов
+        шагов) в виде списка строк."""
+
+        METHODS = {'index':u'по индексу', 'bitmap':u'по маске', 'check':u'проверка', 'scan':u'перебор', None:u'-'}
+
+        ret = [u'План поиска (книг в библиотеке - %d):' % self.nbooks]
+
+        if not self.steps:
+            ret.append(u'  (условий нет)')
+
+        for ixstep, step in enumerate(self.steps, 1):
+            ret.append(u'  %d. %-40s оценка %8d  %-10s  %s' % (ixstep, step.descr, step.estimate,
+                METHODS[step.method], u'-> %d' % step.found if step.found is not None else u''))
+
+        if self.time is not None:
+            ret.append(u'  время: %.4f сек' % self.time)
+
+        return ret
+
+
+class FacetCounter():
+    """Подсчёт книг по фасетам (см. Library.book_facets), в т.ч. по частям -
+    напр. чтобы длинный список считать понемногу, не занимая надолго
+    главный цикл GUI.
+
+    Считается без BookInfo: книги - по id наборов тэгов, языков, форматов
+    и по датам (методом add, для каждой части списка), затем уже они (их
+    намного меньше, чем книг) - по жанрам и годам (методом facets).
+
+    library - экземпляр Library; его хранилище книг и пул тэгов
+              запоминаются, так что подмена индекса (см. Library.swap_index)
+              во время подсчёта ему не мешает."""
+
+    def __init__(self, library):
+        self.lock = library.lock
+        self.books = library.books
+        self.tags = library.tags
+
+        self.tagsets = Counter() # ключи - id наборов тэгов (см. BookStore.tagsets)
+        self.langs = Counter() # ключи - id языков (см. BookStore.langs)
+        self.formats = Counter() # ключи - id форматов (см. BookStore.formats)
+        self.dates = Counter() # ключи - порядковые номера дней
+
+    def add(self, bookids):
+        """Подсчёт книг из последовательности bookids (в дополнение
+        к посчитанным раньше). Книги, которых нет в хранилище, пропускаются."""
+
+        with self.lock:
+            books = self.books
+
+            rows = books.get_rows(bookids)
+            if None in rows:
+                rows = [row for row in rows if row is not None]
+
+            self.tagsets.update(map(books.tagset.__getitem__, rows))
+            self.langs.update(map(books.lang.__getitem__, rows))
+            self.formats.update(map(books.format.__getitem__, rows))
+            self.dates.update(map(books.date.__getitem__, rows))
+
+    def facets(self):
+        """Возвращает посчитанное - словарь, где ключи - имена фасет
+        (см. Library.FACETS), значения - словари вида {значение:кол-во книг}.
+        Книга с несколькими жанрами считается в каждом."""
+
+        with self.lock:
+            books = self.books
+
+            genres = Counter()
+            for tsid, nbooks in self.tagsets.items():
+                for tid in books.tagsets[tsid]:
+                    genres[self.tags[tid]] += nbooks
+
+            years = Counter()
+            for dateord, nbooks in self.dates.items():
+                years[datetime.date.fromordinal(dateord).year] += nbooks
+
+            return {'genre':dict(genres),
+                'lang':{books.langs[ix]:nbooks for ix, nbooks in self.langs.items()},
+                'format':{books.formats[ix]:nbooks for ix, nbooks in self.formats.items()},
+                'year':dict(years)}
+
+
+class InpMember(namedtuple('InpMember', 'fname bundle crc size live dead')):
+    """Сведения о файле .inp из индекса, запоминаемые между загрузками.
+
+    fname       - имя файла .inp в архиве индекса
+    bundle      - имя соответствующего файла архива с книгами
+    crc, size   - CRC32 и размер файла .inp (по ним опознаются изменения)
+    live, dead  - массивы bookid, см. parse_inp_member"""
+
+    __slots__ = ()
+
+
+# номера поколений индекса (см. Library.generation) - общие для всех
+# экземпляров Library, дабы поколения разных экземпляров не совпадали
+_index_generations = itertools.count(1)
+
+
 class Library():
     """Класс для библиотеки"""
 
     GENRE_NAMES_FNAME = u'genrelist.json'
 
+    # снимок разобранного индекса, лежит рядом с файлом настроек
+    SNAPSHOT_FNAME = u'library.cache'
+    SNAPSHOT_VERSION = 4
+
     class LibSettings(Settings):
         V_LIBROOT = 'library_root_directory'
         V_LIBINDEX = 'library_index_file'
         V_EXTDIR = 'extract_directory'
         V_LANGS = u'languages'
+        V_PROCESSES = 'parser_processes'
+        V_SEARCHINDEX = 'search_index'
+        V_SEARCHCACHE = 'search_cache_size'
 
         DEF_LANGS = {u'ru'} # патамушто я шовинистЪ
 
         VALID_KEYS = {V_LIBROOT:str, V_LIBINDEX:str,
-            V_EXTDIR:str, V_LANGS:str}
-        DEFAULTS = {V_LIBROOT:None, V_LANGS:u' '.join(list(DEF_LANGS))}
+            V_EXTDIR:str, V_LANGS:str, V_PROCESSES:int, V_SEARCHINDEX:bool,
+            V_SEARCHCACHE:int}
+        DEFAULTS = {V_LIBROOT:None, V_LANGS:u' '.join(list(DEF_LANGS)), V_PROCESSES:0,
+            V_SEARCHINDEX:True, V_SEARCHCACHE:32}
 
         def languages_to_str(self, langs):
             """Преобразует множество кодов языков в строку, разделённую пробелами"""
@@ -207,13 +1117,12 @@ class Library():
             ls.update(self.DEF_LANGS)
             return ls
 
+    # атрибуты, загружаемые из индекса (см. swap_index)
+    INDEX_ATTRS = ('authornames', 'authors', 'books', 'bundles', 'series',
+        'tags', 'indexMembers', 'genrenames', 'searchIndex', 'authorFuzzyIndex', 'sortRanks', 'tagsetNames', 'generation')
+
     def __init__(self):
-        self.authors = {}   # ключи - aid (хэши нормализованных имен авторов), а значения - экземпляры AuthorInfo.
-        self.books = {}     # ключи - bookid's, значения - экземпляры BookInfo
-        self.bundles = {}   # ключи - хэши имен файлов, значения - имена файлов
-        self.series = {}    # ключи - хэши нормализованных названий серий, значения - сами названия
-        self.tags = {}      # ключи - хэши тэгов, значения - сами тэги
-        self.genrenames = {}# ключи - хэши тэгов, значения - названия (человекочитаемые)
+        self.__init_index()
 
         self.languages = self.LibSettings.DEF_LANGS # допустимые языки
 
@@ -231,7 +1140,14 @@ class Library():
         self.libraryIndexFile = ''
         self.dataDirectory = self.appDir # каталог со служебными файлами (banned* и др.)
         self.genreNamesFile = None
+        self.snapshotFile = None
         self.extractDir = os.path.abspath(u'./')
+        self.parserProcesses = 0 # кол-во процессов для разбора индекса, 0 - по кол-ву процессоров
+        self.useSearchIndex = True # строить ли после загрузки индекс триграмм (см. build_search_index)
+
+        # кэш результатов поиска (см. find_books); общий с экземплярами,
+        # созданными new_index - ключи всё равно содержат поколение индекса
+        self.searchCache = LRUCache(self.LibSettings.DEFAULTS[self.LibSettings.V_SEARCHCACHE])
 
         self.config = self.LibSettings()
 
@@ -245,6 +1161,7 @@ class Library():
   libraryIndexFile: "%s"
   dataDirectory:    "%s"
   genreNamesFile:   "%s"
+  snapshotFile:     "%s"
   extractDir:       "%s"
   authors:          %d item(s)
   books:            %d item(s)
@@ -254,24 +1171,74 @@ class Library():
   genrenames:       %d item(s)
   languages:        %d item(s)''' % (self.__class__.__name__,
         self.appDir, self.cfgDir, self.libraryRootDir,
-        self.libraryIndexFile, self.dataDirectory, self.genreNamesFile, self.extractDir,
+        self.libraryIndexFile, self.dataDirectory, self.genreNamesFile, self.snapshotFile, self.extractDir,
         len(self.authors), len(self.books), len(self.bundles), len(self.series), len(self.tags),
         len(self.genrenames), len(self.languages))
 
     def parse_author_name(self, rawname):
-        """Приведение списка имён авторов к виду "Фамилия Имя Отчество[, Фамилия Имя Отчество]"."""
-
-        rawnames = filter(None, rawname.split(u':'))
-        tmpn = []
-
-        for rawname in rawnames:
-            # потому что в индексных файлах кривожопь
-            tmpn.append((u' '.join(map(lambda s: s.strip(), rawname.split(u',')))).strip())
-
-        return u', '.join(tmpn)
-
-    def name_hash(self, s):
-        return hash(s.lower()) if s else None
+        return parse_author_name(rawname)
+
+    def __init_index(self):
+        # все идентификаторы авторов, серий, архивов и тэгов - плотные (0..N-1),
+        # и при неизменном индексном файле от запуска к запуску не меняются (см. StringPool)
+        self.authornames = StringPool(True) # имена авторов, id - aid
+        self.authors = []   # экземпляры AuthorInfo, индексы - aid
+        self.books = BookStore(self) # ключи - bookid's, значения - экземпляры BookInfo
+        self.bundles = StringPool() # имена файлов архивов (регистрозависимые!)
+        self.series = StringPool(True, (u'',)) # названия серий; id 0 - "серии нет"
+        self.tags = StringPool() # тэги
+        self.indexMembers = [] # экземпляры InpMember в порядке разбора файлов .inp
+        self.genrenames = {}# ключи - id тэгов, значения - названия (человекочитаемые)
+        self.searchIndex = None # экземпляр SearchIndex или None (см. build_search_index)
+        self.authorFuzzyIndex = None # экземпляр FuzzyNameIndex или None (см. build_fuzzy_author_index)
+        self.sortRanks = {} # ключи - порядки сортировки, значения - см. build_sort_ranks
+        self.tagsetNames = {} # ключи - id наборов тэгов (см. BookStore.tagsets), значения - см. get_book_tags
+
+        # поколение индекса - меняется при любом изменении индекса и названий
+        # жанров (см. index_changed); результаты поиска, найденные в другом
+        # поколении, недействительны
+        self.generation = next(_index_generations)
+
+        # блокировка на время изменения индекса - чтобы его можно было
+        # загружать в одном потоке, а искать в нём (по уже загруженному) в другом
+        self.lock = threading.RLock()
+
+    def clear_index(self):
+        """Очистка всего, что загружается из индексного файла."""
+
+        with self.lock:
+            self.authornames.clear()
+            self.authors.clear()
+            self.books.clear()
+            self.bundles.clear()
+            self.series.clear()
+            self.tags.clear()
+            self.indexMembers.clear()
+            self.index_changed()
+
+    def new_index(self):
+        """Возвращает новый экземпляр Library с теми же настройками,
+        но с собственным пустым индексом - для загрузки в фоне
+        (см. swap_index)."""
+
+        newlib = copy.copy(self)
+        newlib.__init_index()
+
+        return newlib
+
+    def swap_index(self, other):
+        """Обмен индексами (см. INDEX_ATTRS) с экземпляром Library other.
+        Т.е. self получает загруженное в other целиком и сразу,
+        а не по мере загрузки."""
+
+        with self.lock, other.lock:
+            for aname in self.INDEX_ATTRS:
+                v = getattr(self, aname)
+                setattr(self, aname, getattr(other, aname))
+                setattr(other, aname, v)
+
+            self.books.library = self
+            other.books.library = other
 
     def get_series_name(self, serid):
         if serid in self.series:
@@ -281,132 +1248,215 @@ class Library():
 
     def get_book_tags(self, bnfo):
         """Возвращает строку с тэгами, разделёнными запятыми.
-        bnfo - экземпляр BookInfo."""
+        bnfo - экземпляр BookInfo.
+        Строка запоминается для каждого набора тэгов (наборов намного
+        меньше, чем книг) до изменения индекса или названий жанров."""
+
+        tsid = bnfo.tagset
 
-        return u', '.join(sorted(map(self.tag_display_name, bnfo.tags)))
+        s = self.tagsetNames.get(tsid)
+        if s is None:
+            s = self.tagsetNames[tsid] = u', '.join(sorted(map(self.tag_display_name, bnfo.tags)))
+
+        return s
+
+    def index_changed(self):
+        """Вызывается при изменении индекса: индекс поиска становится
+        недействительным, и начинается новое поколение индекса
+        (см. generation)."""
+
+        self.searchIndex = None
+        self.authorFuzzyIndex = None
+        self.sortRanks = {}
+        self.tagsetNames = {}
+        self.generation = next(_index_generations)
+        self.searchCache.clear() # всё равно уже не пригодится
+
+    def genre_names_changed(self):
+        """Вызывается после изменения self.genrenames (напр. в окне настроек) -
+        то, что от них зависит, надо пересчитать."""
+
+        self.tagsetNames = {}
+        self.generation = next(_index_generations)
+        self.searchCache.clear()
 
     def __print_stat(self, what, value):
         print('  {:<24}{}'.format('%s:' % what, value))
 
-    def parse_inpx_file(self, fpath, callback=None):
-        """Разбор файла .inpx и загрузка его в словарь self.authors.
-        callback(fraction) - (если не None) функция для отображения прогресса,
-        передаваемое значение fraction - в диапазоне 0.0-1.0."""
+    def __remove_book(self, bookid):
+        """Удаление книги из библиотеки (если она там есть).
+        Индекс поиска и пр. не сбрасывает - это делает вызывающий,
+        один раз на все изменения (см. index_changed)."""
 
-        print(u'Загрузка общего файла индекса...')
+        bnfo = self.books.pop(bookid, None)
+        if bnfo is not None:
+            bnfo.author.books.discard(bookid)
 
-        try:
-            with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
-                indexFiles = []
+    def __prune_authors(self):
+        """Выкидывание авторов, у которых не осталось книг (напр. все их
+        книги удалены или переписаны на другого автора), с перенумерацией
+        aid, чтобы authornames, authors и books.authorid оставались плотными.
+        Хранилище книг должно быть сжато (см. BookStore.compact)."""
 
-                # сначала ищем все индексные файлы, кладем в список
+        authors = [anfo for anfo in self.authors if anfo.books]
+        if len(authors) == len(self.authors):
+            return
 
-                for nfo in zf.infolist():
-                    if nfo.file_size != 0:
-                        fname = os.path.splitext(nfo.filename)
+        # имена берём из пула, а не из aname - в пуле первое встреченное написание
+        anames = [self.authornames.names[anfo.aid] for anfo in authors]
+        remap = array('i', [-1]) * len(self.authors)
 
-                        if fname[1].lower() == u'.inp':
-                            bundle = fname[0] + u'.zip'
+        for aid, anfo in enumerate(authors):
+            remap[anfo.aid] = aid
+            anfo.aid = aid
 
-                            indexFiles.append((bundle, nfo.filename))
+        self.authornames.set_names(anames)
+        self.authors[:] = authors
+        self.books.authorid = array('i', map(remap.__getitem__, self.books.authorid))
 
-                numindexes = len(indexFiles)
-                self.__print_stat('индексных файлов', numindexes)
+        self.index_changed()
 
-                # ...потому что дальше нужно работать с _отсортированным_ списком файлов: новое затирает старое
+    def __merge_inp_records(self, bundle, records, bookids=None):
+        """Добавление в библиотеку записей, полученных от parse_inp_member.
+        bundle  - имя файла архива с книгами из этого файла .inp;
+        bookids - если не None - множество bookid, записи о которых
+                  следует учитывать (прочие пропускаются).
+        Записи, идущие позже, затирают более ранние с тем же bookid."""
 
-                rejected = 0
-                ixindex = 0
-                for bundle, fname in sorted(indexFiles, key=lambda a: a[0]):
-                    ixindex += 1
+        self.index_changed()
 
-                    znfo = zf.getinfo(fname)
-                    defdate = datetime.date(znfo.date_time[0], znfo.date_time[1], znfo.date_time[2]) # могли бы поганцы и константы для индексов сделать, или namedtuple
+        # здесь имена жрем как есть, т.к. они могут быть регистрозависимыми!
+        bunid = self.bundles.intern(bundle)
 
-                    with zf.open(fname, 'r') as f:
-                        for recix, recstr in enumerate(f):
-                            srcrec = [u'<not yet parsed>']
-                            try:
-                                srcrec = recstr.decode(INPX_INDEX_ENCODING, 'replace').split(INPX_REC_SEPARATOR)
+        for rec in records:
+            bookid = rec[0]
 
-                                if not srcrec[INPX_REC_LIBID].isdigit():
-                                    raise ValueError(u'Неправильное значение поля LIBID: "%s"' % srcrec[INPX_REC_LIBID])
+            if bookids is not None and bookid not in bookids:
+                continue
 
-                                bookid = int(srcrec[INPX_REC_LIBID])
+            # старую версию книги выкидываем в т.ч. из списка книг её автора,
+            # т.к. у новой версии автор может быть другим
+            self.__remove_book(bookid)
 
-                                author = self.parse_author_name(srcrec[INPX_REC_AUTHOR])
-                                aid = self.name_hash(author)
+            if len(rec) > 1:
+                author = rec[1]
 
-                                if srcrec[INPX_REC_DEL] != u'1':
-                                    # пока валим без учета даты добавления
+                # тэги
+                # тэги обрабатываем ДО фильтрации - в общий список self.tags должны попасть ВСЕ
+                btags = tuple(map(self.tags.intern, rec[2]))
 
-                                    # проверяем на допустимость языка
-                                    if srcrec[INPX_REC_LANG].lower() not in self.languages:
-                                        rejected += 1
-                                        continue
+                # добавляем автыря в список
+                aid = self.authornames.intern(author)
+                if aid == len(self.authors):
+                    anfo = AuthorInfo(aid, author, set())
+                    self.authors.append(anfo)
+                else:
+                    anfo = self.authors[aid]
+
+                # добавляем книжку
+                serid = self.series.intern(rec[4])
 
-                                    taglist = list(filter(None, srcrec[INPX_REC_GENRE].lower().split(u':')))
-                                    #print(taglist)
+                anfo.books.add(bookid)
 
-                                    # тэги
-                                    btags = set()
+                self.books.add(bookid, aid, rec[6], rec[3], serid, rec[5],
+                    rec[7], rec[8], rec[9], btags, bunid, rec[10])
 
-                                    # тэги обрабатываем ДО фильтрации - в общий список self.tags должны попасть ВСЕ
-                                    for tag in taglist:
-                                        tid = hash(tag)
+    def __list_inp_members(self, fpath):
+        """Возвращает отсортированный по именам архивов список файлов .inp
+        из индекса fpath - список кортежей (bundle, fname, crc, size)."""
 
-                                        if tid not in self.tags:
-                                            self.tags[tid] = tag
+        indexFiles = []
 
-                                        btags.add(tid)
+        with zipfile.ZipFile(fpath, 'r', allowZip64=True) as zf:
+            # сначала ищем все индексные файлы, кладем в список
 
-                                    #print(btags)
+            for nfo in zf.infolist():
+                if nfo.file_size != 0:
+                    fname = os.path.splitext(nfo.filename)
 
-                                    # добавляем автыря в список
-                                    if aid not in self.authors:
-                                        anfo = AuthorInfo(aid, author, set())
-                                        self.authors[aid] = anfo
-                                    else:
-                                        anfo = self.authors[aid]
+                    if fname[1].lower() == u'.inp':
+                        bundle = fname[0] + u'.zip'
 
-                                    # добавляем книжку
-                                    sername = srcrec[INPX_REC_SERIES]
-                                    serid = self.name_hash(sername)
-                                    if serid is not None:
-                                        self.series[serid] = sername
+                        indexFiles.append((bundle, nfo.filename, nfo.CRC, nfo.file_size))
 
-                                    # здесь имена жрем как есть, т.к. они могут быть регистрозависимыми!
-                                    bunid = hash(bundle)
-                                    self.bundles[bunid] = bundle
+        # ...потому что дальше нужно работать с _отсортированным_ списком файлов: новое затирает старое
+        indexFiles.sort(key=lambda a: a[0])
 
-                                    anfo.books.add(bookid)
+        return indexFiles
 
-                                    serno = int(srcrec[INPX_REC_SERNO]) if srcrec[INPX_REC_SERNO].isdigit() else 0
-                                    nbfsize = int(srcrec[INPX_REC_SIZE]) if srcrec[INPX_REC_SIZE].isdigit() else 0
+    def __parse_inp_members(self, fpath, indexFiles, processes=None, callback=None):
+        """Разбор файлов .inp из индекса fpath (возможно, параллельный).
+        indexFiles  - список кортежей, где второй элемент - имя файла .inp;
+        processes   - см. parse_inpx_file;
+        callback    - см. parse_inpx_file.
+        Генератор; возвращает результаты parse_inp_member строго в порядке
+        следования файлов в indexFiles."""
 
-                                    bnfo = BookInfo(bookid, aid,
-                                        u'%s.%s' % (srcrec[INPX_REC_FILE], srcrec[INPX_REC_EXT]),
-                                        srcrec[INPX_REC_TITLE], serid, serno,
-                                        srcrec[INPX_REC_EXT], nbfsize,
-                                        srcrec[INPX_REC_LANG], btags, bunid,
-                                        inpx_date_to_date(srcrec[INPX_REC_DATE], defdate))
-                                    bnfo.author = anfo
-                                    self.books[bookid] = bnfo
+        numindexes = len(indexFiles)
+
+        if not processes:
+            processes = os.cpu_count() or 1
+
+        processes = min(processes, numindexes)
+
+        tasks = [(fpath, nfo[1], self.languages) for nfo in indexFiles]
+
+        pool = None
+        if processes > 1:
+            try:
+                pool = multiprocessing.get_context(PARSER_START_METHOD).Pool(processes)
+            except (OSError, ImportError, ValueError) as ex:
+                print(u'Не удалось запустить процессы-обработчики (%s), разбор в одном процессе' % str(ex), file=sys.stderr)
+
+        try:
+            if pool is not None:
+                self.__print_stat('процессов', processes)
+                # imap отдаёт результаты в порядке заданий - т.е. сливаем в правильном порядке
+                results = pool.imap(_parse_inp_member_task, tasks)
+            else:
+                results = map(_parse_inp_member_task, tasks)
 
-                                else:
-                                    if aid in self.authors:
-                                        anfo = self.authors[aid]
-                                        if bookid in anfo.books:
-                                            anfo.books.remove(bookid)
+            for ixindex, r in enumerate(results, 1):
+                yield r
 
-                                    if bookid in self.books:
-                                        del self.books[bookid]
+                if callback is not None:
+                    callback(float(ixindex) / numindexes)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def parse_inpx_file(self, fpath, callback=None, processes=None):
+        """Разбор файла .inpx и загрузка его в словарь self.authors.
+        callback(fraction) - (если не None) функция для отображения прогресса,
+        передаваемое значение fraction - в диапазоне 0.0-1.0.
+        processes   - кол-во процессов для разбора файлов .inp;
+                      если None или 0 - по кол-ву процессоров,
+                      если 1 - разбор в текущем процессе.
+        Файлы .inp разбираются независимо (в т.ч. параллельно),
+        но добавляются в библиотеку строго по порядку имён."""
+
+        print(u'Загрузка общего файла индекса...')
+
+        try:
+            indexFiles = self.__list_inp_members(fpath)
+            self.__print_stat('индексных файлов', len(indexFiles))
+
+            rejected = 0
+            self.indexMembers.clear()
+
+            for (bundle, fname, crc, size), (records, frejected, live, dead) in zip(indexFiles,
+                    self.__parse_inp_members(fpath, indexFiles, processes, callback)):
+                rejected += frejected
+
+                with self.lock:
+                    self.__merge_inp_records(bundle, records)
+                    self.indexMembers.append(InpMember(fname, bundle, crc, size, live, dead))
+
+            with self.lock:
+                self.books.compact()
+                self.__prune_authors()
 
-                            except Exception as ex:
-                                # вот ниибет, что квыво
-                                raise Exception(u'Ошибка в записи #%d файла "%s" - %s\n* запись: %s' % (recix + 1, fname, str(ex), u';'.join(srcrec)))
-                    if callback is not None:
-                        callback(float(ixindex) / numindexes)
         except Exception as ex:
             raise Exception(u'Ошибка обработки файла "%s",\n%s' % (fpath, str(ex)))
 
@@ -417,13 +1467,246 @@ class Library():
         self.__print_stat('доступно', included)
         self.__print_stat('авторов', len(self.authors))
 
-    def print_exec_time(self, todo, *arg):
+    def update_inpx_file(self, fpath, callback=None, processes=None):
+        """Обновление уже загруженной библиотеки (напр. из снимка) по
+        изменившемуся файлу .inpx.
+
+        Разбираются заново только добавленные и изменённые (по CRC и размеру)
+        файлы .inp; книги, затронутые этими файлами и удалёнными из индекса
+        файлами, пересчитываются по правилам parse_inpx_file (новое затирает
+        старое, DEL=1 удаляет), так что итоговый список книг совпадает с
+        полученным полным разбором.
+        Параметры - как у parse_inpx_file."""
+
+        print(u'Обновление общего файла индекса...')
+
+        try:
+            indexFiles = self.__list_inp_members(fpath)
+
+            oldmembers = {m.fname:m for m in self.indexMembers}
+            newnames = set(nfo[1] for nfo in indexFiles)
+
+            toparse = [nfo for nfo in indexFiles
+                if nfo[1] not in oldmembers or (oldmembers[nfo[1]].crc, oldmembers[nfo[1]].size) != (nfo[2], nfo[3])]
+            removed = [m for m in self.indexMembers if m.fname not in newnames]
+
+            self.__print_stat('индексных файлов', len(indexFiles))
+            self.__print_stat('изменено', len(toparse))
+            self.__print_stat('удалено', len(removed))
+
+            # затронутые изменениями книги
+            affected = set()
+
+            for m in removed:
+                affected.update(m.live)
+                affected.update(m.dead)
+
+            parsed = {} # ключи - имена файлов .inp, значения - списки записей
+            members = {}
+
+            for nfo in toparse:
+                if nfo[1] in oldmembers:
+                    affected.update(oldmembers[nfo[1]].live)
+                    affected.update(oldmembers[nfo[1]].dead)
+
+            for (bundle, fname, crc, size), (records, frejected, live, dead) in zip(toparse,
+                    self.__parse_inp_members(fpath, toparse, processes, callback)):
+                parsed[fname] = records
+                members[fname] = InpMember(fname, bundle, crc, size, live, dead)
+                affected.update(live)
+                affected.update(dead)
+
+            for bundle, fname, crc, size in indexFiles:
+                if fname not in members:
+                    members[fname] = oldmembers[fname]
+
+            # для каждой затронутой книги ищем последний упоминающий её файл:
+            # значения - кортежи (индекс в indexFiles, книга существует)
+            winners = {}
+
+            for ixindex, (bundle, fname, crc, size) in enumerate(indexFiles):
+                m = members[fname]
+
+                for bookid in m.live:
+                    if bookid in affected:
+                        winners[bookid] = (ixindex, True)
+
+                for bookid in m.dead:
+                    if bookid in affected:
+                        winners[bookid] = (ixindex, False)
+
+            # книги, которые надо взять из записей индекса; ключи - индексы в indexFiles
+            toapply = {}
+            toremove = []
+
+            for bookid in affected:
+                ixindex, live = winners.get(bookid, (None, False))
+
+                if live:
+                    bundle, fname = indexFiles[ixindex][:2]
+
+                    bnfo = self.books.get(bookid)
+                    if fname not in parsed and bnfo is not None and self.bundles[bnfo.bundle] == bundle:
+                        # книга и так взята из этого неизменного файла
+                        continue
+
+                    toapply.setdefault(ixindex, set()).add(bookid)
+
+                toremove.append(bookid)
+
+            # книги, которые после изменений берутся из неизменных файлов
+            # (напр., если более новый файл удалён) - их файлы придётся разобрать
+            toreparse = [indexFiles[ixindex] for ixindex in sorted(toapply) if indexFiles[ixindex][1] not in parsed]
+
+            if toreparse:
+                self.__print_stat('повторно разобрано', len(toreparse))
+
+                for nfo, r in zip(toreparse, self.__parse_inp_members(fpath, toreparse, processes)):
+                    parsed[nfo[1]] = r[0]
+
+            # всё разобрано - меняем библиотеку разом
+            with self.lock:
+                for bookid in toremove:
+                    self.__remove_book(bookid)
+
+                for ixindex in sorted(toapply):
+                    bundle, fname = indexFiles[ixindex][:2]
+                    self.__merge_inp_records(bundle, parsed[fname], toapply[ixindex])
+
+                self.indexMembers[:] = [members[nfo[1]] for nfo in indexFiles]
+
+                self.books.compact()
+                self.__prune_authors()
+
+                # в т.ч. если книги только удалялись
+                self.index_changed()
+
+        except Exception as ex:
+            raise Exception(u'Ошибка обработки файла "%s",\n%s' % (fpath, str(ex)))
+
+        self.__print_stat('затронуто книг', len(affected))
+        self.__print_stat('доступно', len(self.books))
+        self.__print_stat('авторов', len(self.authors))
+
+    def print_exec_time(self, todo, *arg, what='время работы'):
         t0 = time()
         r = todo(*arg)
         t0 = time() - t0
-        self.__print_stat('время работы', '%.1f сек' % t0)
+        self.__print_stat(what, '%.1f сек' % t0)
         return r
 
+    def snapshot_key(self, fpath):
+        """Возвращает ключ снимка для файла индекса fpath - кортеж из
+        версии формата снимка, полного пути к файлу индекса и отсортированного
+        списка допустимых языков.
+        Снимок, сохранённый с другим ключом, непригоден вообще."""
+
+        return (self.SNAPSHOT_VERSION, os.path.abspath(fpath), tuple(sorted(self.languages)))
+
+    def snapshot_stamp(self, fpath):
+        """Возвращает кортеж из размера и времени изменения файла индекса fpath.
+        Снимок с подходящим ключом, но с другим штампом, может быть
+        обновлён (см. update_inpx_file)."""
+
+        st = os.stat(fpath)
+
+        return (st.st_size, st.st_mtime_ns)
+
+    def save_snapshot(self, fpath):
+        """Сохранение снимка разобранного индекса fpath в файл self.snapshotFile.
+        Пулы имён авторов, серий, архивов и тэгов сохраняются списками,
+        а книги - столбцами хранилища BookStore (см. BookStore.get_state).
+        Ошибки записи не фатальны - в худшем случае при следующем
+        запуске индекс будет разобран заново."""
+
+        if not self.snapshotFile:
+            return
+
+        books = self.books.get_state()
+
+        tmpfname = self.snapshotFile + u'.tmp'
+
+        try:
+            os.makedirs(os.path.dirname(self.snapshotFile), exist_ok=True)
+
+            with open(tmpfname, 'wb') as f:
+                # ключ и штамп пишутся отдельно, дабы проверять их, не загружая всё остальное
+                pickle.dump(self.snapshot_key(fpath), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.snapshot_stamp(fpath), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump((self.authornames.names, self.series.names,
+                    self.bundles.names, self.tags.names,
+                    list(map(tuple, self.indexMembers)), books), f, pickle.HIGHEST_PROTOCOL)
+
+            os.replace(tmpfname, self.snapshotFile)
+        except OSError as ex:
+            print(u'Не удалось сохранить снимок индекса в файл "%s" - %s' % (self.snapshotFile, str(ex)), file=sys.stderr)
+
+    def __restore_snapshot(self, authornames, sernames, bunnames, tagnames, members, books):
+        """Заполнение библиотеки данными из снимка (см. save_snapshot)."""
+
+        self.clear_index()
+
+        self.authornames.set_names(authornames)
+        self.series.set_names(sernames)
+        self.bundles.set_names(bunnames)
+        self.tags.set_names(tagnames)
+
+        self.indexMembers[:] = [InpMember(*m) for m in members]
+
+        for aid, aname in enumerate(authornames):
+            self.authors.append(AuthorInfo(aid, aname, set()))
+
+        self.books.set_state(books)
+
+        for bookid, aid in zip(self.books.bookid, self.books.authorid):
+            self.authors[aid].books.add(bookid)
+
+    def load_snapshot(self, fpath, callback=None):
+        """Загрузка снимка разобранного индекса fpath из файла self.snapshotFile.
+        Если индекс с момента сохранения снимка изменился - библиотека
+        обновляется (см. update_inpx_file), и снимок пересохраняется.
+        callback(fraction) - см. parse_inpx_file.
+        Возвращает True, если снимок загружен, и False, если снимка нет,
+        он повреждён или не соответствует файлу индекса и настройкам
+        (в этом случае индекс надо разбирать заново)."""
+
+        if not self.snapshotFile or not os.path.exists(self.snapshotFile):
+            return False
+
+        print(u'Загрузка снимка индекса...')
+
+        try:
+            with open(self.snapshotFile, 'rb') as f:
+                if pickle.load(f) != self.snapshot_key(fpath):
+                    print(u'Снимок индекса не соответствует настройкам')
+                    return False
+
+                uptodate = pickle.load(f) == self.snapshot_stamp(fpath)
+
+                snapshot = pickle.load(f)
+
+            with self.lock:
+                self.__restore_snapshot(*snapshot)
+                self.index_changed()
+        except (OSError, EOFError, ValueError, TypeError, IndexError, pickle.UnpicklingError) as ex:
+            # кривой или недописанный снимок - не повод падать, просто разберём индекс заново
+            print(u'Ошибка загрузки снимка индекса из файла "%s" - %s' % (self.snapshotFile, str(ex)), file=sys.stderr)
+            self.clear_index()
+            return False
+
+        if not uptodate:
+            print(u'Снимок индекса устарел')
+
+            self.print_exec_time(self.update_inpx_file, fpath, callback, self.parserProcesses, what='обновление индекса')
+            self.save_snapshot(fpath)
+        elif callback is not None:
+            callback(1.0)
+
+        self.__print_stat('доступно', len(self.books))
+        self.__print_stat('авторов', len(self.authors))
+
+        return True
+
     def tag_display_name(self, tid):
         if tid in self.genrenames:
             return self.genrenames[tid]
@@ -450,7 +1733,9 @@ class Library():
                     if not isinstance(v, str):
                         raise TypeError(u'Значение по ключу "%s" словаря в файле "%s" не является строкой' % (k, self.genreNamesFile))
 
-                    self.genrenames[hash(k)] = v
+                    self.genrenames[self.tags.intern(k)] = v
+
+        self.genre_names_changed()
 
     def save_genre_names(self):
         tmpdict = {}
@@ -465,7 +1750,7 @@ class Library():
         callback(fraction) - (если не None) функция для отображения прогресса,
         передаваемое значение fraction - в диапазоне 0.0-1.0."""
 
-        self.books.clear()
+        self.clear_index()
 
         if not self.libraryRootDir:
             print(u'Корневой каталог библиотеки не указан')
@@ -475,22 +1760,26 @@ class Library():
             print(u'Корневой каталог библиотеки "%s" не найден' % rootDir)
             return
 
-        if self.dataDirectory:
-            print(u'Загрузка названий жанров...')
-            self.load_genre_names()
-            self.__print_stat('жанров', len(self.genrenames))
-
-        self.authors.clear()
-
         if not self.libraryIndexFile:
             print(u'Файл общего индекса не указан')
-            return
-
-        if not os.path.exists(self.libraryIndexFile):
+        elif not os.path.exists(self.libraryIndexFile):
             print(u'Файл общего индекса "%s" не найден' % self.libraryIndexFile)
-            return
-        else:
-            self.print_exec_time(self.parse_inpx_file, self.libraryIndexFile, callback)
+        elif not self.print_exec_time(self.load_snapshot, self.libraryIndexFile, callback, what='загрузка снимка'):
+            self.print_exec_time(self.parse_inpx_file, self.libraryIndexFile, callback, self.parserProcesses, what='разбор индекса')
+            self.save_snapshot(self.libraryIndexFile)
+
+        if self.books:
+            self.print_exec_time(self.build_search_index, self.useSearchIndex, what='построение индекса поиска')
+            self.print_exec_time(self.build_sort_ranks, what='сортировка библиотеки')
+
+        # названия жанров грузим после индекса, т.к. тэги из файла жанров,
+        # отсутствующие в индексе, добавляются в конец пула self.tags,
+        # и не должны влиять на идентификаторы тэгов из индекса
+        if self.dataDirectory:
+            print(u'Загрузка названий жанров...')
+            with self.lock:
+                self.load_genre_names()
+            self.__print_stat('жанров', len(self.genrenames))
 
     def extract_books(self, bookids, template, pack=False, callback=None):
         """Извлекает книги.
@@ -620,6 +1909,19 @@ class Library():
 
         self.languages = self.config.languages_from_str(s)
 
+    def cache_directory(self):
+        """Возвращает каталог для снимка индекса (см. save_snapshot):
+        под Windows - %LOCALAPPDATA%\\flibrowser, иначе -
+        $XDG_CACHE_HOME/flibrowser (по умолчанию ~/.cache/flibrowser).
+        Каталог может ещё не существовать."""
+
+        if system_name() == 'Windows':
+            basedir = os.environ.get('LOCALAPPDATA') or os.environ['APPDATA']
+        else:
+            basedir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(u'~/.cache')
+
+        return os.path.join(basedir, u'flibrowser')
+
     def load_settings(self):
         """Загрузка файла настроек.
         При успешной загрузке возвращает None, иначе - строку с сообщением об ошибке."""
@@ -661,6 +1963,10 @@ class Library():
         #print('self.libraryRootDir: %s\nself.libraryIndexFile: %s\nself.dataDirectory: %s\nself.extractDir: %s' % (self.libraryRootDir, self.libraryIndexFile, self.dataDirectory, self.extractDir))
 
         self.languages_from_str(self.config.get_value(self.LibSettings.V_LANGS))
+        self.parserProcesses = self.config.get_value(self.LibSettings.V_PROCESSES)
+        self.useSearchIndex = self.config.get_value(self.LibSettings.V_SEARCHINDEX)
+        self.searchCache.maxitems = self.config.get_value(self.LibSettings.V_SEARCHCACHE)
+        self.searchCache.clear()
 
         return None
 
@@ -708,6 +2014,7 @@ class Library():
             #    return"""
 
         self.genreNamesFile = os.path.join(self.dataDirectory, self.GENRE_NAMES_FNAME)
+        self.snapshotFile = os.path.join(self.cache_directory(), self.SNAPSHOT_FNAME)
 
         if self.extractDir:
             self.extractDir, errs = validate_path(u'Каталог для извлечения книг', self.extractDir, None)
@@ -731,103 +2038,785 @@ class Library():
         self.config.set_value(self.LibSettings.V_LIBINDEX, self.libraryIndexFile)
         self.config.set_value(self.LibSettings.V_EXTDIR, self.extractDir)
         self.config.set_value(self.LibSettings.V_LANGS, self.languages_to_str())
+        self.config.set_value(self.LibSettings.V_PROCESSES, self.parserProcesses)
+        self.config.set_value(self.LibSettings.V_SEARCHINDEX, self.useSearchIndex)
+        self.config.set_value(self.LibSettings.V_SEARCHCACHE, self.searchCache.maxitems)
 
         self.config.save()
 
-    def filter(self, filterfunc=None, progressfunc=None):
-        """Фильтрует список книг.
+    def book_filter(self, author=None, title=None, series=None, filename=None):
+        """Возвращает функцию отбора для filter(), проверяющую поля книги.
+        author, title, series, filename - функции (напр. SearchPattern.match),
+        получающие строку и возвращающие булевское значение, или None, если
+        по соотв. полю не ищем.
+        Отбираются книги, для которых совпали все заданные поля."""
+
+        def _filterfunc(bnfo):
+            if author and not author(self.authors[bnfo.authorid].aname):
+                return False
+
+            if title and not title(bnfo.title):
+                return False
+
+            if series:
+                if not bnfo.series:
+                    if not series(u''):
+                        # потому что в условиях поиска может быть регексп '.*'
+                        # и в этом случае "нет названия сериала" как бы с таким регекспом совпадает
+                        # а при поиске по простой строке пустое название правильно отбросится
+                        return False
+                elif not series(self.series[bnfo.series]):
+                    return False
+
+            if filename and not filename(bnfo.filename):
+                return False
+
+            return True
+
+        return _filterfunc
+
+    def build_search_index(self, trigrams=True):
+        """Построение индекса поиска (см. fbsearch.SearchIndex) по загруженной
+        библиотеке: нормализованных копий полей, по которым ищем, и, если
+        trigrams=True - индексов триграмм для них.
+        Индекс действителен до следующего изменения библиотеки, после
+        которого его надо строить заново."""
+
+        with self.lock:
+            self.books.compact()
+
+            books = self.books
+            nbooks = len(books)
+
+            self.searchIndex = SearchIndex([anfo.aname for anfo in self.authors],
+                self.series.names, books.authorid, books.series,
+                list(map(books.title.__getitem__, range(nbooks))),
+                list(map(books.filename.__getitem__, range(nbooks))),
+                books.date, books.tagset, books.tagsets.names, len(self.tags), trigrams)
+
+    def build_fuzzy_author_index(self):
+        """Построение индекса нечёткого поиска авторов (см. fbsearch.FuzzyNameIndex),
+        если он ещё не построен. Без вызова этого метода индекс строится
+        при первом нечётком поиске (см. fuzzy_authors) - но это несколько
+        секунд, так что его можно построить заранее (напр. в фоне).
+        Как и индекс поиска, после изменения библиотеки недействителен.
+        Возвращает индекс."""
+
+        with self.lock:
+            if self.authorFuzzyIndex is None:
+                self.authorFuzzyIndex = FuzzyNameIndex([anfo.aname for anfo in self.authors])
+
+            return self.authorFuzzyIndex
+
+    # сколько самых похожих авторов отбирается нечётким поиском (см. fuzzy_authors)
+    FUZZY_AUTHORS = 50
+
+    def fuzzy_authors(self, key, limit=FUZZY_AUTHORS):
+        """Нечёткий поиск авторов (см. SearchPattern, fbsearch.name_distance)
+        по ключу образца key (атрибуту pattern экземпляра SearchPattern
+        с fuzzy=True).
+        Возвращает список id не более чем limit (если не None) самых похожих
+        авторов с книгами: по возрастанию расстояния, при равном - от авторов
+        с большим кол-вом книг."""
+
+        with self.lock:
+            authors = self.authors
+
+            found = [(dist, -len(authors[aid].books), authors[aid].aname, aid)
+                for dist, aid in self.build_fuzzy_author_index().search(key) if authors[aid].books]
+
+            found.sort()
+
+            return [r[-1] for r in (found[:limit] if limit is not None else found)]
+
+    # см. plan_query
+    REFINE_MAX_ROWS = 5000
+
+    # для оценки кол-ва найденного, если точнее оценить нельзя (см. plan_query) -
+    # доля от всех книг, находимая простой строкой и регулярным выражением
+    TEXT_SELECTIVITY = 0.1
+    REGEX_SELECTIVITY = 0.25
+
+    def __field_getter(self, fldname, bykey=False):
+        """Возвращает функцию, получающую номер строки хранилища книг
+        и возвращающую значение поля fldname (см. BookQuery.FIELDS) книги.
+        Если bykey=True - функция получает не номер строки, а номер строки
+        в индексе поиска этого поля (см. SearchIndex), т.е. для авторов
+        и серий - их id."""
+
+        books = self.books
+
+        if fldname == 'author':
+            authors = self.authors
+            if bykey:
+                return lambda aid: authors[aid].aname
+
+            ids = books.authorid
+            return lambda row: authors[ids[row]].aname
+        elif fldname == 'series':
+            # у книги без серии название - пустая строка (как в book_filter)
+            names = self.series
+            if bykey:
+                return lambda sid: names[sid] if sid else u''
+
+            ids = books.series
+            return lambda row: names[ids[row]] if ids[row] else u''
+        else:
+            return getattr(books, fldname).__getitem__
 
-        filterfunc      - если не None - функция, получающая на входе экземпляр BookInfo,
-                          и возвращающая булевское значение.
-                          если None - ничего не ищем!
+    def __pattern_step(self, fldname, sp):
+        """Шаг плана поиска (QueryStep) для образца sp поля fldname."""
 
-        progressfunc    - если не None - функция для отображения прогресса,
-                          получающая на входе значение в диапазоне 0.0-1.0.
+        nbooks = len(self.books)
 
-        Возвращает список bookid (или пустой список, если ничего не находит)."""
+        if sp.fuzzy:
+            return self.__fuzzy_step(fldname, sp)
 
-        if progressfunc is not None and not callable(progressfunc):
-            raise TypeError(u'%s.filter: progressfunc is not callable' % self.__class__.__name__)
+        if sp.regex is not None:
+            descr = u'%s =~ /%s/%s' % (fldname, sp.pattern, u'n' if sp.normalized else u'')
+        else:
+            descr = u'%s ~ "%s"' % (fldname, sp.pattern)
 
-        if not callable(filterfunc):
-            return [] # потому что нефиг
+        index = self.searchIndex
 
-        ret = set()
+        # обязательные литералы регулярного выражения - по ним кандидаты
+        # отбираются по индексу, а выражение проверяется только у них
+        clauses = regex_literals(sp.regex) if index is not None and sp.regex is not None else None
 
-        #print u'Library.filter rxauthors="%s"' % rxauthors.pattern
+        if clauses:
+            descr = u'%s [литералов: %d]' % (descr, sum(map(len, clauses)))
+
+        if index is None or (not sp.normalized and not clauses):
+            # только проверка каждой книги (нормализация или регулярное выражение)
+            getfld = self.__field_getter(fldname)
+            match = sp.match
+
+            return QueryStep(descr,
+                int(nbooks * (self.REGEX_SELECTIVITY if sp.regex is not None else self.TEXT_SELECTIVITY)),
+                lambda row: match(getfld(row)), None, 4)
+
+        if sp.regex is not None:
+            estimate = index.estimate_literals(fldname, clauses) if clauses else None
+            if estimate is None:
+                estimate = int(nbooks * self.REGEX_SELECTIVITY)
+
+            if sp.normalized:
+                return QueryStep(descr, estimate, index.row_matcher(fldname, None, sp.regex),
+                    lambda: index.match_rows_regex(fldname, sp.regex, clauses), 3)
+
+            # выражение для исходных строк - по нормализованным только кандидаты
+            getfld = self.__field_getter(fldname)
+            getkeyfld = self.__field_getter(fldname, True)
+            match = sp.match
+
+            return QueryStep(descr, estimate, lambda row: match(getfld(row)),
+                lambda: index.match_rows_literals(fldname, clauses, lambda key: match(getkeyfld(key))), 4)
+
+        estimate = index.estimate(fldname, sp.pattern)
+        if estimate is None:
+            estimate = int(nbooks * self.TEXT_SELECTIVITY)
+
+        return QueryStep(descr, estimate, index.row_matcher(fldname, sp.pattern),
+            lambda: index.match_rows(fldname, sp.pattern), 2)
+
+    def __fuzzy_step(self, fldname, sp):
+        """Шаг плана поиска (QueryStep) для нечёткого образца sp поля fldname.
+        Для авторов - книги FUZZY_AUTHORS самых похожих (см. fuzzy_authors),
+        для прочих полей - проверка каждой книги."""
+
+        descr = u'%s ≈ "%s"' % (fldname, sp.pattern)
+
+        if fldname != 'author':
+            getfld = self.__field_getter(fldname)
+            match = sp.match
+
+            return QueryStep(descr, int(len(self.books) * self.TEXT_SELECTIVITY),
+                lambda row: match(getfld(row)), None, 8)
+
+        aids = self.fuzzy_authors(sp.pattern)
+        descr = u'%s [авторов: %d]' % (descr, len(aids))
+
+        authorids = self.books.authorid
+        aidset = frozenset(aids)
+        check = lambda row: authorids[row] in aidset
+
+        estimate = sum(len(self.authors[aid].books) for aid in aids)
+
+        index = self.searchIndex
+        if index is None:
+            return QueryStep(descr, estimate, check, None, 1)
+
+        def _select():
+            rows = set()
+            for aid in aids:
+                rows.update(index.authorrows[aid])
+
+            return rows
+
+        return QueryStep(descr, estimate, check, _select, 1)
+
+    def __pool_step(self, descr, column, pool, values):
+        """Шаг плана поиска (QueryStep) для отбора книг, у которых значение
+        столбца column (идентификатор строки в пуле pool, см. StringPool)
+        есть среди values (строки без учёта регистра)."""
+
+        ids = frozenset(ix for ix in pool if pool[ix].lower() in values)
+
+        # array.count - без питоньего цикла по книгам
+        return QueryStep(u'%s in (%s)' % (descr, u', '.join(sorted(values))),
+            sum(map(column.count, ids)), lambda row: column[row] in ids, None, 1)
+
+    def __genre_step(self, query):
+        """Шаг плана поиска (QueryStep) для отбора по жанрам (тэгам)."""
+
+        include = [self.tags.get_id(tag, -1) for tag in query.genres] if query.genres else []
+        exclude = [self.tags.get_id(tag, -1) for tag in query.exclgenres] if query.exclgenres else []
+
+        descr = []
+        if include:
+            descr.append(u'жанры %s (%s)' % (u'все' if query.allgenres else u'любой', u', '.join(sorted(query.genres))))
+        if exclude:
+            descr.append(u'без (%s)' % u', '.join(sorted(query.exclgenres)))
+
+        # для проверки отдельных книг - какие наборы тэгов подходят
+        # (наборов намного меньше, чем книг)
+        inclset = frozenset(include)
+        exclset = frozenset(exclude)
+        tagsets = self.books.tagsets
+
+        if not include:
+            tsmatch = lambda ts: ts.isdisjoint(exclset)
+        elif query.allgenres:
+            tsmatch = lambda ts: inclset <= ts and ts.isdisjoint(exclset)
+        else:
+            tsmatch = lambda ts: not ts.isdisjoint(inclset) and ts.isdisjoint(exclset)
+
+        okids = frozenset(tsid for tsid in tagsets if tsmatch(tagsets[tsid]))
+        column = self.books.tagset
+        check = lambda row: column[row] in okids
+
+        if self.searchIndex is None:
+            return QueryStep(u' '.join(descr), len(self.books) // 2, check, None, 1)
+
+        mask = self.searchIndex.tags.select(include, exclude, query.allgenres)
+
+        return QueryStep(u' '.join(descr), bitmap_count(mask), check, None, 1, lambda: mask)
+
+    def plan_query(self, query, within=None):
+        """Составление плана поиска книг по запросу query (экземпляру
+        BookQuery). within - см. search_books.
+
+        Для каждого условия оценивается, сколько книг ему удовлетворяют
+        (по индексу поиска и столбцам хранилища, если это возможно без
+        перебора книг), и во что обходится его проверка.
+        Первым выполняется самое избирательное из условий, по которым
+        можно отбирать по индексу; если таких нет - перебираются все
+        книги с проверкой самого дешёвого и избирательного условия.
+        Остальные условия проверяются у отобранного, начиная с самых
+        дешёвых и избирательных.
+
+        Возвращает экземпляр QueryPlan (см. execute_plan)."""
+
+        with self.lock:
+            nbooks = len(self.books)
+            steps = []
+
+            # по индексу искать быстрее, чем перебирать много найденного раньше
+            if within is not None and (self.searchIndex is None or len(within) <= self.REFINE_MAX_ROWS):
+                withinrows = frozenset(filter(lambda row: row is not None, map(self.books.get_row, within)))
+
+                steps.append(QueryStep(u'среди найденного раньше', len(withinrows),
+                    withinrows.__contains__, lambda: set(withinrows), 1))
+
+            for fldname in query.FIELDS:
+                if fldname in query.patterns:
+                    steps.append(self.__pattern_step(fldname, query.patterns[fldname]))
+
+            if query.mindate is not None or query.maxdate is not None:
+                minord = query.mindate.toordinal() if query.mindate is not None else 0
+                maxord = query.maxdate.toordinal() if query.maxdate is not None else datetime.date.max.toordinal()
+
+                dates = self.books.date
+                descr = u'дата %s..%s' % (query.mindate or u'', query.maxdate or u'')
+                check = lambda row: minord <= dates[row] <= maxord
+
+                if self.searchIndex is None:
+                    steps.append(QueryStep(descr, nbooks // 2, check, None, 1))
+                else:
+                    # книги за период - срез отсортированных по дате строк
+                    index = self.searchIndex
+
+                    steps.append(QueryStep(descr, index.count_dates(minord, maxord), check,
+                        lambda: set(index.date_rows(minord, maxord)), 1))
+
+            if query.languages:
+                steps.append(self.__pool_step(u'язык', self.books.lang, self.books.langs, query.languages))
+
+            if query.formats:
+                steps.append(self.__pool_step(u'формат', self.books.format, self.books.formats, query.formats))
+
+            if query.genres or query.exclgenres:
+                steps.append(self.__genre_step(query))
+
+            if steps:
+                selectable = [step for step in steps if step.select is not None or step.bitmap is not None]
+
+                first = min(selectable if selectable else steps,
+                    key=lambda step: step.estimate if selectable else step.estimate * step.cost)
+                steps.remove(first)
+
+                steps.sort(key=lambda step: step.estimate * step.cost)
+                steps.insert(0, first)
+
+            return QueryPlan(query, steps, nbooks)
+
+    def execute_plan(self, plan, progressfunc=None, cancel=None):
+        """Выполнение плана поиска plan (см. plan_query), составленного
+        для текущего состояния библиотеки.
+        progressfunc, cancel - см. search_books.
+        Шаг, для которого есть отбор по индексу, выполняется через
+        индекс, пока отобранного больше REFINE_MAX_ROWS, иначе
+        проверяется каждая отобранная книга.
+        Заполняет атрибуты method и found шагов плана.
+        Возвращает список bookid, или None, если поиск прерван."""
+
+        def _cancelled():
+            return cancel is not None and cancel.is_set()
 
-        nbooks = len(self.books)
         PBAR_RATE = 1000
 
-        for ixbook, bnfo in enumerate(self.books.values()):
-            if (progressfunc) and (ixbook % PBAR_RATE) == 0:
-                progressfunc(float(ixbook) / nbooks)
+        t0 = time()
 
-            if not filterfunc(bnfo):
-                continue
+        with self.lock:
+            rows = None # множество номеров строк отобранного,
+            bits = None # или его битовая маска, если шаги выполняются по маскам
+            nfound = 0
+
+            for step in plan.steps:
+                if _cancelled():
+                    return None
+
+                if step.bitmap is not None and (bits is not None or rows is None or nfound > self.REFINE_MAX_ROWS):
+                    # AND битовых масок
+                    step.method = 'bitmap'
+
+                    if bits is None:
+                        bits = step.bitmap() if rows is None else rows_to_bitmap(rows, plan.nbooks) & step.bitmap()
+                        rows = None
+                    else:
+                        bits &= step.bitmap()
+
+                    step.found = nfound = bitmap_count(bits)
+                    continue
+
+                if bits is not None:
+                    if step.select is not None and nfound > self.REFINE_MAX_ROWS:
+                        # найденное по индексу - тоже в маску
+                        step.method = 'index'
+                        bits &= rows_to_bitmap(step.select(), plan.nbooks)
+                        step.found = nfound = bitmap_count(bits)
+                        continue
+
+                    rows = set(bitmap_to_rows(bits))
+                    bits = None
+
+                if rows is None and step.select is None:
+                    step.method = 'scan'
+
+                    rows = set()
+                    check = step.check
+
+                    for ixrow, row in enumerate(self.books.rows()):
+                        if (ixrow % PBAR_RATE) == 0:
+                            if _cancelled():
+                                return None
+
+                            if progressfunc:
+                                progressfunc(float(ixrow) / plan.nbooks)
+
+                        if check(row):
+                            rows.add(row)
+                elif rows is None:
+                    step.method = 'index'
+                    rows = step.select()
+                elif step.select is not None and nfound > self.REFINE_MAX_ROWS:
+                    step.method = 'index'
+                    rows &= step.select()
+                else:
+                    step.method = 'check'
+                    rows = set(filter(step.check, rows))
+
+                step.found = nfound = len(rows)
+
+            if bits is not None:
+                rows = bitmap_to_rows(bits)
+
+            if rows is None:
+                # условий нет - искать нечего
+                return []
+
+            if _cancelled():
+                return None
+
+            plan.time = time() - t0
+
+            return list(map(self.books.bookid.__getitem__, rows))
+
+    def run_query(self, query, progressfunc=None, within=None, cancel=None):
+        """Поиск книг по запросу query (экземпляру BookQuery).
+        progressfunc, within, cancel - см. search_books.
+        Возвращает список bookid (в т.ч. пустой, если условий нет),
+        или None, если поиск прерван."""
+
+        with self.lock:
+            return self.execute_plan(self.plan_query(query, within), progressfunc, cancel)
+
+    def search_books(self, author=None, title=None, series=None, filename=None, progressfunc=None,
+            within=None, cancel=None):
+        """Поиск книг по образцам.
+        author, title, series, filename - экземпляры SearchPattern или None,
+                          если по соотв. полю не ищем;
+        progressfunc    - см. filter();
+        within          - None или последовательность bookid, среди которых
+                          искать (напр. найденное предыдущим поиском,
+                          уточнением которого является этот, см. patterns_refine);
+        cancel          - None или threading.Event (или подобный объект
+                          с методом is_set()); если он установлен - поиск
+                          прерывается.
+        Отбираются книги, для которых совпали все заданные поля.
+
+        Как искать - решает plan_query: простые (не регулярные) образцы
+        и регулярные выражения для нормализованных строк (см. SearchPattern)
+        ищутся по индексу поиска (если он построен, см. build_search_index),
+        остальные проверяются только у книг, отобранных по индексу; если по
+        индексу отбирать нечего - перебирается вся библиотека.
+        Если задан within - ищется только среди этих книг (если их немного,
+        или индекса нет; иначе within не нужен - по индексу быстрее).
+        Возвращает список bookid (в т.ч. пустой), или None, если поиск
+        прерван."""
+
+        return self.run_query(BookQuery({'author':author, 'title':title, 'series':series, 'filename':filename}),
+            progressfunc, within, cancel)
+
+    def find_books(self, query, progressfunc=None, within=None, cancel=None):
+        """Поиск книг по запросу query (экземпляру BookQuery) с сортировкой
+        (как в списке книг главного окна).
+        progressfunc, within, cancel - см. search_books.
+
+        Результаты кэшируются (см. self.searchCache) по запросу и поколению
+        индекса, так что повторный поиск того же самого (до изменения
+        индекса или названий жанров) не ищет заново.
+        Возвращает array отсортированных bookid, или None, если поиск прерван."""
+
+        with self.lock:
+            key = (self.generation, query.key())
+
+            found = self.searchCache.get(key)
+            if found is not None:
+                return found
+
+            found = self.run_query(query, progressfunc, within, cancel)
+            if found is None:
+                return None
+
+            found = array('q', self.sort_books(found))
+
+            self.searchCache.put(key, found)
+
+            return found
+
+    def newest_books(self, count=None, mindate=None, within=None):
+        """Возвращает список bookid книг, добавленных в библиотеку последними,
+        от новых к старым (при равных датах - от больших bookid к меньшим):
+        не более count (если не None) книг, добавленных не раньше mindate
+        (datetime.date, если не None), из последовательности bookid within
+        (если не None) или из всей библиотеки.
+        По всей библиотеке с индексом поиска - срез отсортированных по дате
+        строк (см. SearchIndex.date_rows), без перебора книг."""
+
+        minord = mindate.toordinal() if mindate is not None else 0
+
+        with self.lock:
+            books = self.books
+
+            if within is None and self.searchIndex is not None:
+                rows = self.searchIndex.date_rows(minord, datetime.date.max.toordinal())
+                if count is not None:
+                    rows = rows[len(rows) - count:] if count < len(rows) else rows
+
+                rows = reversed(rows)
+            else:
+                if within is None:
+                    rows = books.rows()
+                else:
+                    rows = filter(lambda row: row is not None, books.get_rows(within))
+
+                dates = books.date
+                bookids = books.bookid
+
+                rows = [row for row in rows if dates[row] >= minord]
+                key = lambda row: (dates[row], bookids[row])
+
+                rows = heapq.nlargest(count, rows, key) if count is not None else sorted(rows, key=key, reverse=True)
+
+            return list(map(books.bookid.__getitem__, rows))
+
+    def filter_dates(self, bookids, mindate=None, maxdate=None):
+        """Отбор из последовательности bookids книг, добавленных в библиотеку
+        не раньше mindate и не позже maxdate (datetime.date или None, если
+        без ограничения). Книги, которых нет в библиотеке, пропускаются
+        (в т.ч. и без ограничений по дате).
+        Возвращает список bookid."""
+
+        minord = mindate.toordinal() if mindate is not None else 0
+        maxord = maxdate.toordinal() if maxdate is not None else datetime.date.max.toordinal()
+
+        with self.lock:
+            rows = self.books.get_rows(bookids)
+
+            if mindate is None and maxdate is None:
+                return [bookid for bookid, row in zip(bookids, rows) if row is not None]
+
+            dates = self.books.date
+
+            return [bookid for bookid, row in zip(bookids, rows) if row is not None and minord <= dates[row] <= maxord]
+
+    # фасеты (см. book_facets) - имена и то, по чему считаются
+    FACETS = ('genre', # жанры (имена тэгов)
+        'lang',        # коды языков
+        'format',      # форматы файлов
+        'year')        # годы добавления в библиотеку (int)
+
+    def book_facets(self, bookids):
+        """Подсчёт книг из последовательности bookids по фасетам (см. FACETS)
+        одним проходом по каждому нужному столбцу хранилища (см. FacetCounter).
+        Книга с несколькими жанрами считается в каждом.
+        Возвращает словарь, где ключи - имена фасет, значения - словари
+        вида {значение:кол-во книг}."""
+
+        with self.lock:
+            counter = FacetCounter(self)
+            counter.add(bookids)
+
+            return counter.facets()
+
+    def filter_facets(self, bookids, selection):
+        """Отбор из последовательности bookids книг с указанными значениями
+        фасет. selection - словарь, где ключи - имена фасет (см. FACETS),
+        значения - как в book_facets. Книга отбирается, если подходит
+        по всем фасетам из selection.
+        Возвращает список bookid (в том же порядке, что и в bookids)."""
+
+        if not selection:
+            return list(bookids)
+
+        with self.lock:
+            books = self.books
+            checks = []
+
+            for facet, value in selection.items():
+                if facet == 'year':
+                    minord = datetime.date(value, 1, 1).toordinal()
+                    maxord = datetime.date(value, 12, 31).toordinal()
+                    dates = books.date
+
+                    checks.append(lambda row, minord=minord, maxord=maxord: minord <= dates[row] <= maxord)
+                    continue
+
+                if facet == 'genre':
+                    # подходящие наборы тэгов, а не тэги каждой книги
+                    tid = self.tags.get_id(value, -1)
+                    ids = frozenset(tsid for tsid in books.tagsets if tid in books.tagsets[tsid])
+                    column = books.tagset
+                elif facet == 'lang':
+                    ids = frozenset((books.langs.get_id(value, -1),))
+                    column = books.lang
+                elif facet == 'format':
+                    ids = frozenset((books.formats.get_id(value, -1),))
+                    column = books.format
+                else:
+                    raise ValueError(u'%s.filter_facets: неизвестная фасета "%s"' % (self.__class__.__name__, facet))
+
+                checks.append(lambda row, column=column, ids=ids: column[row] in ids)
+
+            return [bookid for bookid, row in zip(bookids, books.get_rows(bookids))
+                if row is not None and all(check(row) for check in checks)]
+
+    # порядки сортировки книг (см. sort_books):
+    # series    - цикл, номер в цикле, автор, название (как в списке книг главного окна);
+    # author    - автор, цикл, номер в цикле, название;
+    # title     - название, автор;
+    # format    - формат файла;
+    # date      - дата добавления в библиотеку;
+    # size      - размер файла.
+    # строки сравниваются по правилам локали (см. collation_key),
+    # при равных ключах книги идут по возрастанию bookid
+    SORT_ORDERS = ('series', 'author', 'title', 'format', 'date', 'size')
+    SORT_DEFAULT = 'series'
+
+    def sort_key_func(self, order=SORT_DEFAULT):
+        """Возвращает функцию, получающую номер строки книги в self.books
+        (см. BookStore) и возвращающую ключ для сортировки в порядке order
+        (см. SORT_ORDERS)."""
+
+        books = self.books
+
+        if order == 'date':
+            return books.date.__getitem__
+        elif order == 'size':
+            return books.fsize.__getitem__
+        elif order == 'format':
+            fkeys = list(map(collation_key, books.formats.names))
+            fmt = books.format
+            return lambda row: fkeys[fmt[row]]
+        elif order not in self.SORT_ORDERS:
+            raise ValueError(u'%s.sort_key_func: неизвестный порядок сортировки "%s"' % (self.__class__.__name__, order))
+
+        # ключи имён авторов и названий циклов - по разу на автора и цикл,
+        # а не на книгу
+        akeys = [collation_key(anfo.aname) for anfo in self.authors]
+        authorid = books.authorid
+        title = books.title
+
+        if order == 'title':
+            return lambda row: (collation_key(title[row]), akeys[authorid[row]])
+
+        skeys = list(map(collation_key, self.series.names))
+        series = books.series
+        serno = books.serno
+
+        if order == 'author':
+            return lambda row: (akeys[authorid[row]], skeys[series[row]], serno[row], collation_key(title[row]))
+
+        return lambda row: (skeys[series[row]], serno[row], akeys[authorid[row]], collation_key(title[row]))
+
+    def build_sort_ranks(self, order=SORT_DEFAULT):
+        """Сортировка всей библиотеки в порядке order (см. SORT_ORDERS),
+        если она ещё не отсортирована в этом порядке.
+        Результат - кортеж из двух массивов (ranks, rows), где ranks[row] -
+        место книги из строки row в self.books (см. BookStore) в порядке
+        сортировки, а rows[rank] - наоборот, номер строки книги на месте
+        rank. С ними сортировка найденного (см. sort_books) - это сортировка
+        целых чисел без сравнения строк.
+        Действителен до следующего изменения библиотеки.
+        Для порядка по умолчанию вызывается при загрузке (см. load),
+        для остальных - при первой сортировке в этом порядке."""
+
+        with self.lock:
+            ret = self.sortRanks.get(order)
+
+            if ret is None:
+                keyfunc = self.sort_key_func(order)
+
+                self.books.compact()
+                nrows = len(self.books.bookid)
+
+                rows = array('i', sorted(range(nrows), key=keyfunc))
+                ranks = array('i', bytes(rows.itemsize * nrows))
+
+                for rank, row in enumerate(rows):
+                    ranks[row] = rank
+
+                ret = self.sortRanks[order] = (ranks, rows)
+
+            return ret
+
+    # см. sort_books
+    SORT_MERGE_RATIO = 8
+
+    def sort_books(self, bookids, order=SORT_DEFAULT, reverse=False):
+        """Возвращает список bookids, отсортированный в порядке order
+        (см. SORT_ORDERS), или в обратном, если reverse=True.
+        Если библиотека отсортирована в этом порядке (см. build_sort_ranks),
+        либо загружена полностью (построен индекс поиска) - сортируются
+        места книг в общем порядке, а если найдена заметная часть
+        библиотеки - книги просто отбираются из общего порядка.
+        Иначе (напр. во время загрузки) - сортировка по ключам строк
+        (см. sort_key_func).
+        Книги, которых нет в библиотеке (напр. удалённые после поиска),
+        пропускаются."""
+
+        with self.lock:
+            books = self.books
+
+            found = books.get_rows(bookids)
+            if None in found:
+                bookids = [bookid for bookid, row in zip(bookids, found) if row is not None]
+                found = [row for row in found if row is not None]
+
+            if order not in self.sortRanks and self.searchIndex is None:
+                keyfunc = self.sort_key_func(order)
+
+                # при равных ключах - по bookid, как и в общем порядке
+                return [bookid for row, bookid in sorted(zip(found, bookids),
+                    key=lambda rb: (keyfunc(rb[0]), rb[1]), reverse=reverse)]
+
+            ranks, rows = self.build_sort_ranks(order)
+
+            if len(found) * self.SORT_MERGE_RATIO >= len(rows):
+                marks = bytearray(len(rows))
+                for row in found:
+                    marks[row] = 1
+
+                ordered = itertools.compress(rows, map(marks.__getitem__, rows))
+            else:
+                ordered = map(rows.__getitem__, sorted(map(ranks.__getitem__, found), reverse=reverse))
+                reverse = False
 
-            ret.add(bnfo.bookid)
+            ret = list(map(books.bookid.__getitem__, ordered))
+            if reverse:
+                ret.reverse()
 
-        return list(ret)
+            return ret
 
+    def filter(self, filterfunc=None, progressfunc=None, cancel=None):
+        """Фильтрует список книг.
 
-# debug
-def main():
-    """print(AuthorInfo.make_shortname('Иванов Иван Иваныч, Сидоров Сидор Сидорыч'))
-    print(AuthorInfo.make_shortname('Петров Пётр Петрович, Сергеев Сергей Сергеич, Климов Клим Климыч, Чон Ду Хван'))
-    print(AuthorInfo.make_shortname('Петров-Задерищенский Навуходоносор Сарданапалович, Сергеев-Оглы Нурмухаммед Кельдыбабаевич, Климов Клим Климыч, Чон Ду Хван'))
+        filterfunc      - если не None - функция, получающая на входе экземпляр BookInfo,
+                          и возвращающая булевское значение.
+                          если None - ничего не ищем!
 
-    return
+        progressfunc    - если не None - функция для отображения прогресса,
+                          получающая на входе значение в диапазоне 0.0-1.0.
 
-    print(BookFileNameTemplate.TEMPLATE_HELP)
-    return"""
+        cancel          - см. search_books.
 
-    library = Library()
-    lse = library.load_settings()
-    if lse:
-        print(lse)
-        return
+        Возвращает список bookid (или пустой список, если ничего не находит),
+        или None, если поиск прерван."""
 
-    lse = library.validate_settings()
-    if lse:
-        print(lse)
-        return
+        if progressfunc is not None and not callable(progressfunc):
+            raise TypeError(u'%s.filter: progressfunc is not callable' % self.__class__.__name__)
 
-    print(library.libraryIndexFile)
+        if not callable(filterfunc):
+            return [] # потому что нефиг
 
-    #library.save_settings()
-    #return
+        ret = set()
 
-    print('loading library')
-    library.load()
-    print('  loaded')
+        #print u'Library.filter rxauthors="%s"' % rxauthors.pattern
 
-    #print(library.tags)
+        PBAR_RATE = 1000
 
-    print(u'* поиск')
-    t0 = time()
+        # индекс может в это время загружаться в другом потоке - ищем по загруженному
+        with self.lock:
+            nbooks = len(self.books)
 
-    if library.authors:
-        #sf = lambda s: True, lambda s: re.search(u'эйзенхорн', s, re.UNICODE|re.IGNORECASE)
-        sf = lambda nfo: nfo.filename.find('666') >= 0
-        f = library.filter(filterfunc=sf)
-        print('found', len(f))
+            for ixbook, bnfo in enumerate(self.books.values()):
+                if (ixbook % PBAR_RATE) == 0:
+                    if cancel is not None and cancel.is_set():
+                        return None
 
-    t0 = time() - t0
-    print('time: %.2g sec.' % t0)
+                    if progressfunc:
+                        progressfunc(float(ixbook) / nbooks)
 
-    return 0
+                if not filterfunc(bnfo):
+                    continue
 
-    n = 40
-    for bnfo in library.books.values():
-        if n <= 0:
-            break
-        n -= 1
-        print(library.get_book_fs_name(bnfo, (EXTRACTPARAM_RENAME, EXTRACTPARAM_AUTHORNAME, EXTRACTPARAM_ZIPFILE)))
+                ret.add(bnfo.bookid)
 
-    return 0
+        return list(ret)
 
 
 if __name__ == '__main__':
-    main()
-
+    # консольный режим см. в fbcli
+    from fbcli import main
+    sys.exit(main())
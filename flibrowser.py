@@ -25,8 +25,10 @@ from flibcrutch import *
 from fbtemplates import *
 from fbsettings import SettingsDialog, InitialSettingsDialog
 import fbabout
-import re, random
+import re, random, itertools
+from time import time
 import os.path, sys
+import threading
 
 
 # для отладки, чтоб не грузить БД в 100500 книжек (которой может и нет вовсе на момент отладки)
@@ -51,7 +53,11 @@ class FilterEntry():
     image   - виджет отображения иконки
     regex   - скомпилированное регулярное выражение
               (если выражение введено и правильное),
-              иначе None"""
+              иначе None
+    searchpattern - экземпляр SearchPattern (если образец введён
+              и правильный), иначе None
+    onchanged - None или функция без параметров, вызываемая при
+              изменении образца (текста или флажка "RE")"""
 
     EMPTY = 'dialog-question'
     VALID = 'gtk-yes'
@@ -59,16 +65,6 @@ class FilterEntry():
 
     ICON_SIZE = Gtk.IconSize.BUTTON
 
-    def search_regexp(self, s):
-        """если выражение не указано - возвращаем True, т.к. отсутствие
-        выражения соответствует выражению .*"""
-
-        return True if not self.pattern else bool(self.regex.search(s))
-
-    def search_text(self, s):
-        #print(u'"%s", %d' % (s, s.lower().find(self.pattern)))
-        return s.lower().find(self.pattern) >= 0
-
     def set_status_icon(self, iconname):
         #print('set_status_icon', iconname)
         if not iconname:
@@ -78,6 +74,14 @@ class FilterEntry():
 
     def chkisregexp_toggled(self, cb, data=None):
         self.isregex = self.chkisregexp.get_active()
+        self.pattern_changed()
+
+    def entry_changed(self, entry, data=None):
+        self.pattern_changed()
+
+    def pattern_changed(self):
+        if callable(self.onchanged):
+            self.onchanged()
 
     def entry_icon_pressed(self, entry, icon_pos, event):
         if icon_pos == Gtk.EntryIconPosition.SECONDARY:
@@ -95,6 +99,7 @@ class FilterEntry():
         self.entry = Gtk.Entry()
         self.entry.set_activates_default(True) # чтоб дефолтная кнопка в окне работала
         self.entry.connect('icon_release', self.entry_icon_pressed)
+        self.entry.connect('changed', self.entry_changed)
         grid.append_col(self.entry, True)
 
         rowlabel.set_mnemonic_widget(self.entry)
@@ -113,9 +118,11 @@ class FilterEntry():
         grid.append_col(self.chkisregexp)
 
         self.isregex = False
+        self.fuzzy = False # см. AuthorFilterEntry
         self.pattern = None
         self.regex = None
-        self.searchfunc = self.search_text
+        self.searchpattern = None
+        self.onchanged = None
 
     def reset(self):
         """Сброс полей"""
@@ -136,34 +143,23 @@ class FilterEntry():
         """Компиляция выражения из поля ввода, установка
         иконки в зависимости от результата компиляции."""
 
-        t = self.entry.get_text().strip()
         self.pattern = None
-        self.searchfunc = None
+        self.regex = None
+        self.searchpattern = None
 
-        if not t:
-            # выражения нет
-            self.regex = None
-            self.pattern = None
-            sti = self.EMPTY
+        try:
+            sp = SearchPattern(self.entry.get_text(), self.isregex and not self.fuzzy, self.filter_pattern, fuzzy=self.fuzzy)
+
+            self.pattern = sp.pattern
+            self.regex = sp.regex
+            self.searchpattern = sp if sp.match else None
+
+            # выражения может и не быть
+            sti = self.VALID if sp.pattern else self.EMPTY
             rok = True
-        else:
-            try:
-                if self.isregex:
-                    self.regex = re.compile(t, re.UNICODE|re.IGNORECASE)
-                    self.pattern = t
-                    self.searchfunc = self.search_regexp
-                else:
-                    self.regex = None
-                    self.pattern = self.filter_pattern(t.lower())
-                    #print self.pattern
-                    self.searchfunc = self.search_text
-
-                sti = self.VALID
-                rok = True
-            except re.error:
-                self.regex = None
-                sti = self.INVALID
-                rok = False
+        except re.error:
+            sti = self.INVALID
+            rok = False
 
         self.set_status_icon(sti)
 
@@ -171,17 +167,45 @@ class FilterEntry():
 
 
 class AuthorFilterEntry(FilterEntry):
+    """Поле ввода имени автора - с флажком нечёткого поиска (см.
+    SearchPattern): с опечатками, в другой транслитерации и т.п.
+
+    onfuzzytoggled - None или функция без параметров, вызываемая при
+              переключении флажка нечёткого поиска."""
+
+    def __init__(self, grid, rowlabel):
+        super().__init__(grid, rowlabel)
+
+        self.onfuzzytoggled = None
+
+        self.chkfuzzy = Gtk.CheckButton(u'≈')
+        self.chkfuzzy.set_tooltip_text(u'Нечёткий поиск: имена с опечатками, в другой транслитерации, с инициалами')
+        self.chkfuzzy.connect('toggled', self.chkfuzzy_toggled)
+        grid.append_col(self.chkfuzzy)
+
+    def chkfuzzy_toggled(self, cb, data=None):
+        self.fuzzy = self.chkfuzzy.get_active()
+
+        # нечёткий образец - не регулярное выражение
+        self.chkisregexp.set_sensitive(not self.fuzzy)
+
+        if callable(self.onfuzzytoggled):
+            self.onfuzzytoggled()
+
+        self.pattern_changed()
+
     def filter_pattern(self, s):
         """Для поля ввода имени автора - удаление некоторых нежелательных
         символов."""
 
-        return ''.join(filter(lambda c: c not in ',;', s))
+        return filter_author_pattern(s)
 
 
 class DateChooser():
     def __init__(self, labtxt):
         self.date = None
         self.oncheckboxtoggled = None
+        self.onchanged = None # функция без параметров, вызываемая при выборе даты или переключении флажка
 
         self.container = Gtk.HBox(spacing=WIDGET_SPACING)
 
@@ -248,6 +272,9 @@ class DateChooser():
         if callable(self.oncheckboxtoggled):
             self.oncheckboxtoggled()
 
+        if callable(self.onchanged):
+            self.onchanged()
+
     def day_selected(self, cln, data=None):
         d, m, y = self.calendar.get_date()
         # вынимание - месяц тут от 0!
@@ -255,10 +282,473 @@ class DateChooser():
         self.display.set_text(self.date.strftime(DATE_FORMAT))
         self.chooserwnd.hide()
 
+        if cln is not None and callable(self.onchanged):
+            self.onchanged()
+
     def drop_chooser(self, btn, data=None):
         self.chooserwnd.show_all()
 
 
+class GenreChooser():
+    """Выбор жанров (тэгов) для поиска: жанры, которые у книги должны
+    быть (любой или все из отмеченных), и жанры, которых быть не должно.
+
+    container - виджет для размещения в окне;
+    include, exclude - множества тэгов (строк) для BookQuery;
+    matchall - True, если у книги должны быть все отмеченные жанры;
+    onchanged - None или функция без параметров, вызываемая при
+              изменении выбора."""
+
+    INCLUDE, EXCLUDE, TAGNAME, DISPNAME = range(4)
+
+    def __init__(self, grid, rowlabel):
+        """grid - экземпляр LabeledGrid,
+        rowlabel - самый левый виджет в строке grid, в которую пихаем остальное."""
+
+        self.include = set()
+        self.exclude = set()
+        self.matchall = False
+        self.onchanged = None
+
+        self.container = Gtk.HBox(spacing=WIDGET_SPACING)
+        grid.append_col(self.container, True)
+
+        self.display = Gtk.Label()
+        self.display.set_alignment(0.0, 0.5)
+        self.display.set_ellipsize(Pango.EllipsizeMode.END)
+        self.container.pack_start(self.display, True, True, 0)
+
+        self.dropbtn = Gtk.Button('...')
+        set_widget_style(self.dropbtn, b'GtkWidget { padding:4pt }')
+        self.dropbtn.connect('clicked', lambda b: self.chooserwnd.show_all())
+        self.container.pack_end(self.dropbtn, False, False, 0)
+
+        rowlabel.set_mnemonic_widget(self.dropbtn)
+
+        self.chooserwnd = Gtk.Popover.new(self.dropbtn)
+        self.chooserwnd.set_transitions_enabled(False)
+
+        cwvbox = Gtk.VBox(spacing=WIDGET_SPACING)
+        cwvbox.set_border_width(WIDGET_SPACING)
+        self.chooserwnd.add(cwvbox)
+
+        self.listview, self.liststore, scwindow, renderers = create_listview(
+            (GObject.TYPE_BOOLEAN, GObject.TYPE_BOOLEAN, GObject.TYPE_STRING, GObject.TYPE_STRING),
+            ((u'Да', self.INCLUDE, True, False, 0), (u'Нет', self.EXCLUDE, True, False, 0),
+            (u'Жанр', self.DISPNAME, False, True, 0)))
+        scwindow.set_size_request(WIDGET_SPACING * 80, WIDGET_SPACING * 60)
+        self.listview.set_tooltip_column(self.TAGNAME)
+        self.listview.set_search_column(self.DISPNAME)
+        cwvbox.pack_start(scwindow, True, True, 0)
+
+        renderers[0].connect('toggled', self.genre_toggled, self.INCLUDE, self.EXCLUDE)
+        renderers[1].connect('toggled', self.genre_toggled, self.EXCLUDE, self.INCLUDE)
+
+        hbox = Gtk.HBox(spacing=WIDGET_SPACING)
+        cwvbox.pack_end(hbox, False, False, 0)
+
+        self.rbtnany = Gtk.RadioButton.new_with_label(None, u'любой из отмеченных')
+        hbox.pack_start(self.rbtnany, False, False, 0)
+
+        self.rbtnall = Gtk.RadioButton.new_with_label_from_widget(self.rbtnany, u'все отмеченные')
+        self.rbtnall.connect('toggled', self.matchall_toggled)
+        hbox.pack_start(self.rbtnall, False, False, 0)
+
+        btnclear = Gtk.Button.new_from_stock(Gtk.STOCK_CLEAR)
+        btnclear.connect('clicked', lambda b: self.reset())
+        hbox.pack_end(btnclear, False, False, 0)
+
+        self.update_display()
+
+    def set_genres(self, lib):
+        """Заполнение списка жанров тэгами библиотеки lib (экземпляра
+        Library). Отмеченное раньше остаётся отмеченным, если такие
+        тэги в библиотеке есть."""
+
+        tags = {lib.tags[tid]:lib.tag_display_name(tid) for tid in lib.tags}
+
+        self.include &= set(tags)
+        self.exclude &= set(tags)
+
+        self.listview.set_model(None)
+        self.liststore.clear()
+
+        for tag, dispname in sorted(tags.items(), key=lambda r: r[1].lower()):
+            self.liststore.append((tag in self.include, tag in self.exclude, tag, dispname))
+
+        self.listview.set_model(self.liststore)
+
+        self.update_display()
+
+    def genre_toggled(self, crt, path, col, othercol):
+        itr = self.liststore.get_iter(path)
+        tag = self.liststore.get_value(itr, self.TAGNAME)
+
+        v = not self.liststore.get_value(itr, col)
+        self.liststore.set_value(itr, col, v)
+
+        # жанр не может быть и нужным, и ненужным
+        if v:
+            self.liststore.set_value(itr, othercol, False)
+
+        self.include.discard(tag)
+        self.exclude.discard(tag)
+
+        if v:
+            (self.include if col == self.INCLUDE else self.exclude).add(tag)
+
+        self.selection_changed()
+
+    def matchall_toggled(self, rbtn, data=None):
+        self.matchall = self.rbtnall.get_active()
+
+        if self.include:
+            self.selection_changed()
+
+    def reset(self):
+        """Сброс выбора."""
+
+        if not self.include and not self.exclude:
+            return
+
+        self.include.clear()
+        self.exclude.clear()
+
+        itr = self.liststore.get_iter_first()
+        while itr:
+            self.liststore.set(itr, self.INCLUDE, False, self.EXCLUDE, False)
+            itr = self.liststore.iter_next(itr)
+
+        self.selection_changed()
+
+    def selection_changed(self):
+        self.update_display()
+
+        if callable(self.onchanged):
+            self.onchanged()
+
+    def update_display(self):
+        names = {}
+
+        itr = self.liststore.get_iter_first()
+        while itr:
+            names[self.liststore.get_value(itr, self.TAGNAME)] = self.liststore.get_value(itr, self.DISPNAME)
+            itr = self.liststore.iter_next(itr)
+
+        def _names(tags):
+            return u', '.join(sorted(names.get(tag, tag) for tag in tags))
+
+        s = []
+        if self.include:
+            s.append(u'%s: %s' % (u'все из' if self.matchall and len(self.include) > 1 else u'любой из', _names(self.include)))
+        if self.exclude:
+            s.append(u'кроме: %s' % _names(self.exclude))
+
+        s = u'; '.join(s) if s else u'любые'
+
+        self.display.set_text(s)
+        self.display.set_tooltip_text(s)
+
+    def query_args(self):
+        """Возвращает словарь параметров BookQuery для отбора по жанрам."""
+
+        return {'genres':frozenset(self.include), 'exclgenres':frozenset(self.exclude),
+            'allgenres':self.matchall}
+
+    def is_empty(self):
+        return not self.include and not self.exclude
+
+
+class FacetPanel():
+    """Панель фасет - сколько найденных книг каких жанров, языков, форматов
+    и годов добавления в библиотеку (см. Library.book_facets).
+    Щелчок по значению фасеты сужает список найденного до книг с этим
+    значением (по одному значению на фасету), повторный щелчок - отменяет.
+
+    container - виджет для размещения в окне;
+    selection - словарь выбранных значений для Library.filter_facets;
+    onchanged - None или функция без параметров, вызываемая при
+              изменении выбора щелчком."""
+
+    DISPNAME, COUNT, FACET, VALUE = range(4)
+
+    # имена фасет для отображения, в порядке отображения
+    FACET_NAMES = (('genre', u'Жанры'), ('lang', u'Языки'), ('format', u'Форматы'), ('year', u'Год добавления'))
+
+    def __init__(self):
+        self.selection = {}
+        self.onchanged = None
+
+        self.collapsed = set() # свёрнутые пользователем фасеты
+
+        self.container = Gtk.VBox(spacing=WIDGET_SPACING)
+        self.container.set_size_request(WIDGET_SPACING * 40, -1)
+
+        hbox = Gtk.HBox(spacing=WIDGET_SPACING)
+        self.container.pack_start(hbox, False, False, 0)
+
+        rowlabel = Gtk.Label(u'_7. Уточнить:')
+        rowlabel.set_use_underline(True)
+        hbox.pack_start(rowlabel, False, False, 0)
+
+        self.btnclear = Gtk.Button.new_from_icon_name('edit-clear', Gtk.IconSize.SMALL_TOOLBAR)
+        self.btnclear.set_tooltip_text(u'Показать всё найденное')
+        self.btnclear.connect('clicked', lambda b: self.selection_changed(True))
+        hbox.pack_end(self.btnclear, False, False, 0)
+
+        self.store = Gtk.TreeStore(GObject.TYPE_STRING, GObject.TYPE_STRING,
+            GObject.TYPE_STRING, GObject.TYPE_PYOBJECT)
+
+        self.view = Gtk.TreeView(self.store)
+        self.view.set_headers_visible(False)
+        self.view.set_activate_on_single_click(True)
+        self.view.set_tooltip_column(self.DISPNAME)
+        rowlabel.set_mnemonic_widget(self.view)
+
+        crt = Gtk.CellRendererText()
+        crt.props.ellipsize = Pango.EllipsizeMode.END
+        col = Gtk.TreeViewColumn(u'Значение', crt)
+        col.add_attribute(crt, 'markup', self.DISPNAME)
+        col.set_expand(True)
+        self.view.append_column(col)
+
+        crt = Gtk.CellRendererText()
+        crt.props.xalign = 1.0
+        self.view.append_column(Gtk.TreeViewColumn(u'Книг', crt, text=self.COUNT))
+
+        self.view.connect('row-activated', self.row_activated)
+        self.view.connect('row-expanded', self.row_expanded, False)
+        self.view.connect('row-collapsed', self.row_expanded, True)
+
+        scwindow = create_scwindow()
+        scwindow.add(self.view)
+        self.container.pack_start(scwindow, True, True, 0)
+
+        self.btnclear.set_sensitive(False)
+
+    def set_facets(self, lib, facets):
+        """Заполнение панели.
+        lib     - экземпляр Library (для названий жанров),
+        facets  - словарь, полученный от Library.book_facets, или пустой
+                  словарь, если ничего не найдено.
+        Выбранные значения показываются, даже если их нет в facets."""
+
+        self.view.set_model(None)
+        self.store.clear()
+
+        for facet, facetname in self.FACET_NAMES:
+            counts = dict(facets.get(facet, {}))
+
+            selected = self.selection.get(facet)
+            if selected is not None:
+                counts.setdefault(selected, 0)
+
+            if not counts:
+                continue
+
+            if facet == 'year':
+                # новые - сверху
+                values = sorted(counts, reverse=True)
+            else:
+                values = sorted(counts, key=lambda v: (-counts[v], v))
+
+            fitr = self.store.append(None, (u'<b>%s</b>' % facetname, str(len(values)), facet, None))
+
+            for value in values:
+                if facet == 'genre':
+                    dispname = lib.tag_display_name(lib.tags.get_id(value))
+                elif facet == 'format':
+                    dispname = value.upper() if value else u'?'
+                else:
+                    dispname = str(value) if value else u'?'
+
+                dispname = GLib.markup_escape_text(dispname)
+                if value == selected:
+                    dispname = u'<b>✔ %s</b>' % dispname
+
+                self.store.append(fitr, (dispname, str(counts[value]), facet, value))
+
+        self.view.set_model(self.store)
+
+        itr = self.store.get_iter_first()
+        while itr:
+            if self.store.get_value(itr, self.FACET) not in self.collapsed:
+                self.view.expand_row(self.store.get_path(itr), False)
+
+            itr = self.store.iter_next(itr)
+
+        self.btnclear.set_sensitive(bool(self.selection))
+
+    def row_activated(self, view, path, col):
+        itr = self.store.get_iter(path)
+        facet = self.store.get_value(itr, self.FACET)
+        value = self.store.get_value(itr, self.VALUE)
+
+        if self.store.iter_parent(itr) is None:
+            # строка с названием фасеты
+            if view.row_expanded(path):
+                view.collapse_row(path)
+            else:
+                view.expand_row(path, False)
+            return
+
+        if self.selection.get(facet) == value:
+            del self.selection[facet]
+        else:
+            self.selection[facet] = value
+
+        self.selection_changed()
+
+    def row_expanded(self, view, itr, path, collapsed):
+        if self.store.iter_parent(itr) is not None:
+            return
+
+        facet = self.store.get_value(itr, self.FACET)
+
+        if collapsed:
+            self.collapsed.add(facet)
+        else:
+            self.collapsed.discard(facet)
+
+    def selection_changed(self, reset=False):
+        if reset:
+            if not self.selection:
+                return
+
+            self.selection.clear()
+
+        if callable(self.onchanged):
+            self.onchanged()
+
+    def reset(self):
+        """Сброс выбора (без вызова onchanged)."""
+
+        self.selection.clear()
+        self.btnclear.set_sensitive(False)
+
+
+class BookListModel(GObject.GObject, Gtk.TreeModel):
+    """Модель списка найденных книг для Gtk.TreeView.
+    В отличие от Gtk.ListStore, не хранит значения всех ячеек всех строк,
+    а только последовательность bookid; значения столбцов строки (см.
+    MainWnd.COL_*) получаются функцией renderfunc, только когда их
+    запрашивает TreeView (т.е. для видимых строк), и держатся в кэше
+    недавно отображённых строк. Так что создание модели для списка
+    любой длины занимает постоянное время.
+
+    bookids     - последовательность bookid (строки списка);
+    renderfunc  - функция, получающая bookid и возвращающая кортеж
+                  значений всех столбцов (типов COLUMN_TYPES)."""
+
+    COLUMN_TYPES = (GObject.TYPE_INT64, # bookid
+        GObject.TYPE_STRING, # author
+        GObject.TYPE_STRING, # title
+        GObject.TYPE_STRING, # series
+        GObject.TYPE_STRING, # serno
+        GObject.TYPE_STRING, # genres
+        GObject.TYPE_STRING, # size
+        GObject.TYPE_STRING, # format
+        GObject.TYPE_STRING) # date
+
+    # сколько отображённых строк держать в кэше (видно обычно несколько десятков)
+    CACHE_ROWS = 256
+
+    # для Gtk.TreeIter.stamp - у каждой модели свой, чтобы итераторы
+    # одной модели не принимались другой
+    __stamps = itertools.count(1)
+
+    def __init__(self, bookids=(), renderfunc=None):
+        GObject.GObject.__init__(self)
+
+        self.bookids = bookids
+        self.renderfunc = renderfunc
+        self.cache = LRUCache(self.CACHE_ROWS)
+        self.stamp = next(self.__stamps)
+
+    def __len__(self):
+        return len(self.bookids)
+
+    def get_row_values(self, ix):
+        """Возвращает кортеж значений столбцов строки ix."""
+
+        values = self.cache.get(ix)
+        if values is None:
+            values = self.renderfunc(self.bookids[ix])
+            self.cache.put(ix, values)
+
+        return values
+
+    def __new_iter(self, ix):
+        itr = Gtk.TreeIter()
+        itr.stamp = self.stamp
+        itr.user_data = ix
+
+        return itr
+
+    #
+    # методы Gtk.TreeModel; строки - без потомков, итератор хранит номер строки
+    #
+    def do_get_flags(self):
+        return Gtk.TreeModelFlags.LIST_ONLY | Gtk.TreeModelFlags.ITERS_PERSIST
+
+    def do_get_n_columns(self):
+        return len(self.COLUMN_TYPES)
+
+    def do_get_column_type(self, col):
+        return self.COLUMN_TYPES[col]
+
+    def do_get_iter(self, path):
+        indices = path.get_indices()
+
+        if len(indices) == 1 and 0 <= indices[0] < len(self.bookids):
+            return (True, self.__new_iter(indices[0]))
+
+        return (False, None)
+
+    def do_get_path(self, itr):
+        return Gtk.TreePath((itr.user_data,))
+
+    def do_get_value(self, itr, col):
+        return self.get_row_values(itr.user_data)[col]
+
+    def do_iter_next(self, itr):
+        ix = itr.user_data + 1
+        if ix >= len(self.bookids):
+            return False
+
+        itr.user_data = ix
+        return True
+
+    def do_iter_previous(self, itr):
+        ix = itr.user_data - 1
+        if ix < 0:
+            return False
+
+        itr.user_data = ix
+        return True
+
+    def do_iter_children(self, parent):
+        if parent is None and self.bookids:
+            return (True, self.__new_iter(0))
+
+        return (False, None)
+
+    def do_iter_has_child(self, itr):
+        return False
+
+    def do_iter_n_children(self, itr):
+        return len(self.bookids) if itr is None else 0
+
+    def do_iter_nth_child(self, parent, n):
+        if parent is None and 0 <= n < len(self.bookids):
+            return (True, self.__new_iter(n))
+
+        return (False, None)
+
+    def do_iter_parent(self, child):
+        return (False, None)
+
+
 class MainWndSettings(Settings):
     WINDOW_X = 'window.x'
     WINDOW_Y = 'window.y'
@@ -281,22 +771,75 @@ class MainWndSettings(Settings):
     FILTER_SERIES_REGEXP = FILTER_IS_REGEXP % FILTER_SERIES
     FILTER_FNAMES_REGEXP = FILTER_IS_REGEXP % FILTER_FNAMES
 
+    SEARCH_LIVE = 'search.live'
+
+    FILTER_AUTHOR_FUZZY = 'filter.author.fuzzy'
+
+    LAST_VISIT = 'library.last_visit' # дата предыдущего запуска (ГГГГ-ММ-ДД)
+
+    BOOKLIST_SORT = 'booklist.sort' # порядок сортировки списка книг (см. Library.SORT_ORDERS)
+    BOOKLIST_SORT_REVERSE = 'booklist.sort.reverse'
+
     VALID_KEYS = {WINDOW_X:int, WINDOW_Y:int, WINDOW_W:int, WINDOW_H:int, WINDOW_MAX:bool,
         EXTRACT_FNAME_TEMPLATE:str, EXTRACT_PACK:bool,
         FILTER_AUTHOR_REGEXP:bool, FILTER_TITLE_REGEXP:bool, FILTER_SERIES_REGEXP:bool,
-        FILTER_FNAMES_REGEXP:bool}
+        FILTER_FNAMES_REGEXP:bool, SEARCH_LIVE:bool, LAST_VISIT:str, FILTER_AUTHOR_FUZZY:bool,
+        BOOKLIST_SORT:str, BOOKLIST_SORT_REVERSE:bool}
 
     DEFAULTS = {WINDOW_X:None, WINDOW_Y:None, WINDOW_W:800, WINDOW_H:600, WINDOW_MAX:False,
         EXTRACT_FNAME_TEMPLATE:'', EXTRACT_PACK:False,
         FILTER_AUTHOR_REGEXP:False, FILTER_TITLE_REGEXP:False, FILTER_SERIES_REGEXP:False,
-        FILTER_FNAMES_REGEXP:False}
+        FILTER_FNAMES_REGEXP:False, SEARCH_LIVE:True, LAST_VISIT:'', FILTER_AUTHOR_FUZZY:False,
+        BOOKLIST_SORT:Library.SORT_DEFAULT, BOOKLIST_SORT_REVERSE:False}
+
+
+class SearchJob():
+    """Поиск при вводе, выполняемый в фоновом потоке (см. MainWnd.live_search).
+
+    library     - экземпляр Library, по которому ищем;
+    patterns    - словарь образцов (см. MainWnd.search_patterns);
+    filters     - словарь прочих параметров BookQuery (см. MainWnd.search_filters);
+    within      - None или список bookid, среди которых ищем (см. Library.search_books);
+    partial     - True, если библиотека ещё загружается;
+    listsort    - порядок сортировки найденного (см. MainWnd.set_book_list_sort);
+    cancel      - threading.Event, установка которого прерывает поиск."""
+
+    def __init__(self, library, patterns, filters, within, partial, listsort):
+        self.library = library
+        self.patterns = patterns
+        self.filters = filters
+        self.within = within
+        self.partial = partial
+        self.listsort = listsort
+        self.cancel = threading.Event()
+
+    def run(self):
+        """Поиск. Возвращает отсортированный (в порядке listsort) список
+        или array bookid, или None, если поиск прерван."""
+
+        found = self.library.find_books(BookQuery(self.patterns, **self.filters), within=self.within, cancel=self.cancel)
+
+        # пересортировка - тоже здесь, а не в главном цикле
+        if found is not None and self.listsort != MainWnd.DEFAULT_SORT:
+            found = self.library.sort_books(found, *self.listsort)
+
+        return found
 
 
 class MainWnd():
     """Основное междумордие"""
 
+    # задержка поиска при вводе (в миллисекундах) - ищем, когда ввод приостановился
+    LIVE_SEARCH_DELAY = 300
+
+    # сколько книг показывать в "последних поступлениях"
+    NEWEST_BOOKS = 200
+
     COL_BOOKID, COL_AUTHOR, COL_TITLE, COL_SERIES, COL_SERNO, COL_GENRES, COL_SIZE, COL_FORMAT, COL_DATE = range(9)
 
+    # порядок сортировки найденного по умолчанию (см. Library.find_books)
+    DEFAULT_SORT = (Library.SORT_DEFAULT, False)
+
     COLID_TO_TTCOLID = {COL_AUTHOR:COL_AUTHOR,
         COL_TITLE:COL_TITLE,
         COL_SERIES:COL_SERIES,
@@ -306,6 +849,15 @@ class MainWnd():
         COL_FORMAT:COL_FORMAT,
         COL_DATE:COL_GENRES}
 
+    # порядки сортировки (см. Library.SORT_ORDERS) по щелчку на заголовке столбца
+    COLID_TO_SORT = {COL_AUTHOR:'author',
+        COL_TITLE:'title',
+        COL_SERIES:'series',
+        COL_SERNO:'series',
+        COL_SIZE:'size',
+        COL_FORMAT:'format',
+        COL_DATE:'date'}
+
     def load_ui_state(self):
         self.uistate.load()
 
@@ -328,6 +880,23 @@ class MainWnd():
         for fevname in self.filters.keys():
             self.filters[fevname].chkisregexp.set_active(self.uistate.get_value(self.uistate.FILTER_IS_REGEXP % fevname))
 
+        self.fltrauthorentry.chkfuzzy.set_active(self.uistate.get_value(self.uistate.FILTER_AUTHOR_FUZZY))
+
+        self.chklivesearch.set_active(self.uistate.get_value(self.uistate.SEARCH_LIVE))
+
+        # дата предыдущего запуска - для отбора поступивших с тех пор книг
+        try:
+            self.lastvisit = datetime.datetime.strptime(self.uistate.get_value(self.uistate.LAST_VISIT), '%Y-%m-%d').date()
+        except ValueError:
+            self.lastvisit = None
+
+        self.mnuitemsincelastvisit.set_sensitive(self.lastvisit is not None)
+
+        # сортировка списка книг
+        order = self.uistate.get_value(self.uistate.BOOKLIST_SORT)
+        if order in Library.SORT_ORDERS:
+            self.set_book_list_sort(order, self.uistate.get_value(self.uistate.BOOKLIST_SORT_REVERSE))
+
         # загружаем шаблоны имени файла
         self.load_book_fn_templates()
 
@@ -360,6 +929,14 @@ class MainWnd():
             for fevname in self.filters.keys():
                 self.uistate.cfg[self.uistate.FILTER_IS_REGEXP % fevname] = self.filters[fevname].chkisregexp.get_active()
 
+            self.uistate.cfg[self.uistate.FILTER_AUTHOR_FUZZY] = self.fltrauthorentry.chkfuzzy.get_active()
+
+            self.uistate.cfg[self.uistate.SEARCH_LIVE] = self.chklivesearch.get_active()
+
+            self.uistate.cfg[self.uistate.LAST_VISIT] = datetime.date.today().isoformat()
+
+            self.uistate.cfg[self.uistate.BOOKLIST_SORT], self.uistate.cfg[self.uistate.BOOKLIST_SORT_REVERSE] = self.booklistsort
+
     def save_ui_state(self):
         #print(self.uistate.cfg)
 
@@ -434,114 +1011,229 @@ class MainWnd():
         self.save_ui_state()
         Gtk.main_quit()
 
-    def update_book_list(self, lstbookids=[]):
+    def update_book_list(self, lstbookids=[], ready=False, listsort=DEFAULT_SORT):
         """Заполнение TreeView отсортированным списком найденных книг
-        (если список не пуст.)"""
+        (если список не пуст.)
+        ready       - True, если lstbookids уже отобран по дате и отсортирован
+                      (см. Library.find_books);
+        listsort    - если ready=True - в каком порядке (кортеж из параметров
+                      order и reverse Library.sort_books); если не в выбранном
+                      для списка книг (см. set_book_list_sort) - пересортировывается.
+        Если в панели фасет выбраны значения - показываются только книги
+        с ними (см. facets_changed). Фасеты длинного списка считаются
+        по частям уже после его отображения (см. facets_count)."""
 
         #print u'update_book_list: start'
 
-        self.booklist.clear()
-
-        def book_sort_key(bookid):
-            bnfo = library.books[bookid]
-
-            # порядок сортировки: цикл, номер в цикле, автор, название
-
-            #print('series: %s, serno: %s, aname: %s, title: %s' % (type(library.get_series_name(bnfo.series)),
-            #    type(bnfo.serno), type(library.authors[bnfo.authorid].aname), type(bnfo.title)))
-
-            return (u'%s%.5d%s%s' % (library.get_series_name(bnfo.series), bnfo.serno,
-                library.authors[bnfo.authorid].aname, bnfo.title)).upper()
+        lib = self.current_library()
 
         #print u'update_book_list: sort and update'
         #print(type(lstbookids))
 
         now = datetime.datetime.now().date()
 
-        filterbymindate = self.mindatechooser.checkbox.get_active()
-        filtermindate = self.mindatechooser.date
-        filterbymaxdate = self.maxdatechooser.checkbox.get_active()
-        filtermaxdate = self.maxdatechooser.date
+        nfound = 0
 
         if lstbookids:
-            self.booklistview.set_model(None)
+            # библиотека может в это время загружаться в фоне
+            with lib.lock:
+                if not ready:
+                    lstbookids = lib.sort_books(lib.filter_dates(lstbookids, *self.search_dates()), *self.booklistsort)
+                elif listsort != self.booklistsort:
+                    lstbookids = lib.sort_books(lstbookids, *self.booklistsort)
 
-            # т.к. в пыхтоне 3 cmp оторвато, сортируем через жопу:
-            # 1. создаём временный список из кортежей (bookid, 'нормализованная строка сортировки')
-            # 2. сортируем временный список
-            # 3. забираем из него взад bookids
+                self.foundbookids = lstbookids
+                nfound = len(lstbookids)
 
-            for bookid, _tmpkey in sorted(map(lambda bookid: (bookid, book_sort_key(bookid)), lstbookids), key=lambda r: r[1]):
-                bnfo = library.books[bookid]
+                lstbookids = lib.filter_facets(lstbookids, self.facetpanel.selection)
+        else:
+            self.foundbookids = []
+            lstbookids = []
 
-                # вот тут - вкрячиваем фильтрацию по дате
-                # по уму надо бы ее вставлять в основную фильтрацию, но тогда придется громоздить костыли в ф-и случайного выбора
-                if filterbymindate:
-                    if bnfo.date < filtermindate:
-                        continue
+        self.facets_count(lib, lstbookids)
 
-                    if filterbymaxdate:
-                        if bnfo.date > filtermaxdate:
-                            continue
+        # строки отображаются по мере надобности (см. BookListModel)
+        self.booklist = BookListModel(lstbookids, lambda bookid: self.book_row(lib, now, bookid))
+        self.booklistview.set_model(self.booklist)
+        self.booklistview.set_search_column(self.COL_TITLE)
+        self.booklistcount = len(lstbookids)
+
+        #print u'update_book_list: finalize'
+        if nfound != self.booklistcount:
+            self.labbookcount.set_label(u'%d из %d' % (self.booklistcount, nfound))
+        else:
+            self.labbookcount.set_label(u'%d' % self.booklistcount)
+
+        self.btnrandomchoicefnd.set_sensitive(self.booklistcount != 0)
+
+        self.update_book_panel()
 
-                # COL_BOOKID, COL_AUTHOR, COL_TITLE, COL_SERIES, COL_SERNO, COL_GENRES, COL_SIZE, COL_FORMAT, COL_DATE
+    def book_row(self, lib, now, bookid):
+        """Возвращает кортеж значений столбцов списка книг (см. BookListModel)
+        для книги bookid из библиотеки lib; now - текущая дата (для цвета
+        возраста книги)."""
 
-                self.booklist.append((bnfo.bookid, library.authors[bnfo.authorid].aname, bnfo.title,
-                    library.get_series_name(bnfo.series),
-                    str(bnfo.serno) if bnfo.serno else u'',
-                    library.get_book_tags(bnfo),
-                    kilobytes_str(bnfo.fsize),
-                    '?' if not bnfo.format else bnfo.format.upper(),
-                    u'%s <span color="%s">●</span>' % (bnfo.date.strftime(DATE_FORMAT), get_book_age_color(now, bnfo.date))))
+        with lib.lock:
+            bnfo = lib.books.get(bookid)
 
-            self.booklistview.set_model(self.booklist)
-            self.booklistview.set_search_column(2)
-            self.booklistcount = len(lstbookids)
+            if bnfo is None:
+                # библиотеку перезагрузили, а в списке - найденное в старой
+                return (bookid, u'?', u'?', u'', u'', u'', u'', u'?', u'')
+
+            # COL_BOOKID, COL_AUTHOR, COL_TITLE, COL_SERIES, COL_SERNO, COL_GENRES, COL_SIZE, COL_FORMAT, COL_DATE
+
+            return (bnfo.bookid, lib.authors[bnfo.authorid].aname, bnfo.title,
+                lib.get_series_name(bnfo.series),
+                str(bnfo.serno) if bnfo.serno else u'',
+                lib.get_book_tags(bnfo),
+                kilobytes_str(bnfo.fsize),
+                '?' if not bnfo.format else bnfo.format.upper(),
+                self.date_cell(now, bnfo.dateord))
+
+    def date_cell(self, now, dateord):
+        """Возвращает строку для столбца "Дата" списка книг - дату
+        dateord (порядковый номер дня) и значок её "свежести" относительно
+        текущей даты now (см. get_book_age_color).
+        Строки запоминаются для каждой даты (дат намного меньше, чем книг),
+        пока не сменится текущая."""
+
+        if now != self.datecellsnow:
+            self.datecells = {}
+            self.datecellsnow = now
+
+        s = self.datecells.get(dateord)
+        if s is None:
+            s = self.datecells[dateord] = u'%s <span color="%s">●</span>' % (datetime.date.fromordinal(dateord).strftime(DATE_FORMAT),
+                get_book_age_color_days(now.toordinal() - dateord))
+
+        return s
+
+    def facets_changed(self):
+        """Изменился выбор в панели фасет - сужение (или расширение)
+        списка книг без повторного поиска."""
+
+        self.update_book_list(self.foundbookids, True, self.booklistsort)
+
+    # подсчёт фасет длинного списка (см. facets_count) - по FACETS_CHUNK
+    # книг, не дольше FACETS_SLICE секунд за вызов из главного цикла
+    FACETS_CHUNK = 10000
+    FACETS_SLICE = 0.02
+
+    def facets_count(self, lib, bookids):
+        """Подсчёт книг из списка bookids по фасетам (см. FacetCounter)
+        и заполнение панели фасет. Короткий список считается сразу,
+        длинный - по частям в главном цикле (см. facets_count_step), так
+        что список книг отображается, не дожидаясь подсчёта, и окно не
+        замирает; до конца подсчёта панель фасет недоступна.
+        Новый подсчёт (напр. после следующего поиска) прерывает
+        незаконченный."""
+
+        self.facets_cancel()
+
+        counter = FacetCounter(lib)
+
+        if len(bookids) <= self.FACETS_CHUNK:
+            counter.add(bookids)
+            self.facetpanel.set_facets(lib, counter.facets())
         else:
-            self.booklistcount = 0
+            self.facetpanel.container.set_sensitive(False)
+            self.facetsjob = GLib.idle_add(self.facets_count_step, lib, counter, bookids,
+                iter(range(0, len(bookids), self.FACETS_CHUNK)))
 
-        #print u'update_book_list: finalize'
-        self.labbookcount.set_label(u'%d' % self.booklistcount)
+    def facets_count_step(self, lib, counter, bookids, chunks):
+        """Подсчёт очередных частей списка bookids (вызывается из главного
+        цикла, см. facets_count); chunks - итератор смещений частей."""
 
-        self.btnrandomchoicefnd.set_sensitive(self.booklistcount != 0)
+        t0 = time()
 
-        self.update_book_panel()
+        for start in chunks:
+            counter.add(bookids[start:start + self.FACETS_CHUNK])
+
+            if time() - t0 >= self.FACETS_SLICE:
+                return True
+
+        self.facetsjob = None
+        self.facetpanel.set_facets(lib, counter.facets())
+        self.facetpanel.container.set_sensitive(True)
+
+        return False
+
+    def facets_cancel(self):
+        """Прерывание незаконченного подсчёта фасет (см. facets_count)."""
+
+        if self.facetsjob is not None:
+            GLib.source_remove(self.facetsjob)
+            self.facetsjob = None
+            self.facetpanel.container.set_sensitive(True)
+
+    def set_book_list_sort(self, order, reverse=False):
+        """Выбор порядка сортировки списка книг (см. Library.sort_books)
+        и отображение его в заголовках столбцов. Сам список не трогает."""
+
+        self.booklistsort = (order, reverse)
+
+        for col, ix in self.colrefs.items():
+            col.set_sort_indicator(self.COLID_TO_SORT.get(ix) == order)
+            col.set_sort_order(Gtk.SortType.DESCENDING if reverse else Gtk.SortType.ASCENDING)
+
+    def booklist_column_clicked(self, col, order):
+        """Щелчок по заголовку столбца - сортировка найденного в порядке
+        order (см. Library.SORT_ORDERS); повторный щелчок - в обратном.
+        Не ищется заново: пересортировка по местам книг в общем порядке
+        (см. Library.build_sort_ranks) - линейная."""
+
+        oldsort = self.booklistsort
+
+        self.set_book_list_sort(order, not oldsort[1] if oldsort[0] == order else False)
+        self.update_book_list(self.foundbookids, True, oldsort)
 
     def update_book_panel(self):
         """Обновление содержимого панели информации о выбранной в списке
         книги. Подробная информация (на текущий момент - только список
         жанров, ибо индекс от MyHomeLib ничего особо полезного не содержит)
         отображается только в случае, если выбрана _одна_ книга,
-        иначе показываем только кол-во выбранных книг."""
+        иначе показываем только кол-во выбранных книг.
+        Книги, которых в библиотеке нет (напр. выбранные во время загрузки
+        и выкинутые загруженным индексом), из выбранных убираются."""
 
         if self.bookids:
             #bnfo = library.authors[self.aid].books[self.bookid]
             #btt = u'%s:%s' % (library.bundles[bnfo.bundle], bnfo.filename)
 
-            bcnt = len(self.bookids)
+            lib = self.current_library()
 
             tags = set()
-            for bookid in self.bookids:
-                tags.update(library.books[bookid].tags)
+            with lib.lock:
+                bnfos = list(filter(None, map(lib.books.get, self.bookids)))
+                if len(bnfos) != len(self.bookids):
+                    self.bookids = [bnfo.bookid for bnfo in bnfos]
+
+                for bnfo in bnfos:
+                    tags.update(bnfo.tags)
+
+            bcnt = len(self.bookids)
 
-            bupk = True
+            bupk = bcnt > 0
         else:
             bcnt = 0
             bupk = False
 
         self.selbookcount.set_text(str(bcnt) if bcnt else u'ни одной')
 
-        for widget in (self.bookextractbtn, self.mnuitemextract,
-                       self.mnuitemfoundauthortosearch, self.mnuitemfoundtitletosearch, self.mnuitemfoundseriestosearch):
+        for widget in (self.mnuitemfoundauthortosearch, self.mnuitemfoundtitletosearch, self.mnuitemfoundseriestosearch):
             widget.set_sensitive(bupk)
 
+        # извлекаем только из загруженной библиотеки, т.к. извлечение идёт в library
+        for widget in (self.bookextractbtn, self.mnuitemextract):
+            widget.set_sensitive(bupk and self.loadinglib is None)
+
     def blistview_selected(self, sel, data=None):
         """Обработка события выбора элемента(ов) в списке книг"""
 
         rows = self.booklistviewsel.get_selected_rows()[1]
 
         if rows:
-            self.bookids = list(map(lambda ix: self.booklist.get_value(self.booklist.get_iter(ix), 0), rows))
+            self.bookids = [self.booklist.bookids[path.get_indices()[0]] for path in rows]
         else:
             self.bookids = []
 
@@ -563,82 +1255,226 @@ class MainWnd():
     def filter_reset(self):
         """Сброс фильтра поиска"""
 
+        self.live_search_cancel()
+
         for en in self.filters.values():
             en.reset()
 
+        self.genrechooser.reset()
+        self.facetpanel.reset()
+
+        self.lastsearch = None
         self.update_book_list()
 
-    def filter_apply(self):
-        """Поиск книг фильтром"""
+    def search_patterns(self):
+        """Проверка образцов в полях поиска.
+        Возвращает кортеж из двух элементов:
+        1. словарь образцов для Library.search_books (значения - экземпляры
+           SearchPattern или None), или None, если есть неправильные образцы;
+        2. булевское значение - True, если все поля пустые."""
 
         badpat = 0 # кол-во недопустимых шаблонов
         emptypat = 0
-        totalpat = len(self.filters)
 
         for en in self.filters.values():
             if not en.validate_pattern():
                 badpat += 1
-            elif not en.pattern:
+            elif not en.searchpattern:
                 emptypat += 1
 
-        #print en.pattern #.encode('cp866') #wantuz!
+        if badpat:
+            return (None, False)
 
-        if emptypat == totalpat:
-            self.show_task(u'Не указаны образцы для поиска')
-            return
+        return ({'author':self.fltrauthorentry.searchpattern,
+            'title':self.fltrtitleentry.searchpattern,
+            'series':self.fltrseriesentry.searchpattern,
+            'filename':self.fltrfnamesentry.searchpattern}, emptypat == len(self.filters))
 
-        # запускаем фильтрацию только если нет неправильных шаблонов
-        # в остальных случаях просто ничего не делаем
-        #print 'badpat', badpat
+    def search_dates(self):
+        """Возвращает кортеж (mindate, maxdate) для отбора найденного по дате
+        (см. Library.find_books)."""
 
-        def _filterfunc(bnfo):
-            if self.fltrauthorentry.searchfunc and not self.fltrauthorentry.searchfunc(library.authors[bnfo.authorid].aname):
-                return False
+        if not self.mindatechooser.checkbox.get_active():
+            return (None, None)
 
-            if self.fltrtitleentry.searchfunc and not self.fltrtitleentry.searchfunc(bnfo.title):
-                return False
+        return (self.mindatechooser.date,
+            self.maxdatechooser.date if self.maxdatechooser.checkbox.get_active() else None)
 
-            if self.fltrseriesentry.searchfunc:
-                if not bnfo.series:
-                    if not self.fltrseriesentry.searchfunc(u''):
-                        # потому что в условиях поиска может быть регексп '.*'
-                        # и в этом случае "нет названия сериала" как бы с таким регекспом совпадает
-                        # а при поиске по простой строке пустое название правильно отбросится
-                        return False
-                elif not self.fltrseriesentry.searchfunc(library.series[bnfo.series]):
-                    return False
+    def search_filters(self):
+        """Возвращает словарь параметров BookQuery, кроме образцов:
+        отбор по дате и жанрам."""
 
-            if self.fltrfnamesentry.searchfunc and not self.fltrfnamesentry.searchfunc(bnfo.filename):
-                return False
+        ret = self.genrechooser.query_args()
+        ret['mindate'], ret['maxdate'] = self.search_dates()
 
-            return True
+        return ret
 
-        if badpat:
+    def search_within(self, patterns, filters):
+        """Возвращает список bookid, найденных предыдущим поиском, если
+        поиск по patterns - его уточнение (см. patterns_refine) с тем же
+        отбором по дате и жанрам filters, иначе None."""
+
+        if self.lastsearch is not None and filters == self.lastsearch[1] and patterns_refine(patterns, self.lastsearch[0]):
+            return self.lastsearch[2]
+
+        return None
+
+    def filter_apply(self):
+        """Поиск книг фильтром"""
+
+        self.live_search_cancel()
+
+        patterns, empty = self.search_patterns()
+
+        if empty and not BookQuery(None, **self.search_filters()):
+            self.show_task(u'Не указаны образцы для поиска')
+            return
+
+        # запускаем фильтрацию только если нет неправильных шаблонов
+        # в остальных случаях просто ничего не делаем
+        if patterns is None:
             msg_dialog(self.window, u'Поиск книг', u'Неправильный шаблон поиска')
         else:
-            self.filter_books(_filterfunc)
+            self.filter_books(patterns)
 
-    def filter_books(self, filterfunc):
-        """Подготавливает междумордие и фильтрует книги.
-        filterfunc - функция отбора (см. flibcrutch.Library.filter)."""
+    def filter_books(self, patterns):
+        """Подготавливает междумордие и ищет книги.
+        patterns - образцы поиска (см. search_patterns)."""
 
-        em = u''
+        # пока библиотека грузится - ищем по уже загруженному
+        partial = self.loadinglib is not None
+
+        filters = self.search_filters()
 
         self.begin_task(u'Поиск книг...')
         try:
-            blist = library.filter(filterfunc, self.progress_callback)
+            blist = self.current_library().find_books(BookQuery(patterns, **filters),
+                progressfunc=self.progress_callback, within=self.search_within(patterns, filters))
+        except Exception:
+            self.end_task()
+            raise
+
+        self.search_done(patterns, filters, blist, partial)
+
+    def search_done(self, patterns, filters, blist, partial, listsort=DEFAULT_SORT):
+        """Отображение найденного по образцам patterns и отобранного
+        по датам и жанрам filters списка bookid blist.
+        partial     - True, если искали по недогруженной библиотеке;
+        listsort    - порядок сортировки blist (см. update_book_list)."""
+
+        em = u''
 
-            #print(type(blist))
+        try:
             if not blist:
                 em = u'По указанным признакам ничего не нашлось'
+                self.update_book_list()
             else:
-                self.show_task(u'Сортировка...')
-                self.update_book_list(blist)
-                em = u''
+                self.update_book_list(blist, True, listsort)
+
+            if partial:
+                em = u'%s%sпоиск по загруженной части библиотеки, найдено не всё' % (em, u' - ' if em else u'')
 
         finally:
             self.end_task(em)
 
+        # по недогруженной библиотеке найдено не всё - уточнять нечего
+        self.lastsearch = (patterns, filters, blist) if not partial else None
+        self.partialsearch = partial
+
+        self.update_search_cache_stats()
+
+        if partial and self.loadinglib is None:
+            # загрузка закончилась во время поиска
+            self.library_loaded_refilter()
+
+    def update_search_cache_stats(self):
+        """Отображение статистики кэша результатов поиска (во всплывающей
+        подсказке к общему кол-ву книг)."""
+
+        stats = self.current_library().searchCache.stats()
+
+        self.labbooktotal.set_tooltip_text(u'Кэш поиска: %d из %d, %s; попаданий - %d%% (%d из %d)' % (
+            stats['items'], stats['maxitems'], kilobytes_str(stats['bytes']),
+            round(stats['hitrate'] * 100), stats['hits'], stats['hits'] + stats['misses']))
+
+    def live_search_changed(self):
+        """Изменился образец в одном из полей поиска - (пере)запуск
+        отложенного поиска при вводе."""
+
+        if not self.chklivesearch.get_active():
+            return
+
+        if self.livesearchtimer is not None:
+            GLib.source_remove(self.livesearchtimer)
+
+        self.livesearchtimer = GLib.timeout_add(self.LIVE_SEARCH_DELAY, self.live_search_timeout)
+
+    def live_search_timeout(self):
+        self.livesearchtimer = None
+        self.live_search()
+
+        return False
+
+    def live_search_cancel(self):
+        """Отмена отложенного и прерывание идущего поиска при вводе."""
+
+        if self.livesearchtimer is not None:
+            GLib.source_remove(self.livesearchtimer)
+            self.livesearchtimer = None
+
+        if self.searchjob is not None:
+            self.searchjob.cancel.set()
+            self.searchjob = None
+
+    def live_search(self):
+        """Поиск при вводе. Ищется в фоновом потоке, так что ввод не
+        тормозит; если образцы изменились раньше, чем поиск закончился -
+        он прерывается. Если новый поиск - уточнение предыдущего (напр.
+        к образцу добавили символ), ищется только среди найденного раньше."""
+
+        self.live_search_cancel()
+
+        patterns, empty = self.search_patterns()
+
+        if patterns is None:
+            # неправильный образец виден по иконке в его поле
+            return
+
+        if empty and not BookQuery(None, **self.search_filters()):
+            self.lastsearch = None
+            self.update_book_list()
+            return
+
+        filters = self.search_filters()
+
+        self.searchjob = SearchJob(self.current_library(), patterns, filters,
+            self.search_within(patterns, filters), self.loadinglib is not None, self.booklistsort)
+
+        # без show_task - тут незачем прокручивать главный цикл
+        self.labmsg.set_text(u'Поиск книг...')
+
+        threading.Thread(target=self.live_search_thread, args=(self.searchjob,), daemon=True).start()
+
+    def live_search_thread(self, job):
+        # выполняется в отдельном потоке, потому междумордие трогаем только через GLib.idle_add
+        try:
+            blist = job.run()
+        except Exception as ex:
+            print(u'Ошибка поиска: %s' % str(ex), file=sys.stderr)
+            blist = None
+
+        GLib.idle_add(self.live_search_finished, job, blist)
+
+    def live_search_finished(self, job, blist):
+        """Завершение поиска при вводе (вызывается из главного цикла)."""
+
+        # результаты прерванного или устаревшего поиска выкидываем
+        if job is self.searchjob and blist is not None:
+            self.searchjob = None
+            self.search_done(job.patterns, job.filters, blist, job.partial, job.listsort)
+
+        return False
+
     def extract_books(self):
         """Извлечение выбранных в списке книг"""
 
@@ -678,8 +1514,12 @@ class MainWnd():
         self.booklistviewsel.select_path(ix)
 
     def random_choice_from_all(self):
-        if library.books:
-            bookid = random.choice(list(library.books.keys())) # вот блин спасибо афтарам пыхтона, что dict.keys() нельзя использовать как список...
+        lib = self.current_library()
+
+        if lib.books:
+            with lib.lock:
+                bookid = random.choice(list(lib.books.keys())) # вот блин спасибо афтарам пыхтона, что dict.keys() нельзя использовать как список...
+            self.facetpanel.reset()
             self.update_book_list([bookid])
             self.select_book(0)
         else:
@@ -691,10 +1531,37 @@ class MainWnd():
         else:
             self.select_book(random.randrange(self.booklistcount))
 
+    def newest_books(self, count=None, mindate=None):
+        """Отображение книг, поступивших в библиотеку последними (см.
+        Library.newest_books), от новых к старым."""
+
+        self.live_search_cancel()
+
+        blist = self.current_library().newest_books(count, mindate)
+
+        self.lastsearch = None
+        self.facetpanel.reset()
+
+        # от новых к старым (при равных датах - от больших bookid к меньшим)
+        self.set_book_list_sort('date', True)
+        self.update_book_list(blist, True, self.booklistsort)
+
+        self.labmsg.set_text(u'Новых книг нет' if not blist else u' ')
+
+    def newest_books_since_last_visit(self):
+        if self.lastvisit is not None:
+            self.newest_books(mindate=self.lastvisit)
+
     def random_choice_from_authors(self):
-        if library.authors:
-            author = random.choice(list(library.authors.values()))
-            self.update_book_list(author.books)
+        lib = self.current_library()
+
+        if lib.authors:
+            with lib.lock:
+                author = random.choice(lib.authors)
+                bookids = list(author.books)
+
+            self.facetpanel.reset()
+            self.update_book_list(bookids)
         else:
             self.random_choice_from_all()
 
@@ -724,26 +1591,112 @@ class MainWnd():
         self.task_events()
         #print(fraction)
 
+    def current_library(self):
+        """Возвращает экземпляр Library, по которому ищутся книги:
+        во время загрузки - загружаемый (с уже загруженной частью книг),
+        иначе - library."""
+
+        return self.loadinglib if self.loadinglib is not None else library
+
     def library_load(self):
-        self.begin_task(u'Загрузка библиотеки...')
-        em = None
+        """Загрузка библиотеки в фоновом потоке.
+        Окно при этом остаётся доступным, а поиск идёт по уже загруженной
+        части библиотеки (см. current_library). Загруженный индекс
+        подменяет индекс library целиком по окончании загрузки
+        (см. Library.swap_index), до того в library остаётся старый."""
+
+        if self.loadinglib is not None:
+            return
+
+        self.loadinglib = library.new_index()
+
+        self.live_search_cancel()
+        self.lastsearch = None
+
+        self.show_task(u'Загрузка библиотеки...')
+        self.labbooktotal.set_text(u'(идёт загрузка библиотеки)')
+        self.update_book_panel()
+
+        threading.Thread(target=self.library_load_thread, args=(self.loadinglib,), daemon=True).start()
+
+    def library_load_thread(self, newlib):
+        # выполняется в отдельном потоке, потому междумордие трогаем только через GLib.idle_add
+        err = None
+
         try:
-            try:
-                #raise KeyError, u'проверка'
-                if not USEFAKELIBRARY:
-                    library.load(self.progress_callback)
-                else:
-                    fill_fake_library(library)
+            #raise KeyError, u'проверка'
+            if not USEFAKELIBRARY:
+                newlib.load(lambda fraction: GLib.idle_add(self.library_load_progress, fraction))
+            else:
+                fill_fake_library(newlib)
 
-                self.labbooktotal.set_text(u'(всего в библиотеке - %d)' % len(library.books))
+        except Exception as ex:
+            err = ex
 
-            except Exception as ex:
-                msg_dialog(self.window, u'Загрузка библиотеки',
-                    u'%s\n\nВероятно, библиотека повреждена или в настройках указан неправильный путь к библиотеке' % ex.args[0] if ex.args[0] else ex.__class__.__name,
-                    Gtk.MessageType.ERROR)
-                #exit(1)
-        finally:
-            self.end_task(em)
+        GLib.idle_add(self.library_loaded, newlib, err)
+
+    def library_load_progress(self, fraction):
+        if self.loadinglib is not None:
+            self.progbar.set_fraction(fraction)
+
+        return False
+
+    def library_loaded(self, newlib, err):
+        """Завершение загрузки (вызывается из главного цикла)."""
+
+        self.loadinglib = None
+
+        # поиск по недогруженной библиотеке, если он ещё идёт, повторится
+        # (см. library_loaded_refilter); найденное раньше уточнять нельзя
+        if self.searchjob is not None:
+            self.live_search_cancel()
+            self.partialsearch = True
+
+        self.lastsearch = None
+
+        if err is None:
+            library.swap_index(newlib)
+            self.genrechooser.set_genres(library)
+            self.fuzzy_index_prepare()
+
+            # список, заполненный во время загрузки не поиском (случайный
+            # выбор, последние поступления), может содержать книги, которых
+            # в загруженном индексе нет (найденное поиском - ищется заново,
+            # см. library_loaded_refilter)
+            if not self.partialsearch and self.foundbookids:
+                self.update_book_list(library.filter_dates(self.foundbookids), True, self.booklistsort)
+        else:
+            # в списке могут быть книги из недогруженной библиотеки
+            self.update_book_list()
+
+            msg_dialog(self.window, u'Загрузка библиотеки',
+                u'%s\n\nВероятно, библиотека повреждена или в настройках указан неправильный путь к библиотеке' % err.args[0] if err.args and err.args[0] else err.__class__.__name__,
+                Gtk.MessageType.ERROR)
+
+        self.labbooktotal.set_text(u'(всего в библиотеке - %d)' % len(library.books))
+        self.update_book_panel()
+
+        if self.ctlvbox.get_sensitive():
+            # иначе (поиск ещё идёт) - см. filter_books
+            self.end_task()
+            self.library_loaded_refilter()
+
+        return False
+
+    def fuzzy_index_prepare(self):
+        """Построение в фоне индекса нечёткого поиска авторов, если он
+        понадобится (см. Library.build_fuzzy_author_index) - чтобы
+        не ждать его при первом поиске."""
+
+        if self.fltrauthorentry.fuzzy and self.loadinglib is None and library.authorFuzzyIndex is None:
+            threading.Thread(target=library.build_fuzzy_author_index, daemon=True).start()
+
+    def library_loaded_refilter(self):
+        """Повтор поиска, сделанного по части библиотеки во время загрузки."""
+
+        if self.partialsearch:
+            self.partialsearch = False
+            self.filter_apply()
 
     def wnd_size_allocate(self, wnd, rect):
         """Сменился размер окна (координаты не получаем)"""
@@ -778,6 +1731,10 @@ class MainWnd():
         self.dlgabout.run()
 
     def settings_dialog(self, data=None):
+        if self.loadinglib is not None:
+            msg_dialog(self.window, u'Настройки', u'Библиотека ещё загружается, подождите немного')
+            return
+
         if self.dlgsettings.run():
             self.filter_reset()
             self.library_load()
@@ -801,10 +1758,11 @@ class MainWnd():
     def field_to_search(self, filterentry, fieldfunc):
         fs = set()
 
-        for bookid in self.bookids:
-            s = fieldfunc(bookid)
-            if s:
-                fs.add(s)
+        with self.current_library().lock:
+            for bookid in self.bookids:
+                s = fieldfunc(bookid)
+                if s:
+                    fs.add(s)
 
         fs = list(fs)
 
@@ -820,13 +1778,16 @@ class MainWnd():
             filterentry.chkisregexp.set_active(isre)
 
     def found_author_to_search(self):
-        self.field_to_search(self.fltrauthorentry, lambda bookid: library.authors[library.books[bookid].authorid].aname)
+        lib = self.current_library()
+        self.field_to_search(self.fltrauthorentry, lambda bookid: lib.authors[lib.books[bookid].authorid].aname)
 
     def found_title_to_search(self):
-        self.field_to_search(self.fltrtitleentry, lambda bookid: library.books[bookid].title)
+        lib = self.current_library()
+        self.field_to_search(self.fltrtitleentry, lambda bookid: lib.books[bookid].title)
 
     def found_series_to_search(self):
-        self.field_to_search(self.fltrseriesentry, lambda bookid: library.series[library.books[bookid].series])
+        lib = self.current_library()
+        self.field_to_search(self.fltrseriesentry, lambda bookid: lib.series[lib.books[bookid].series])
 
     def chkusedatefilter_toggled(self):
         self.maxdatechooser.set_sensitive(self.mindatechooser.checkbox.get_active())
@@ -882,6 +1843,8 @@ class MainWnd():
             ('booksRandomFromAll', None, u'Выбрать случайную книгу', '<Control>1', None, lambda w: self.random_choice_from_all()),
             ('booksRandomFromAuthors', None, u'Выбрать случайного автора', '<Control>2', None, lambda w: self.random_choice_from_authors()),
             ('booksRandomFromFound', None, u'Выбрать случайную книгу из найденных', '<Control>3', None, lambda w: self.random_choice_from_found()),
+            ('booksNewest', None, u'Последние поступления', '<Control>4', None, lambda w: self.newest_books(self.NEWEST_BOOKS)),
+            ('booksSinceLastVisit', None, u'Поступившие с прошлого запуска', '<Control>5', None, lambda w: self.newest_books_since_last_visit()),
             ('booksFind', Gtk.STOCK_FIND, None, '<Control>f', None, lambda w: self.filter_apply()),
             ('booksClear', Gtk.STOCK_CLEAR, None, '<Control>l', None, lambda w: self.filter_reset()),
             ('booksExtract', None, u'Извлечь выбранные', '<Control>e', None, lambda w: self.extract_books()),
@@ -907,6 +1870,9 @@ class MainWnd():
             <menuitem name="mnuBooksRandomFromAuthors" action="booksRandomFromAuthors"/>
             <menuitem name="mnuBooksRandomFromFound" action="booksRandomFromFound"/>
             <separator/>
+            <menuitem name="mnuBooksNewest" action="booksNewest"/>
+            <menuitem name="mnuBooksSinceLastVisit" action="booksSinceLastVisit"/>
+            <separator/>
             <menuitem name="mnuBooksFind" action="booksFind"/>
             <menuitem name="mnuBooksClear" action="booksClear"/>
             <menuitem name="mnuBooksExtract" action="booksExtract"/>
@@ -920,6 +1886,7 @@ class MainWnd():
 </ui>''')
 
         self.mnuitemextract = uimgr.get_widget('/ui/menubar/mnuBooks/mnuBooksExtract')
+        self.mnuitemsincelastvisit = uimgr.get_widget('/ui/menubar/mnuBooks/mnuBooksSinceLastVisit')
         self.mnuitemfoundauthortosearch = uimgr.get_widget('/ui/menubar/mnuBooks/mnuFoundToSearch/mnuFoundAuthorToSearch')
         self.mnuitemfoundtitletosearch = uimgr.get_widget('/ui/menubar/mnuBooks/mnuFoundToSearch/mnuFoundTitleToSearch')
         self.mnuitemfoundseriestosearch = uimgr.get_widget('/ui/menubar/mnuBooks/mnuFoundToSearch/mnuFoundSeriesToSearch')
@@ -959,8 +1926,14 @@ class MainWnd():
         # фильтр по названиям файлов
         self.fltrfnamesentry = add_filter_entry(u'_4. Имя файла:', self.uistate.FILTER_FNAMES)
 
+        for fe in self.filters.values():
+            fe.onchanged = self.live_search_changed
+
+        self.fltrauthorentry.onfuzzytoggled = self.fuzzy_index_prepare
+
         # фильтр по жанрам
-        # потом когда-нито
+        self.genrechooser = GenreChooser(flgr, flgr.append_row(u'_5. Жанры:'))
+        self.genrechooser.onchanged = self.live_search_changed
 
         # кнопки поиска и сброса фильтра
         flhbox = Gtk.HBox(spacing=WIDGET_SPACING)
@@ -977,6 +1950,10 @@ class MainWnd():
         btnfilterclear.connect('clicked', lambda b: self.filter_reset())
         flhbox.pack_start(btnfilterclear, False, False, 0)
 
+        self.chklivesearch = Gtk.CheckButton(u'при вводе')
+        self.chklivesearch.set_tooltip_text(u'Искать, не дожидаясь нажатия кнопки "Найти"')
+        flhbox.pack_start(self.chklivesearch, False, False, 0)
+
         flhbox.pack_start(Gtk.HSeparator(), False, False, WIDGET_SPACING * 4)
 
         flhbox.pack_start(Gtk.Label(u'Чего б почитать'), False, False, 0)
@@ -998,9 +1975,11 @@ class MainWnd():
 
         self.mindatechooser = DateChooser(u'не старше')
         self.mindatechooser.oncheckboxtoggled = self.chkusedatefilter_toggled
+        self.mindatechooser.onchanged = self.live_search_changed
         flhbox.pack_start(self.mindatechooser.container, False, False, 0)
 
         self.maxdatechooser = DateChooser(u'и не новее')
+        self.maxdatechooser.onchanged = self.live_search_changed
         flhbox.pack_start(self.maxdatechooser.container, False, False, 0)
 
         self.maxdatechooser.set_sensitive(False) # возможно, будет изменено загрузкой настроек
@@ -1010,10 +1989,23 @@ class MainWnd():
         #
         self.bookids = []
         self.booklistcount = 0
+        self.foundbookids = [] # список найденного без отбора по фасетам, см. facets_changed
+        self.booklistsort = self.DEFAULT_SORT # порядок сортировки списка книг, см. set_book_list_sort
+        self.datecells = {} # строки столбца "Дата", см. date_cell
+        self.facetsjob = None # id подсчёта фасет в главном цикле, см. facets_count
+        self.datecellsnow = None
+
+        self.loadinglib = None # загружаемая в фоне библиотека, см. library_load
+        self.partialsearch = False # последний поиск был по недогруженной библиотеке
+
+        self.livesearchtimer = None # id таймера отложенного поиска при вводе
+        self.searchjob = None # идущий поиск при вводе (экземпляр SearchJob)
+        self.lastsearch = None # (образцы, прочие условия, список bookid) последнего поиска, см. search_within
+        self.lastvisit = None # дата предыдущего запуска, см. load_ui_state
 
         blfrhb = Gtk.HBox(spacing=WIDGET_SPACING)
 
-        bltfrlab = Gtk.Label(u'_5. Книги:')
+        bltfrlab = Gtk.Label(u'_6. Книги:')
         bltfrlab.set_use_underline(True)
         blfrhb.pack_start(bltfrlab, False, False, 0)
 
@@ -1033,54 +2025,57 @@ class MainWnd():
         blvbox.set_border_width(WIDGET_SPACING)
         booklistfr.add(blvbox)
 
-        self.booklist = Gtk.ListStore(GObject.TYPE_INT64, # bookid
-            GObject.TYPE_STRING, # author
-            GObject.TYPE_STRING, # title
-            GObject.TYPE_STRING, # series
-            GObject.TYPE_STRING, # serno
-            GObject.TYPE_STRING, # genres
-            GObject.TYPE_STRING, # size
-            GObject.TYPE_STRING, # format
-            GObject.TYPE_STRING) # date
+        self.booklist = BookListModel()
 
         self.booklistview = Gtk.TreeView(self.booklist)
 
         self.booklistview.set_grid_lines(Gtk.TreeViewGridLines.VERTICAL)
         self.booklistview.set_rules_hint(True)
 
+        # строки одной высоты, а столбцы - фиксированной ширины: иначе
+        # TreeView для расчёта размеров запрашивает значения всех строк,
+        # и от отображения только видимых (см. BookListModel) толку нет
+        self.booklistview.set_fixed_height_mode(True)
+
         bltfrlab.set_mnemonic_widget(self.booklistview)
 
         self.colrefs = {} # костыль для определения столбца по координатам
         # ключи - экземпляры Gtk.TreeViewColumn, значения - номера столбцов в self.booklist
 
-        def mktvcol(ctitle, ix, expand, align=0.0, markup=False):
+        def mktvcol(ctitle, ix, expand, nchars, align=0.0, markup=False):
+            """nchars - начальная ширина столбца в символах."""
+
             crt = Gtk.CellRendererText()
             crt.props.xalign = align
-            crt.props.ellipsize = Pango.EllipsizeMode.END if expand else Pango.EllipsizeMode.NONE
+            crt.props.ellipsize = Pango.EllipsizeMode.END
 
             aname = 'markup' if markup else 'text'
 
             col = Gtk.TreeViewColumn(ctitle, crt)
             col.add_attribute(crt, aname, ix)
-            #col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
-            col.set_sizing(Gtk.TreeViewColumnSizing.GROW_ONLY)
-            col.set_resizable(expand)
+            col.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            col.set_fixed_width(self.booklistview.create_pango_layout(u'0' * nchars).get_pixel_size()[0] + WIDGET_SPACING * 2)
+            col.set_resizable(True)
             col.set_expand(expand)
 
+            if ix in self.COLID_TO_SORT:
+                col.set_clickable(True)
+                col.connect('clicked', self.booklist_column_clicked, self.COLID_TO_SORT[ix])
+
             self.colrefs[col] = ix
 
             return col
 
-        self.booklistview.append_column(mktvcol(u'Автор', self.COL_AUTHOR, True))
-        self.booklistview.append_column(mktvcol(u'Название', self.COL_TITLE, True))
-        self.booklistview.append_column(mktvcol(u'Цикл', self.COL_SERIES, True))
-        self.booklistview.append_column(mktvcol(u'#', self.COL_SERNO, False, 1.0))
-        self.booklistview.append_column(mktvcol(u'Жанры', self.COL_GENRES, True))
-        self.booklistview.append_column(mktvcol(u'Размер', self.COL_SIZE, False, 1.0))
-        self.booklistview.append_column(mktvcol(u'Формат', self.COL_FORMAT, False, 1.0))
+        self.booklistview.append_column(mktvcol(u'Автор', self.COL_AUTHOR, True, 20))
+        self.booklistview.append_column(mktvcol(u'Название', self.COL_TITLE, True, 30))
+        self.booklistview.append_column(mktvcol(u'Цикл', self.COL_SERIES, True, 15))
+        self.booklistview.append_column(mktvcol(u'#', self.COL_SERNO, False, 4, 1.0))
+        self.booklistview.append_column(mktvcol(u'Жанры', self.COL_GENRES, True, 20))
+        self.booklistview.append_column(mktvcol(u'Размер', self.COL_SIZE, False, 8, 1.0))
+        self.booklistview.append_column(mktvcol(u'Формат', self.COL_FORMAT, False, 6, 1.0))
 
         # date
-        datecol = mktvcol(u'Дата', self.COL_DATE, False, 1.0, True)
+        datecol = mktvcol(u'Дата', self.COL_DATE, False, 13, 1.0, True)
 
         self.booklistview.append_column(datecol)
 
@@ -1094,7 +2089,15 @@ class MainWnd():
         blscr.set_overlay_scrolling(False)
         blscr.add(self.booklistview)
 
-        blvbox.pack_start(blscr, True, True, 0)
+        # найденное и панель фасет
+        blpaned = Gtk.Paned.new(Gtk.Orientation.HORIZONTAL)
+        blvbox.pack_start(blpaned, True, True, 0)
+
+        blpaned.pack1(blscr, True, False)
+
+        self.facetpanel = FacetPanel()
+        self.facetpanel.onchanged = self.facets_changed
+        blpaned.pack2(self.facetpanel.container, False, False)
 
         self.booklistviewsel = self.booklistview.get_selection()
         self.booklistviewsel.set_mode(Gtk.SelectionMode.MULTIPLE)